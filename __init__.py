@@ -31,6 +31,7 @@ bl_info = {
 }
 
 import logging
+import os
 import time
 from . import cm_timings
 
@@ -241,6 +242,40 @@ customOutline = True  # This saves the outline value
 customRLines = True  # This saves the relationship lines value
 
 
+def newSimulation(scene, resumeFrame=None):
+    """Replace the current simulation with a new one and set up its agents"""
+    global sim
+    if "sim" in globals():
+        sim.stopFrameHandler()
+        del sim
+    stopReplay()
+    sim = Simulation(resumeFrame)
+    sim.setupActions()
+
+    for group in scene.cm_groups:
+        sim.createAgents(group)
+    return sim
+
+
+def prepareViewport(context):
+    """Turn off the viewport settings that slow down the simulation. They
+    are restored by SCENE_OT_cm_stop"""
+    global customSyncMode
+    global customOutline
+    global customRLines
+
+    customSyncMode = context.scene.sync_mode
+    context.scene.sync_mode = 'NONE'
+
+    if context.screen is not None:
+        for area in context.screen.areas:
+            if area.type == 'VIEW_3D':
+                customOutline = area.spaces[0].show_outline_selected
+                customRLines = area.spaces[0].show_relationship_lines
+                area.spaces[0].show_outline_selected = False
+                area.spaces[0].show_relationship_lines = False
+
+
 class SCENE_OT_cm_start(Operator):
     """Start to simulate the CrowdMaster agents."""
     bl_idname = "scene.cm_start"
@@ -248,38 +283,70 @@ class SCENE_OT_cm_start(Operator):
 
     def execute(self, context):
         scene = context.scene
-        global customSyncMode
-        global customOutline
-        global customRLines
 
         preferences = context.user_preferences.addons[__package__].preferences
         if (preferences.ask_to_save) and (bpy.data.is_dirty):
             self.report({'ERROR'}, "You must save your file first!")
             return {'CANCELLED'}
 
-        customSyncMode = scene.sync_mode
-        bpy.context.scene.sync_mode = 'NONE'
+        prepareViewport(context)
 
-        if bpy.context.screen is not None:
-            for area in bpy.context.screen.areas:
-                if area.type == 'VIEW_3D':
-                    customOutline = area.spaces[0].show_outline_selected
-                    customRLines = area.spaces[0].show_relationship_lines
-                    area.spaces[0].show_outline_selected = False
-                    area.spaces[0].show_relationship_lines = False
+        scene.frame_current = scene.cm_sim_start_frame
+
+        sim = newSimulation(scene)
+        sim.startFrameHandler()
+
+        if preferences.play_animation:
+            bpy.ops.screen.animation_play()
+
+        return {'FINISHED'}
+
+
+class SCENE_OT_cm_bake(Operator):
+    """Simulate all the frames between the start and end frame at once without playing the animation."""
+    bl_idname = "scene.cm_bake"
+    bl_label = "Bake Simulation"
+
+    def execute(self, context):
+        scene = context.scene
+
+        preferences = context.user_preferences.addons[__package__].preferences
+        if (preferences.ask_to_save) and (bpy.data.is_dirty):
+            self.report({'ERROR'}, "You must save your file first!")
+            return {'CANCELLED'}
 
         scene.frame_current = scene.cm_sim_start_frame
 
-        global sim
-        if "sim" in globals():
-            sim.stopFrameHandler()
-            del sim
-        sim = Simulation()
-        sim.setupActions()
+        sim = newSimulation(scene)
+        sim.run(scene.cm_sim_start_frame, scene.cm_sim_end_frame)
+
+        return {'FINISHED'}
 
-        for group in scene.cm_groups:
-            sim.createAgents(group)
 
+class SCENE_OT_cm_resume(Operator):
+    """Continue the simulation from the latest snapshot on or before the current frame."""
+    bl_idname = "scene.cm_resume"
+    bl_label = "Resume From Snapshot"
+
+    def execute(self, context):
+        scene = context.scene
+
+        preferences = context.user_preferences.addons[__package__].preferences
+        if (preferences.ask_to_save) and (bpy.data.is_dirty):
+            self.report({'ERROR'}, "You must save your file first!")
+            return {'CANCELLED'}
+
+        found = findSnapshot(scene, scene.frame_current)
+        if found is None:
+            self.report({'ERROR'}, "No snapshot found on or before this frame")
+            return {'CANCELLED'}
+        frame, path = found
+
+        prepareViewport(context)
+
+        sim = newSimulation(scene, resumeFrame=frame)
+        sim.loadSnapshot(path)
+        scene.frame_set(frame)
         sim.startFrameHandler()
 
         if preferences.play_animation:
@@ -288,6 +355,44 @@ class SCENE_OT_cm_start(Operator):
         return {'FINISHED'}
 
 
+class SCENE_OT_cm_snapshot_save(Operator):
+    """Save a snapshot of the running simulation that it can be resumed from."""
+    bl_idname = "scene.cm_snapshot_save"
+    bl_label = "Save Snapshot"
+
+    @classmethod
+    def poll(cls, context):
+        return "sim" in globals()
+
+    def execute(self, context):
+        sim.saveSnapshot()
+        return {'FINISHED'}
+
+
+class SCENE_OT_cm_cache_replay(Operator):
+    """Set the agents from the simulation cache whenever the frame changes."""
+    bl_idname = "scene.cm_cache_replay"
+    bl_label = "Replay Cache"
+
+    def execute(self, context):
+        path = bpy.path.abspath(context.scene.cm_sim_cache_path)
+        if not os.path.exists(path + ".index"):
+            self.report({'ERROR'}, "No simulation cache found")
+            return {'CANCELLED'}
+        startReplay(context.scene)
+        return {'FINISHED'}
+
+
+class SCENE_OT_cm_cache_replay_stop(Operator):
+    """Stop setting the agents from the simulation cache."""
+    bl_idname = "scene.cm_cache_replay_stop"
+    bl_label = "Stop Replay"
+
+    def execute(self, context):
+        stopReplay()
+        return {'FINISHED'}
+
+
 class SCENE_OT_cm_stop(Operator):
     """Stop simulating the CrowdMaster agents."""
     bl_idname = "scene.cm_stop"
@@ -354,10 +459,47 @@ class SCENE_PT_CrowdMaster(Panel):
         else:
             row.operator(SCENE_OT_cm_stop.bl_idname, icon='CANCEL')
 
+        row = layout.row()
+        row.operator(SCENE_OT_cm_bake.bl_idname, icon='REC')
+
         row = layout.row(align=True)
         row.prop(scene, "cm_sim_start_frame")
         row.prop(scene, "cm_sim_end_frame")
 
+        row = layout.row(align=True)
+        row.prop(scene, "cm_keyframe_mode")
+        if scene.cm_keyframe_mode == "BULK":
+            row.prop(scene, "cm_keyframe_flush_interval")
+
+        row = layout.row()
+        row.prop(scene, "cm_brain_evaluation")
+        if scene.cm_brain_evaluation == "PARALLEL":
+            row.prop(scene, "cm_brain_threads")
+
+        box = layout.box()
+        row = box.row()
+        row.prop(scene, "cm_sim_cache")
+        row = box.row()
+        row.prop(scene, "cm_sim_cache_path")
+        row = box.row(align=True)
+        row.operator(SCENE_OT_cm_cache_replay.bl_idname, icon='PLAY')
+        row.operator(SCENE_OT_cm_cache_replay_stop.bl_idname, icon='PAUSE')
+
+        box = layout.box()
+        row = box.row()
+        row.prop(scene, "cm_brain_cache")
+        row = box.row()
+        row.prop(scene, "cm_brain_cache_directory")
+
+        box = layout.box()
+        row = box.row()
+        row.prop(scene, "cm_snapshot_directory")
+        row = box.row()
+        row.prop(scene, "cm_snapshot_interval")
+        row = box.row(align=True)
+        row.operator(SCENE_OT_cm_snapshot_save.bl_idname, icon='FILE_TICK')
+        row.operator(SCENE_OT_cm_resume.bl_idname, icon='RECOVER_LAST')
+
         row = layout.row()
         row.separator()
 
@@ -437,6 +579,15 @@ class SCENE_PT_CrowdMasterAgents(Panel):
                             box.prop(group, "freezeAnimation")
                     else:
                         box.prop(group, "freezeAnimation")
+                    box.prop(group, "useLOD")
+                    if group.useLOD:
+                        row = box.row(align=True)
+                        row.prop(group, "lodMidDistance")
+                        row.prop(group, "lodMidRate")
+                        row = box.row(align=True)
+                        row.prop(group, "lodFarDistance")
+                        row.prop(group, "lodFarRate")
+                        box.prop(group, "lodActionRate")
                 if preferences.use_custom_icons:
                     op = box.operator(
                         SCENE_OT_cm_groups_reset.bl_idname, icon_value=cicon('reset'))
@@ -550,6 +701,11 @@ def register():
     bpy.utils.register_class(SCENE_OT_cm_agent_add)
     bpy.utils.register_class(SCENE_OT_cm_agent_add_selected)
     bpy.utils.register_class(SCENE_OT_cm_start)
+    bpy.utils.register_class(SCENE_OT_cm_bake)
+    bpy.utils.register_class(SCENE_OT_cm_resume)
+    bpy.utils.register_class(SCENE_OT_cm_snapshot_save)
+    bpy.utils.register_class(SCENE_OT_cm_cache_replay)
+    bpy.utils.register_class(SCENE_OT_cm_cache_replay_stop)
     bpy.utils.register_class(SCENE_OT_cm_stop)
     bpy.utils.register_class(SCENE_PT_CrowdMaster)
     bpy.utils.register_class(SCENE_PT_CrowdMasterAgents)
@@ -558,6 +714,14 @@ def register():
 
     global Simulation
     from .cm_simulate import Simulation
+    global findSnapshot
+    from .cm_simulate import findSnapshot
+    global startReplay
+    from .cm_simCache import startReplay
+    global stopReplay
+    from .cm_simCache import stopReplay
+    global replayLoadHandler
+    from .cm_simCache import replayLoadHandler
 
     global action_register
     from .cm_actions import action_register
@@ -598,6 +762,8 @@ def register():
 
     if nodeTreeSetFakeUser not in bpy.app.handlers.save_pre:
         bpy.app.handlers.save_pre.append(nodeTreeSetFakeUser)
+    if replayLoadHandler not in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.append(replayLoadHandler)
 
     preferences = bpy.context.user_preferences.addons[__package__].preferences
     if preferences.show_debug_options:
@@ -607,6 +773,7 @@ def register():
 
 
 def unregister():
+    stopReplay()
     unregister_icons()
 
     bpy.utils.unregister_class(SCENE_UL_group)
@@ -615,6 +782,11 @@ def unregister():
     bpy.utils.unregister_class(SCENE_OT_cm_agent_add)
     bpy.utils.unregister_class(SCENE_OT_cm_agent_add_selected)
     bpy.utils.unregister_class(SCENE_OT_cm_start)
+    bpy.utils.unregister_class(SCENE_OT_cm_bake)
+    bpy.utils.unregister_class(SCENE_OT_cm_resume)
+    bpy.utils.unregister_class(SCENE_OT_cm_snapshot_save)
+    bpy.utils.unregister_class(SCENE_OT_cm_cache_replay)
+    bpy.utils.unregister_class(SCENE_OT_cm_cache_replay_stop)
     bpy.utils.unregister_class(SCENE_OT_cm_stop)
     bpy.utils.unregister_class(SCENE_PT_CrowdMaster)
     bpy.utils.unregister_class(SCENE_PT_CrowdMasterAgents)
@@ -647,6 +819,8 @@ def unregister():
 
     if nodeTreeSetFakeUser in bpy.app.handlers.save_pre:
         bpy.app.handlers.save_pre.remove(nodeTreeSetFakeUser)
+    if replayLoadHandler in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.remove(replayLoadHandler)
 
 
 if __name__ == "__main__":
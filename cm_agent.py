@@ -25,16 +25,63 @@ import bpy
 import mathutils
 
 from . import cm_timings
+from .cm_agentState import stateProperty
 from .cm_compileBrain import compileBrain
 
 logger = logging.getLogger("CrowdMaster")
 
+"""Flags that are True if the transform was keyframed last frame"""
+KEY_ATTRS = ("arxKey", "aryKey", "arzKey", "apxKey", "apyKey", "apzKey")
+
 
 class Agent:
     """Represents each of the agents in the scene."""
 
+    __slots__ = ("id", "brain", "sim", "external", "access",
+                 "freezeAnimation", "geoGroup", "lod", "rigOverwrite",
+                 "constrainBone", "modifyBones", "index",
+                 "shapeKeys", "lastShapeKeys", "appliedTransform",
+                 "appliedShapeKeys") + KEY_ATTRS
+
+    """ar - absolute rot, r - change rot by, rs - rot speed"""
+    arx = stateProperty("rotation", 0)
+    ary = stateProperty("rotation", 1)
+    arz = stateProperty("rotation", 2)
+    rsx = stateProperty("rotationSpeed", 0)
+    rsy = stateProperty("rotationSpeed", 1)
+    rsz = stateProperty("rotationSpeed", 2)
+    rx = stateProperty("deltaRotation", 0)
+    ry = stateProperty("deltaRotation", 1)
+    rz = stateProperty("deltaRotation", 2)
+
+    """ap - absolute pos, p - change pos by, s - speed"""
+    apx = stateProperty("position", 0)
+    apy = stateProperty("position", 1)
+    apz = stateProperty("position", 2)
+    sx = stateProperty("speed", 0)
+    sy = stateProperty("speed", 1)
+    sz = stateProperty("speed", 2)
+    px = stateProperty("delta", 0)
+    py = stateProperty("delta", 1)
+    pz = stateProperty("delta", 2)
+
+    radius = stateProperty("radius")
+
+    @property
+    def dimensions(self):
+        return mathutils.Vector(self.sim.state.dimensions[self.index])
+
+    @property
+    def globalVelocity(self):
+        return mathutils.Vector(self.sim.state.velocity[self.index])
+
+    @globalVelocity.setter
+    def globalVelocity(self, value):
+        self.sim.state.velocity[self.index] = value
+
     def __init__(self, blenderid, nodeGroup, sim, rigOverwrite, constrainBone,
-                 tags=None, modifyBones=None, freezeAnimation=False, geoGroup=None):
+                 tags=None, modifyBones=None, freezeAnimation=False, geoGroup=None,
+                 lod=None):
         preferences = bpy.context.user_preferences.addons[__package__].preferences
         if preferences.show_debug_options:
             t = time.time()
@@ -52,6 +99,8 @@ class Agent:
 
         self.geoGroup = geoGroup
 
+        self.lod = lod  # type: cm_simulate.LevelOfDetail | None
+
         self.rigOverwrite = rigOverwrite
         self.constrainBone = constrainBone
         self.modifyBones = {}
@@ -63,56 +112,57 @@ class Agent:
 
         objs = bpy.data.objects
 
-        """Set the dimensions of this object"""
-        self.dimensions = objs[blenderid].dimensions
-        self.radius = max(self.dimensions) / 2
+        """Add this agent to the simulations state table. The absolute
+        position, rotation, speeds, velocity, scale and dimensions are stored
+        there."""
+        self.index = sim.state.add(blenderid,
+                                   objs[blenderid].location,
+                                   objs[blenderid].rotation_euler,
+                                   objs[blenderid].scale,
+                                   objs[blenderid].dimensions)
 
-        """ar - absolute rot, r - change rot by, rs - rot speed"""
-        self.arx = objs[blenderid].rotation_euler[0]
-        self.rx = 0
-        self.rsx = 0
         self.arxKey = True  # True if a keyframe was set last frame
-
-        self.ary = objs[blenderid].rotation_euler[1]
-        self.ry = 0
-        self.rsy = 0
         self.aryKey = True  # True if a keyframe was set last frame
-
-        self.arz = objs[blenderid].rotation_euler[2]
-        self.rz = 0
-        self.rsz = 0
         self.arzKey = True  # True if a keyframe was set last frame
-
-        """ap - absolute pos, p - change pos by, s - speed"""
-        self.apx = objs[blenderid].location[0]
-        self.px = 0
-        self.sx = 0
         self.apxKey = True  # True if a keyframe was set last frame
-
-        self.apy = objs[blenderid].location[1]
-        self.py = 0
-        self.sy = 0
         self.apyKey = True  # True if a keyframe was set last frame
-
-        self.apz = objs[blenderid].location[2]
-        self.pz = 0
-        self.sz = 0
         self.apzKey = True  # True if a keyframe was set last frame
 
-        self.globalVelocity = mathutils.Vector([0, 0, 0])
-
         self.shapeKeys = {}
         self.lastShapeKeys = set()
 
-        """Clear out the nla"""
-        if not freezeAnimation:
+        """Clear out the nla (unless the animation up to the snapshot that is
+        being resumed from should be kept)"""
+        resuming = sim.resumeFrame is not None
+        if not freezeAnimation and not resuming:
             objs[blenderid].animation_data_clear()
-            objs[blenderid].keyframe_insert(data_path="location", frame=1)
-            objs[blenderid].keyframe_insert(
-                data_path="rotation_euler", frame=1)
+            if not sim.writeKeyframes:
+                pass
+            elif sim.keyframes is None:
+                objs[blenderid].keyframe_insert(data_path="location", frame=1)
+                objs[blenderid].keyframe_insert(
+                    data_path="rotation_euler", frame=1)
+            else:
+                for dataPath in ("location", "rotation_euler"):
+                    value = getattr(objs[blenderid], dataPath)
+                    for index in range(3):
+                        sim.keyframes.insert(objs[blenderid], dataPath, index,
+                                             1, value[index],
+                                             "Object Transforms")
+
+        """The values that were last keyframed. Used instead of reading the
+        properties back when keyframes are written in bulk as the fcurves
+        aren't up to date while the simulation is running."""
+        self.appliedTransform = {
+            "location": list(objs[blenderid].location),
+            "rotation_euler": list(objs[blenderid].rotation_euler)
+        }
+        self.appliedShapeKeys = {}
 
         # Keyframe everything so agent return to the same position.
-        if self.geoGroup is None or self.geoGroup == "":
+        if resuming:
+            pass
+        elif self.geoGroup is None or self.geoGroup == "":
             # ie. manual agent
             if self.rigOverwrite != "":
                 obj = objs[self.id]
@@ -157,11 +207,16 @@ class Agent:
 
     def step(self):
         """Called each frame of the simulation."""
+        self.store(*self.evaluate())
 
-        objs = bpy.data.objects
-        preferences = bpy.context.user_preferences.addons[__package__].preferences
+    def evaluate(self):
+        """Run the brain of the agent. Only reads the state of the simulation
+        from the end of the last frame so the agents can be evaluated in any
+        order.
 
-        rot = objs[self.id].rotation_euler
+        :returns: The outputs of the brain and the tags for the next frame
+        :rtype: (dict, dict)"""
+        preferences = bpy.context.user_preferences.addons[__package__].preferences
 
         if preferences.show_debug_options:
             t = time.time()
@@ -169,57 +224,57 @@ class Agent:
         if preferences.show_debug_options:
             if preferences.show_debug_timings:
                 cm_timings.agent["brainExecute"] += time.time() - t
+        return self.evaluated()
+
+    def evaluated(self):
+        """Called once the brain has been executed for this frame, either by
+        self.evaluate or for many agents at once by
+        cm_batchBrain.evaluateBatched
+
+        :returns: The outputs of the brain and the tags for the next frame
+        :rtype: (dict, dict)"""
+        objs = bpy.data.objects
+        preferences = bpy.context.user_preferences.addons[__package__].preferences
+
+        if preferences.show_debug_options:
             if objs[self.id].select:
                 logger.debug("ID: {} Tags: {} outvars: {}".format(
                     self.id, self.brain.tags, self.brain.outvars))
             # TODO show this in the UI
         if preferences.show_debug_options:
             t = time.time()
-        if objs[self.id] == bpy.context.active_object:
-            self.brain.hightLight(bpy.context.scene.frame_current)
+        if objs[self.id] == getattr(bpy.context, "active_object", None):
+            self.brain.hightLight(self.sim.framelast)
         if preferences.show_debug_options and preferences.show_debug_timings:
             cm_timings.agent["highLight"] += time.time() - t
-            t = time.time()
-
-        self.rx = self.brain.outvars["rx"] if self.brain.outvars["rx"] else 0
-        self.ry = self.brain.outvars["ry"] if self.brain.outvars["ry"] else 0
-        self.rz = self.brain.outvars["rz"] if self.brain.outvars["rz"] else 0
-
-        self.arx += self.rx + self.rsx
-        self.rx = 0
-
-        self.ary += self.ry + self.rsy
-        self.ry = 0
-
-        self.arz += self.rz + self.rsz
-        self.rz = 0
-
-        self.px = self.brain.outvars["px"] if self.brain.outvars["px"] else 0
-        self.py = self.brain.outvars["py"] if self.brain.outvars["py"] else 0
-        self.pz = self.brain.outvars["pz"] if self.brain.outvars["pz"] else 0
-
-        self.shapeKeys = self.brain.outvars["sk"]
-
-        self.external["tags"] = self.brain.tags
-
-        move = mathutils.Vector((self.px + self.sx,
-                                 self.py + self.sy,
-                                 self.pz + self.sz))
 
-        z = mathutils.Matrix.Rotation(-self.arz, 4, 'Z')
-        y = mathutils.Matrix.Rotation(-self.ary, 4, 'Y')
-        x = mathutils.Matrix.Rotation(-self.arx, 4, 'X')
+        return self.brain.outvars, self.brain.tags
 
-        rotation = x * y * z
-        result = move * rotation
+    def coast(self):
+        """Called instead of self.step on frames that the level of detail
+        scheduler skips this agent. The brain isn't evaluated and the agent
+        keeps moving with the same velocity as last frame."""
+        self.brain.coast()
 
-        self.globalVelocity = result
+    def store(self, outvars, tags):
+        """Hand the outputs of the brain to the simulation. The position and
+        rotation are integrated for all agents at once by
+        AgentState.integrate once every agent has been evaluated."""
+        preferences = bpy.context.user_preferences.addons[__package__].preferences
+        if preferences.show_debug_options:
+            t = time.time()
 
-        self.apx += result[0]
+        state = self.sim.state
+        state.deltaRotation[self.index] = (outvars["rx"] or 0,
+                                           outvars["ry"] or 0,
+                                           outvars["rz"] or 0)
+        state.delta[self.index] = (outvars["px"] or 0,
+                                   outvars["py"] or 0,
+                                   outvars["pz"] or 0)
 
-        self.apy += result[1]
+        self.shapeKeys = outvars["sk"]
 
-        self.apz += result[2]
+        self.external["tags"] = tags
 
         if preferences.show_debug_options and preferences.show_debug_timings:
             cm_timings.agent["setOutput"] += time.time() - t
@@ -245,8 +300,10 @@ class Agent:
 
         """Set objects shape key value, rotation and location"""
 
-        lastFrame = bpy.context.scene.frame_current - 1
-        thisFrame = bpy.context.scene.frame_current
+        keyframes = self.sim.keyframes
+
+        lastFrame = self.sim.framelast - 1
+        thisFrame = self.sim.framelast
 
         if self.geoGroup is None or self.geoGroup == "":
             grpObjs = [obj]
@@ -260,104 +317,36 @@ class Agent:
                         sk = cobj.data.shape_keys.key_blocks.get(skNm)
                         if sk is not None:
                             skVal = self.shapeKeys[skNm]
-                            if abs(sk.value - skVal) > 0.000001:
+                            if keyframes is None:
+                                current = sk.value
+                            else:
+                                current = self.appliedShapeKeys.get(
+                                    (cobj.name, skNm), sk.value)
+                            if abs(current - skVal) > 0.000001:
                                 if skNm not in self.lastShapeKeys:
-                                    sk.keyframe_insert(
-                                        data_path="value", frame=lastFrame)
+                                    self.insertShapeKey(cobj, sk, lastFrame,
+                                                        current)
                                     self.lastShapeKeys.add(skNm)
                                 sk.value = skVal
-                                sk.keyframe_insert(
-                                    data_path="value", frame=thisFrame)
+                                self.insertShapeKey(cobj, sk, thisFrame, skVal)
                             else:
                                 if skNm in self.lastShapeKeys:
                                     self.lastShapeKeys.remove(skNm)
 
-        if abs(self.arx - obj.rotation_euler[0]) > 0.000001:
-            if not self.arxKey:
-                obj.keyframe_insert(data_path="rotation_euler",
-                                    index=0,
-                                    frame=lastFrame)
-                self.arxKey = True
-            obj.rotation_euler[0] = self.arx
-            obj.keyframe_insert(data_path="rotation_euler",
-                                index=0,
-                                frame=thisFrame)
-        else:
-            self.arxKey = False
-
-        if abs(self.ary - obj.rotation_euler[1]) > 0.000001:
-            if not self.aryKey:
-                obj.keyframe_insert(data_path="rotation_euler",
-                                    index=1,
-                                    frame=lastFrame)
-                self.aryKey = True
-            obj.rotation_euler[1] = self.ary
-            obj.keyframe_insert(data_path="rotation_euler",
-                                index=1,
-                                frame=thisFrame)
-        else:
-            self.aryKey = False
-
-        if abs(self.arz - obj.rotation_euler[2]) > 0.000001:
-            if not self.arzKey:
-                obj.keyframe_insert(data_path="rotation_euler",
-                                    index=2,
-                                    frame=lastFrame)
-                self.arzKey = True
-            obj.rotation_euler[2] = self.arz
-            obj.keyframe_insert(data_path="rotation_euler",
-                                index=2,
-                                frame=thisFrame)
-        else:
-            self.arzKey = False
-
-        if abs(self.apx - obj.location[0]) > 0.000001:
-            if not self.apxKey:
-                obj.keyframe_insert(data_path="location",
-                                    index=0,
-                                    frame=lastFrame)
-                self.apxKey = True
-            obj.location[0] = self.apx
-            obj.keyframe_insert(data_path="location",
-                                index=0,
-                                frame=thisFrame)
-        else:
-            self.apxKey = False
-
-        if abs(self.apy - obj.location[1]) > 0.000001:
-            if not self.apyKey:
-                obj.keyframe_insert(data_path="location",
-                                    index=1,
-                                    frame=lastFrame)
-                self.apyKey = True
-            obj.location[1] = self.apy
-            obj.keyframe_insert(data_path="location",
-                                index=1,
-                                frame=thisFrame)
-        else:
-            self.apyKey = False
-
-        if abs(self.apz - obj.location[2]) > 0.000001:
-            if not self.apzKey:
-                obj.keyframe_insert(data_path="location",
-                                    index=2,
-                                    frame=lastFrame)
-                self.apzKey = True
-            obj.location[2] = self.apz
-            obj.keyframe_insert(data_path="location",
-                                index=2,
-                                frame=thisFrame)
-        else:
-            self.apzKey = False
-
-        objs = bpy.context.scene.objects
-
-        modArm = None
-        if objs[self.id].type == 'Armature':
-            modArm = objs[self.id]
-        if self.rigOverwrite is not None and self.rigOverwrite != "":
-            modArm = objs[self.rigOverwrite]
-
+        self.applyTransform(obj, "rotation_euler", 0, self.arx, "arxKey",
+                            lastFrame, thisFrame)
+        self.applyTransform(obj, "rotation_euler", 1, self.ary, "aryKey",
+                            lastFrame, thisFrame)
+        self.applyTransform(obj, "rotation_euler", 2, self.arz, "arzKey",
+                            lastFrame, thisFrame)
+        self.applyTransform(obj, "location", 0, self.apx, "apxKey",
+                            lastFrame, thisFrame)
+        self.applyTransform(obj, "location", 1, self.apy, "apyKey",
+                            lastFrame, thisFrame)
+        self.applyTransform(obj, "location", 2, self.apz, "apzKey",
+                            lastFrame, thisFrame)
+
+        modArm = self.modifiedArmature()
         if modArm is not None:
             for bone in self.modifyBones:
                 for attribute in self.modifyBones[bone]:
@@ -368,24 +357,146 @@ class Agent:
                         if bone in modArm.pose.bones:
                             boneObj = modArm.pose.bones[bone]
                             if attribute == "RX":
-                                boneObj.rotation_euler[0] = tagVal
-                                boneObj.keyframe_insert(data_path="rotation_euler",
-                                                        index=0,
-                                                        frame=thisFrame)
+                                self.insertBoneRotation(modArm, boneObj, 0,
+                                                        tagVal, thisFrame)
                             if attribute == "RY":
-                                boneObj.rotation_euler[1] = tagVal
-                                boneObj.keyframe_insert(data_path="rotation_euler",
-                                                        index=1,
-                                                        frame=thisFrame)
+                                self.insertBoneRotation(modArm, boneObj, 1,
+                                                        tagVal, thisFrame)
                             if attribute == "RZ":
-                                boneObj.rotation_euler[2] = tagVal
-                                boneObj.keyframe_insert(data_path="rotation_euler",
-                                                        index=2,
-                                                        frame=thisFrame)
+                                self.insertBoneRotation(modArm, boneObj, 2,
+                                                        tagVal, thisFrame)
 
         if preferences.show_debug_options and preferences.show_debug_timings:
             cm_timings.agent["applyOutput"] += time.time() - t
 
+    def applyTransform(self, obj, dataPath, index, value, keyAttr,
+                       lastFrame, thisFrame):
+        """Set and keyframe one channel of the location or rotation of obj.
+        If the value was held constant up to now (keyAttr is False) then a
+        keyframe is also added on lastFrame to stop the fcurve interpolating
+        over the hold."""
+        if not self.sim.writeKeyframes:
+            getattr(obj, dataPath)[index] = value
+            return
+        keyframes = self.sim.keyframes
+        if keyframes is None:
+            current = getattr(obj, dataPath)[index]
+        else:
+            current = self.appliedTransform[dataPath][index]
+        if abs(value - current) > 0.000001:
+            if not getattr(self, keyAttr):
+                if keyframes is None:
+                    obj.keyframe_insert(data_path=dataPath, index=index,
+                                        frame=lastFrame)
+                else:
+                    keyframes.insert(obj, dataPath, index, lastFrame, current,
+                                     "Object Transforms")
+                setattr(self, keyAttr, True)
+            getattr(obj, dataPath)[index] = value
+            if keyframes is None:
+                obj.keyframe_insert(data_path=dataPath, index=index,
+                                    frame=thisFrame)
+            else:
+                keyframes.insert(obj, dataPath, index, thisFrame, value,
+                                 "Object Transforms")
+                self.appliedTransform[dataPath][index] = value
+        else:
+            setattr(self, keyAttr, False)
+
+    def insertShapeKey(self, cobj, sk, frame, value):
+        """Keyframe the value of the shape key sk (which is currently value)"""
+        if not self.sim.writeKeyframes:
+            return
+        keyframes = self.sim.keyframes
+        if keyframes is None:
+            sk.keyframe_insert(data_path="value", frame=frame)
+        else:
+            keyframes.insert(sk.id_data, sk.path_from_id("value"), 0, frame,
+                             value)
+            self.appliedShapeKeys[(cobj.name, sk.name)] = value
+
+    def modifiedArmature(self):
+        """The armature whose bones are rotated by self.modifyBones
+
+        :rtype: bpy.types.Object | None"""
+        objs = bpy.context.scene.objects
+        modArm = None
+        if objs[self.id].type == 'Armature':
+            modArm = objs[self.id]
+        if self.rigOverwrite is not None and self.rigOverwrite != "":
+            modArm = objs[self.rigOverwrite]
+        return modArm
+
+    def insertBoneRotation(self, modArm, boneObj, index, value, frame):
+        """Set and keyframe one channel of the euler rotation of a bone"""
+        boneObj.rotation_euler[index] = value
+        if not self.sim.writeKeyframes:
+            return
+        keyframes = self.sim.keyframes
+        if keyframes is None:
+            boneObj.keyframe_insert(data_path="rotation_euler", index=index,
+                                    frame=frame)
+        else:
+            keyframes.insert(modArm, boneObj.path_from_id("rotation_euler"),
+                             index, frame, value, boneObj.name)
+
+    def animatedIDs(self):
+        """The ID blocks that get keyframed by self.apply"""
+        objs = bpy.context.scene.objects
+        ids = [objs[self.id]]
+        if self.geoGroup is None or self.geoGroup == "":
+            grpObjs = [objs[self.id]]
+        else:
+            grpObjs = bpy.data.groups[self.geoGroup].objects
+        for cobj in grpObjs:
+            if cobj.type == 'MESH' and cobj.data.shape_keys is not None:
+                ids.append(cobj.data.shape_keys)
+        if self.rigOverwrite is not None and self.rigOverwrite != "":
+            ids.append(objs[self.rigOverwrite])
+        return ids
+
+    def snapshot(self):
+        """Everything about this agent that is carried between frames apart
+        from its row in sim.state (see Simulation.saveSnapshot)"""
+        return {"access": self.access,
+                "external": self.external,
+                "keyed": {k: getattr(self, k) for k in KEY_ATTRS},
+                "shapeKeys": self.shapeKeys,
+                "lastShapeKeys": self.lastShapeKeys,
+                "appliedTransform": self.appliedTransform,
+                "appliedShapeKeys": self.appliedShapeKeys,
+                "brain": self.brain.snapshot()}
+
+    def restore(self, data):
+        """Load the values returned by self.snapshot"""
+        self.access = data["access"]
+        self.external = data["external"]
+        for k, v in data["keyed"].items():
+            setattr(self, k, v)
+        self.shapeKeys = data["shapeKeys"]
+        self.lastShapeKeys = data["lastShapeKeys"]
+        self.appliedTransform = data["appliedTransform"]
+        self.appliedShapeKeys = data["appliedShapeKeys"]
+        self.brain.restore(data["brain"])
+
+    def truncate(self, frame):
+        """Remove the keyframes and NLA strips after frame so the simulation
+        can continue from a snapshot made on that frame"""
+        for idData in self.animatedIDs():
+            animData = idData.animation_data
+            if animData is None:
+                continue
+            if animData.action is not None:
+                for fc in animData.action.fcurves:
+                    points = fc.keyframe_points
+                    for i in reversed(range(len(points))):
+                        if points[i].co.x > frame:
+                            points.remove(points[i], fast=True)
+                    fc.update()
+            for track in animData.nla_tracks:
+                for strip in list(track.strips):
+                    if strip.frame_start > frame:
+                        track.strips.remove(strip)
+
     def highLight(self):
-        for n in self.brain.neurons.values():
-            n.highLight(bpy.context.scene.frame_current)
+        self.brain.hightLight(bpy.context.scene.frame_current)
@@ -0,0 +1,362 @@
+# Copyright 2017 CrowdMaster Developer Team
+#
+# ##### BEGIN GPL LICENSE BLOCK ######
+# This file is part of CrowdMaster.
+#
+# CrowdMaster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CrowdMaster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
+# ##### END GPL LICENSE BLOCK #####
+
+import math
+import unittest
+from types import SimpleNamespace
+
+import bpy
+import mathutils
+import numpy
+
+"""The arrays stored for each agent and the number of columns they have (None
+for a single value per agent)"""
+ARRAYS = (
+    ("position", 3),  # ap - absolute pos
+    ("rotation", 3),  # ar - absolute rot
+    ("speed", 3),  # s - speed
+    ("rotationSpeed", 3),  # rs - rot speed
+    ("velocity", 3),  # globalVelocity
+    ("delta", 3),  # p - change pos by
+    ("deltaRotation", 3),  # r - change rot by
+    ("radius", None),  # half the largest dimension
+    ("scale", 3),
+    ("dimensions", 3)
+)
+
+
+class AgentState:
+    """The transforms of every agent in the simulation stored as rows of
+    contiguous arrays. cm_agent.Agent objects only hold their row index and
+    read and write their values through this table."""
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.names = []  # type: List[str] - row -> agent name
+        self.index = {}  # type: Dict[str, int] - agent name -> row
+        self._allocate(capacity)
+        # Worked out from the rotations once per frame (see updateTransforms)
+        self.worldToLocal = numpy.zeros((0, 3, 3))
+        self.forward = numpy.zeros((0, 3))
+        self.matrices = {}  # type: Dict[int, mathutils.Matrix] - row -> matrix
+
+    def _allocate(self, capacity):
+        """(Re)create the arrays keeping the rows that are already in use"""
+        old = getattr(self, "position", None)
+        for name, columns in ARRAYS:
+            if columns is None:
+                new = numpy.zeros(capacity)
+            else:
+                new = numpy.zeros((capacity, columns))
+            if old is not None:
+                new[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def add(self, name, location, rotation, scale, dimensions):
+        """Add a new row for an agent. The simulation doesn't change the
+        scale or dimensions of the agents so they are only set here.
+
+        :returns: The row index of the agent
+        :rtype: int"""
+        if self.count == self.capacity:
+            self._allocate(self.capacity * 2)
+        row = self.count
+        self.count += 1
+        self.names.append(name)
+        self.index[name] = row
+        self.position[row] = location
+        self.rotation[row] = rotation
+        self.scale[row] = scale
+        self.dimensions[row] = dimensions
+        self.radius[row] = max(dimensions) / 2
+        return row
+
+    def integrate(self, skipped=None):
+        """Move every agent by the changes its brain output this frame.
+
+        The change in position is in the agents local space so it is rotated
+        by the agents new rotation (XYZ euler) before being accumulated.
+
+        :param skipped: Boolean mask of the rows whose brains weren't
+            evaluated this frame. They keep their rotation and move by their
+            velocity from last frame."""
+        n = self.count
+        rotation = self.rotation[:n]
+        if skipped is None:
+            rotation += self.deltaRotation[:n] + self.rotationSpeed[:n]
+        else:
+            live = ~skipped
+            rotation[live] += (self.deltaRotation[:n][live] +
+                               self.rotationSpeed[:n][live])
+        move = self.delta[:n] + self.speed[:n]
+
+        result = eulerRotate(move, rotation)
+        if skipped is not None:
+            result[skipped] = self.velocity[:n][skipped]
+
+        self.velocity[:n] = result
+        self.position[:n] += result
+
+        self.delta[:n] = 0
+        self.deltaRotation[:n] = 0
+
+    def updateTransforms(self, geometry=None):
+        """Work out the rotation into the local space of every agent and the
+        direction every agent is facing from the current rotations. Called
+        once at the start of each frame so that the channels don't need to
+        build rotation matrices from the euler angles of the agents.
+
+        worldToLocal[row] * v is the same as v * (Rx(x) * Ry(y) * Rz(z))
+        with mathutils, which is what the channels have always used to get
+        the position of a target relative to an agent. forward[row] is the
+        y axis rotated by the rotation of the agent.
+
+        :param geometry: The Geometry of the simulation. Agents it doesn't
+            take from this table (those with frozen animation) use the
+            rotation it reads from Blender instead."""
+        n = self.count
+        rotation = self.rotation[:n]
+        if geometry is not None:
+            rotation = rotation.copy()
+            for row, name in enumerate(self.names):
+                if geometry.row(name) is None:
+                    rotation[row] = geometry.rotation(name)
+        columns = [eulerRotate(numpy.tile(axis, (n, 1)), -rotation)
+                   for axis in numpy.identity(3)]
+        self.worldToLocal = numpy.stack(columns, axis=2)
+        self.forward = eulerRotate(numpy.tile((0.0, 1.0, 0.0), (n, 1)),
+                                   rotation)
+        self.matrices = {}
+
+    def localMatrix(self, row):
+        """worldToLocal[row] as a mathutils.Matrix. Only created for the
+        agents that are asked for and then kept until the next frame.
+
+        :rtype: mathutils.Matrix"""
+        matrix = self.matrices.get(row)
+        if matrix is None:
+            matrix = mathutils.Matrix(self.worldToLocal[row].tolist())
+            self.matrices[row] = matrix
+        return matrix
+
+    def keyName(self, key):
+        """The name of the agent a key of an impulse refers to. Agents are
+        keyed by their row. Other keys (cm_impulse.SCALAR) are returned
+        as they are."""
+        if isinstance(key, int):
+            return self.names[key]
+        return key
+
+    def view(self, name):
+        """The slices of the arrays that contain data for agents"""
+        return getattr(self, name)[:self.count]
+
+    def snapshot(self):
+        """A copy of the rows that are in use (see Simulation.saveSnapshot)"""
+        return {"names": list(self.names),
+                "arrays": {name: self.view(name).copy()
+                           for name, columns in ARRAYS}}
+
+    def restore(self, data):
+        """Load the values from a snapshot into the rows of the agents with
+        the same names"""
+        for row, name in enumerate(data["names"]):
+            if name in self.index:
+                i = self.index[name]
+                for arrayName, values in data["arrays"].items():
+                    getattr(self, arrayName)[i] = values[row]
+
+
+class Geometry:
+    """Where the agents and the other objects that the channels look at are
+    on this frame. Agents are read from the AgentState table of the
+    simulation. Objects the simulation doesn't move (including agents with
+    frozen animation, which keep their own animation) are read from Blender
+    the first time they are asked for on each frame. The channels use this
+    instead of reading the transforms of objects from bpy."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.objects = {}  # type: Dict[str, tuple] - name -> transforms
+
+    def newFrame(self):
+        """Forget the objects that were read from Blender"""
+        self.objects = {}
+
+    def row(self, name):
+        """The row of the agent in the AgentState table or None if the object
+        isn't moved by the simulation"""
+        agent = self.sim.agents.get(name)
+        if agent is None or agent.freezeAnimation:
+            return None
+        return agent.index
+
+    def sceneObject(self, name):
+        """(location, rotation, scale, dimensions) of an object that isn't
+        moved by the simulation"""
+        transforms = self.objects.get(name)
+        if transforms is None:
+            obj = bpy.data.objects[name]
+            transforms = (obj.location.copy(), obj.rotation_euler.copy(),
+                          obj.scale.copy(), obj.dimensions.copy())
+            self.objects[name] = transforms
+        return transforms
+
+    def location(self, name):
+        """:rtype: mathutils.Vector"""
+        row = self.row(name)
+        if row is None:
+            return self.sceneObject(name)[0].copy()
+        return mathutils.Vector(self.sim.state.position[row])
+
+    def rotation(self, name):
+        """:rtype: mathutils.Euler"""
+        row = self.row(name)
+        if row is None:
+            return self.sceneObject(name)[1].copy()
+        return mathutils.Euler(self.sim.state.rotation[row])
+
+    def scale(self, name):
+        """:rtype: mathutils.Vector"""
+        row = self.row(name)
+        if row is None:
+            return self.sceneObject(name)[2].copy()
+        return mathutils.Vector(self.sim.state.scale[row])
+
+    def dimensions(self, name):
+        """The size of the bounding box of the object
+
+        :rtype: mathutils.Vector"""
+        row = self.row(name)
+        if row is None:
+            return self.sceneObject(name)[3].copy()
+        return mathutils.Vector(self.sim.state.dimensions[row])
+
+    def matrixWorld(self, name):
+        """The matrix that transforms from the local space of the object to
+        world space. Built from its location, rotation and scale, so the
+        parent and constraints of the object are ignored.
+
+        :rtype: mathutils.Matrix"""
+        matrix = mathutils.Matrix.Translation(self.location(name)) * \
+            self.rotation(name).to_matrix().to_4x4()
+        axes = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+        for axis, factor in zip(axes, self.scale(name)):
+            matrix *= mathutils.Matrix.Scale(factor, 4, axis)
+        return matrix
+
+    def radius(self, name):
+        """Half of the largest dimension of the object"""
+        row = self.row(name)
+        if row is None:
+            return max(self.sceneObject(name)[3]) / 2
+        return float(self.sim.state.radius[row])
+
+
+def eulerRotate(vectors, eulers):
+    """Rotate each row of vectors by the matching row of XYZ euler angles.
+
+    Equivalent to vector * (Rx(-x) * Ry(-y) * Rz(-z)) with mathutils, or
+    Rz(z) * Ry(y) * Rx(x) * vector written as a column vector."""
+    cx, cy, cz = numpy.cos(eulers).T
+    sx, sy, sz = numpy.sin(eulers).T
+    x, y, z = vectors.T
+
+    y, z = cx * y - sx * z, sx * y + cx * z
+    x, z = cy * x + sy * z, cy * z - sy * x
+    x, y = cz * x - sz * y, sz * x + cz * y
+
+    return numpy.column_stack((x, y, z))
+
+
+def stateProperty(array, column=None):
+    """Property that reads and writes a single cell of the AgentState table
+    of the owning agent (which must have .sim and .index attributes)"""
+    if column is None:
+        def getter(self):
+            return float(getattr(self.sim.state, array)[self.index])
+
+        def setter(self, value):
+            getattr(self.sim.state, array)[self.index] = value
+    else:
+        def getter(self):
+            return float(getattr(self.sim.state, array)[self.index, column])
+
+        def setter(self, value):
+            getattr(self.sim.state, array)[self.index, column] = value
+    return property(getter, setter)
+
+
+class AgentStateTestCase(unittest.TestCase):
+    def testTransforms(self):
+        state = AgentState()
+        rotations = [(0.0, 0.0, 0.0), (0.0, 0.0, 1.2), (0.3, -0.7, 2.5),
+                     (-1.1, 0.4, 0.9)]
+        agents = {}
+        for i, rotation in enumerate(rotations):
+            name = "Agent.{:03d}".format(i)
+            agents[name] = SimpleNamespace(index=i, freezeAnimation=i == 3)
+            state.add(name, (i, 0, 0), rotation, (1, 1, 1), (2, 2, 2))
+        geometry = Geometry(SimpleNamespace(state=state, agents=agents))
+        # The frozen agent has been turned by its animation, not its brain
+        state.rotation[3] = (0.0, 0.0, 0.0)
+        geometry.objects["Agent.003"] = (mathutils.Vector((3, 0, 0)),
+                                         mathutils.Euler(rotations[3]),
+                                         mathutils.Vector((1, 1, 1)),
+                                         mathutils.Vector((2, 2, 2)))
+        state.updateTransforms(geometry)
+        target = mathutils.Vector((0.4, 1.5, -2.0))
+        for row, (x, y, z) in enumerate(rotations):
+            rotation = (mathutils.Matrix.Rotation(x, 4, 'X') *
+                        mathutils.Matrix.Rotation(y, 4, 'Y') *
+                        mathutils.Matrix.Rotation(z, 4, 'Z'))
+            expected = target * rotation
+            relative = state.localMatrix(row) * target
+            for a, b in zip(expected, relative):
+                self.assertAlmostEqual(a, b)
+            forward = mathutils.Vector((0, 1, 0))
+            forward.rotate(mathutils.Euler((x, y, z)))
+            for a, b in zip(forward, state.forward[row]):
+                self.assertAlmostEqual(a, b)
+
+    def testGeometry(self):
+        state = AgentState()
+        state.add("Agent", (1, 2, 3), (0, 0, 0.5), (2, 2, 2), (1, 4, 2))
+        agent = SimpleNamespace(index=0, freezeAnimation=False)
+        sim = SimpleNamespace(state=state, agents={"Agent": agent})
+        geometry = Geometry(sim)
+        self.assertEqual(tuple(geometry.location("Agent")), (1, 2, 3))
+        self.assertEqual(tuple(geometry.scale("Agent")), (2, 2, 2))
+        self.assertEqual(tuple(geometry.dimensions("Agent")), (1, 4, 2))
+        self.assertEqual(geometry.radius("Agent"), 2)
+        self.assertAlmostEqual(geometry.rotation("Agent").z, 0.5)
+        point = geometry.matrixWorld("Agent") * mathutils.Vector((1, 0, 0))
+        expected = (1 + 2 * math.cos(0.5), 2 + 2 * math.sin(0.5), 3)
+        for a, b in zip(point, expected):
+            self.assertAlmostEqual(a, b, places=5)
+        state.position[0] = (4, 5, 6)
+        self.assertEqual(tuple(geometry.location("Agent")), (4, 5, 6))
+
+    def testKeyName(self):
+        state = AgentState()
+        state.add("Agent", (0, 0, 0), (0, 0, 0), (1, 1, 1), (1, 1, 1))
+        state.add("Agent.001", (0, 0, 0), (0, 0, 0), (1, 1, 1), (1, 1, 1))
+        self.assertEqual(state.keyName(1), "Agent.001")
+        self.assertEqual(state.keyName("None"), "None")
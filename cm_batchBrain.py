@@ -0,0 +1,386 @@
+# Copyright 2017 CrowdMaster Developer Team
+#
+# ##### BEGIN GPL LICENSE BLOCK ######
+# This file is part of CrowdMaster.
+#
+# CrowdMaster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CrowdMaster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
+# ##### END GPL LICENSE BLOCK #####
+
+"""Evaluate the brains of all the agents that use the same brain at once.
+
+The neurons that have a vectorised form (see Neuron.batch) are evaluated
+once for all of the agents with numpy. Their outputs are kept as a
+BatchImpulse, which holds the (agent, key, value) of every entry of the
+dict that each agent would have got. The rest of the neurons and the states
+are evaluated agent by agent in segments between the vectorised ones.
+
+In the parallel mode the agents of each batch are split into contiguous
+chunks and the vectorised segments of each chunk are evaluated on a pool of
+worker threads (numpy releases the GIL while it works on the arrays). The
+vectorised neurons only do elementwise maths and merge the inputs of each
+agent on their own so every chunk gives the same bits it would have as part
+of the whole batch. Neurons that aren't vectorised read bpy and the channels
+so they stay on the main thread.
+"""
+
+import random
+import threading
+import unittest
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy
+
+from .cm_brainClasses import GATED, LOGIC, SHARED, STATE
+from .cm_impulse import SCALAR, Impulse, normaliseOutput, scalar
+from .cm_nodeFunctions import LogicMATH, LogicNOT, LogicSTRONG
+
+"""Batches are split so that each worker thread gets at least this many
+agents. The numpy calls for fewer aren't long enough to be worth it."""
+MIN_CHUNK = 256
+
+
+class KeyTable:
+    """Integer codes for the keys of impulses (agent rows and SCALAR)"""
+
+    def __init__(self):
+        self.codes = {}
+        self.keys = []
+        # Chunks of a batch can be converted on several threads at once. The
+        # codes given to the keys then depend on the order the threads get
+        # to them but the results don't (see BatchImpulse.merge).
+        self.lock = threading.Lock()
+
+    def code(self, key):
+        code = self.codes.get(key)
+        if code is None:
+            with self.lock:
+                if key not in self.codes:
+                    self.keys.append(key)
+                    self.codes[key] = len(self.keys) - 1
+                code = self.codes[key]
+        return code
+
+
+keyTable = KeyTable()
+
+
+class BatchImpulse:
+    """The outputs of one neuron for every agent in a batch. Entry i is the
+    value of key keys[i] in the dict of agent rows[i]. The entries of each
+    agent are in the same order as the keys of its dict."""
+
+    def __init__(self, rows, keys, values):
+        self.rows = rows  # type: numpy.ndarray - int, index in the batch
+        self.keys = keys  # type: numpy.ndarray - int, see KeyTable
+        self.values = values  # type: numpy.ndarray - float
+
+    @classmethod
+    def fromDicts(cls, dicts):
+        """:param dicts: The impulse of each agent (None is empty)"""
+        rows = []
+        keys = []
+        values = []
+        code = keyTable.code
+        for row, impulse in enumerate(dicts):
+            if impulse:
+                rows += [row] * len(impulse)
+                keys += [code(k) for k in impulse]
+                values += impulse.values()
+        return cls(numpy.array(rows, dtype=numpy.int64),
+                   numpy.array(keys, dtype=numpy.int64),
+                   numpy.array(values, dtype=numpy.float64))
+
+    def toImpulses(self, count):
+        """The impulse of each of the count agents"""
+        names = keyTable.keys
+        keys = [names[k] for k in self.keys.tolist()]
+        values = self.values.tolist()
+        # The entries of each agent are together and in order of agent
+        bounds = numpy.searchsorted(self.rows, numpy.arange(count + 1)).tolist()
+        return [scalar(values[start])
+                if end - start == 1 and keys[start] == SCALAR
+                else Impulse(keys[start:end], values[start:end])
+                for start, end in zip(bounds, bounds[1:])]
+
+    @classmethod
+    def merge(cls, impulses, keepFirst):
+        """Join the inputs of a neuron, the way a core that loops over all
+        of its inputs and keys would. Each agent keeps one entry per key in
+        the order the keys are first seen.
+
+        :param keepFirst: Keep the value from the first input with a key
+            rather than the last."""
+        if len(impulses) == 0:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return cls(empty, empty, numpy.zeros(0))
+        if len(impulses) == 1:
+            only = impulses[0]
+            return cls(only.rows, only.keys, only.values)
+        rows = numpy.concatenate([i.rows for i in impulses])
+        keys = numpy.concatenate([i.keys for i in impulses])
+        values = numpy.concatenate([i.values for i in impulses])
+        # Stable sort by agent so the entries of each agent stay in order
+        order = numpy.argsort(rows, kind="stable")
+        rows = rows[order]
+        keys = keys[order]
+        values = values[order]
+        combined = rows * len(keyTable.keys) + keys
+        unique, first, inverse = numpy.unique(combined, return_index=True,
+                                              return_inverse=True)
+        if keepFirst:
+            taken = first
+        else:
+            taken = numpy.zeros(len(unique), dtype=numpy.int64)
+            numpy.maximum.at(taken, inverse.ravel(), numpy.arange(len(combined)))
+        seen = numpy.argsort(first)
+        return cls(rows[first[seen]], keys[first[seen]], values[taken[seen]])
+
+
+class BatchPlan:
+    """The plan of a brain template (see BrainTemplate.plan) split into
+    segments that are either evaluated for all the agents at once or for
+    one agent at a time"""
+
+    def __init__(self, template, plan):
+        self.template = template
+        self.gated = [slot for slot, kind, inputSlots in plan if kind == GATED]
+        self.shared = [slot for slot, kind, inputSlots in plan
+                       if kind == SHARED]
+
+        # Vectorised neurons get odd levels and the others even levels. The
+        # neurons evaluated by agent stay in the order of the plan as they
+        # can change the tags and outputs of the brain.
+        levels = {}
+        segments = {}
+        lastAgentLevel = 0
+        for slot, kind, inputSlots in plan:
+            if kind in (GATED, SHARED):
+                continue
+            nt = template.neurons[slot]
+            if kind == STATE:
+                function = None
+                deps = nt.valueInputSlots
+            else:
+                try:
+                    function = nt.neuronType.batch(nt)
+                except KeyError:
+                    # Missing settings are left to raise from core
+                    function = None
+                deps = inputSlots
+            level = max([levels[i] for i in deps if i in levels] + [0])
+            if function is not None:
+                if level % 2 == 0:
+                    level += 1
+            else:
+                level = max(level, lastAgentLevel)
+                if level % 2 == 1:
+                    level += 1
+                lastAgentLevel = level
+            levels[slot] = level
+            segments.setdefault(level, []).append(
+                (slot, kind, inputSlots, function, nt.neuronType))
+
+        self.segments = []
+        self.materialise = set()
+        for level in sorted(segments):
+            entries = segments[level]
+            vectorised = level % 2 == 1
+            usesChannels = any(nType.usesChannels for slot, kind, inputSlots,
+                               function, nType in entries)
+            self.segments.append((vectorised, usesChannels, entries))
+            if not vectorised:
+                for slot, kind, inputSlots, function, nType in entries:
+                    if kind == STATE:
+                        deps = template.neurons[slot].valueInputSlots
+                    else:
+                        deps = inputSlots
+                    self.materialise.update(i for i in deps
+                                            if levels.get(i, 0) % 2 == 1)
+
+    def run(self, brains, frame, pool=None, workers=1):
+        """Does the same as calling Brain.run for each of the brains. The
+        outputs of vectorised neurons are only stored in Brain.results if
+        a neuron that isn't vectorised needs them or the brain is recording
+        its outputs for the node colours (see Brain.record).
+
+        :param pool: Evaluate the vectorised segments for chunks of the
+            brains on this pool of workers threads.
+        :type pool: concurrent.futures.Executor | None
+        :param workers: The number of threads in the pool"""
+        chunks = [brains]
+        if pool is not None:
+            chunks = partition(brains, min(workers, len(brains) // MIN_CHUNK))
+        for slot in self.gated:
+            for brain in brains:
+                brain.results[slot] = None
+        for slot in self.shared:
+            output = self.template.shared[slot]
+            for brain in brains:
+                brain.results[slot] = output
+        # The outputs of the vectorised neurons for each chunk
+        batched = [{} for chunk in chunks]
+        for vectorised, usesChannels, entries in self.segments:
+            if vectorised:
+                if len(chunks) == 1:
+                    self.runVectorised(entries, brains, batched[0])
+                else:
+                    futures = [pool.submit(self.runVectorised, entries, chunk,
+                                           chunkBatched)
+                               for chunk, chunkBatched in zip(chunks, batched)]
+                    for future in futures:
+                        future.result()
+            else:
+                for brain in brains:
+                    if usesChannels:
+                        for var in brain.lvars.values():
+                            var.setuser(brain.userid)
+                    results = brain.results
+                    slots = brain.slots
+                    for slot, kind, inputSlots, function, nType in entries:
+                        if kind == STATE:
+                            slots[slot].evaluate()
+                            continue
+                        neuron = slots[slot]
+                        inps = [results[i] for i in inputSlots
+                                if results[i] is not None]
+                        output = normaliseOutput(neuron.core(inps,
+                                                             neuron.settings))
+                        results[slot] = output
+
+    def runVectorised(self, entries, brains, batched):
+        """Evaluate a vectorised segment for all of the brains at once
+
+        :param batched: {slot: BatchImpulse} - the outputs of the vectorised
+            neurons for these brains, which this segment adds to"""
+        count = len(brains)
+        recording = any(brain.recording for brain in brains)
+        for slot, kind, inputSlots, function, nType in entries:
+            inputs = []
+            for i in inputSlots:
+                if i in batched:
+                    inputs.append(batched[i])
+                else:
+                    inputs.append(BatchImpulse.fromDicts(
+                        [brain.results[i] for brain in brains]))
+            impulse = BatchImpulse.merge(inputs, nType.keepsFirstKey)
+            with numpy.errstate(all="ignore"):
+                impulse.values = function(impulse.values)
+            batched[slot] = impulse
+            if slot in self.materialise:
+                for brain, output in zip(brains, impulse.toImpulses(count)):
+                    brain.results[slot] = output
+            elif recording:
+                for brain, output in zip(brains, impulse.toImpulses(count)):
+                    if brain.recording:
+                        brain.results[slot] = output
+
+
+def partition(items, count):
+    """Split items into count (at least 1) contiguous chunks of nearly equal
+    size
+
+    :rtype: List[list]"""
+    count = max(1, count)
+    size, extra = divmod(len(items), count)
+    chunks = []
+    start = 0
+    for c in range(count):
+        end = start + size + (1 if c < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def evaluateBatched(sim, names):
+    """Simulation.evaluate with the agents grouped by brain and evaluation
+    plan so that each group can be evaluated together"""
+    groups = OrderedDict()
+    keys = {}
+    for name in names:
+        brain = sim.agents[name].brain
+        key = brain.prepare()
+        keys[name] = key
+        groups.setdefault((brain.template, key), []).append(brain)
+    pool = sim.workerPool()
+    for (template, key), brains in groups.items():
+        template.batchPlan(*key).run(brains, sim.framelast, pool,
+                                     sim.workerCount)
+    results = {}
+    for name in names:
+        agent = sim.agents[name]
+        state = agent.brain.transition()
+        if agent.brain.recording:
+            agent.brain.record(*keys[name], state)
+        results[name] = agent.evaluated()
+    return results
+
+
+class BatchImpulseTestCase(unittest.TestCase):
+    def testRoundTrip(self):
+        dicts = [{3: 1.0, SCALAR: 2.5}, None, {}, {0: -1.0}, scalar(4.0)]
+        impulse = BatchImpulse.fromDicts(dicts)
+        impulses = impulse.toImpulses(5)
+        self.assertEqual(impulses, [{3: 1.0, SCALAR: 2.5}, {}, {}, {0: -1.0},
+                                    {SCALAR: 4.0}])
+        self.assertTrue(impulses[4].isScalar())
+        again = BatchImpulse.fromDicts(impulses)
+        self.assertEqual(again.toImpulses(5), impulses)
+
+    def testMerge(self):
+        first = BatchImpulse.fromDicts([{"a": 1.0, "b": 2.0}, {"c": 3.0}])
+        second = BatchImpulse.fromDicts([{"b": 4.0, "d": 5.0}, {}])
+        last = BatchImpulse.merge([first, second], False).toImpulses(2)
+        self.assertEqual(last, [{"a": 1.0, "b": 4.0, "d": 5.0}, {"c": 3.0}])
+        self.assertEqual(list(last[0]), ["a", "b", "d"])
+        kept = BatchImpulse.merge([first, second], True).toImpulses(2)
+        self.assertEqual(kept, [{"a": 1.0, "b": 2.0, "d": 5.0}, {"c": 3.0}])
+
+
+class ParallelBatchTestCase(unittest.TestCase):
+    """The vectorised segments must give exactly the same results when the
+    batch is split between worker threads"""
+
+    def brains(self):
+        rng = random.Random(7)
+        names = [SCALAR, 0, 1, 2]
+        brains = []
+        for i in range(3000):
+            keys = rng.sample(names, rng.randint(0, 3))
+            inputs = {k: rng.uniform(-5, 5) for k in keys}
+            brains.append(SimpleNamespace(results=[inputs, None, None, None],
+                                          recording=True))
+        return brains
+
+    def testParallel(self):
+        neurons = [SimpleNamespace(neuronType=None, settings={}),
+                   SimpleNamespace(neuronType=LogicMATH,
+                                   settings={"operation": "div",
+                                             "num1": 3.7}),
+                   SimpleNamespace(neuronType=LogicNOT, settings={}),
+                   SimpleNamespace(neuronType=LogicSTRONG, settings={})]
+        template = SimpleNamespace(neurons=neurons, shared=[None] * 4)
+        # Slot 0 stands for a neuron that isn't vectorised
+        plan = BatchPlan(template, ((1, LOGIC, (0,)), (2, LOGIC, (1,)),
+                                    (3, LOGIC, (2, 0))))
+        serial = self.brains()
+        plan.run(serial, 1)
+        parallel = self.brains()
+        with ThreadPoolExecutor(4) as pool:
+            plan.run(parallel, 1, pool, 4)
+        for a, b in zip(serial, parallel):
+            for slot in (1, 2, 3):
+                self.assertEqual(list(a.results[slot].items()),
+                                 list(b.results[slot].items()))
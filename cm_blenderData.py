@@ -48,6 +48,74 @@ bpy.types.Scene.cm_sim_end_frame = IntProperty(
     default=250,
     update=updateEndFrame,
 )
+bpy.types.Scene.cm_keyframe_mode = EnumProperty(
+    name="Keyframe Mode",
+    description="How the simulated animation is written to the agents",
+    items=[("IMMEDIATE", "Immediate",
+            "Insert the keyframes for each agent as each frame is simulated"),
+           ("BULK", "Bulk",
+            "Buffer the keyframes in memory and write them all at once when the simulation stops"),
+           ("NONE", "None",
+            "Don't keyframe the agents. Use with the simulation cache to replay the simulation")],
+    default="IMMEDIATE",
+)
+bpy.types.Scene.cm_keyframe_flush_interval = IntProperty(
+    name="Flush Interval",
+    description="Write the buffered keyframes every this many frames (0 only writes them when the simulation stops)",
+    default=0,
+    min=0,
+)
+bpy.types.Scene.cm_brain_evaluation = EnumProperty(
+    name="Brain Evaluation",
+    description="How the brains of the agents are evaluated",
+    items=[("AGENT", "Per Agent",
+            "Evaluate the brain of each agent on its own"),
+           ("BATCH", "Batched",
+            "Evaluate the brains of all the agents of each brain type together, with the maths nodes vectorised"),
+           ("PARALLEL", "Parallel",
+            "Batched, with the vectorised maths nodes of large batches split between several threads")],
+    default="AGENT",
+)
+bpy.types.Scene.cm_brain_threads = IntProperty(
+    name="Threads",
+    description="The number of threads used by the parallel brain evaluation (0 uses one per processor)",
+    default=0,
+    min=0,
+)
+bpy.types.Scene.cm_sim_cache = BoolProperty(
+    name="Write Cache",
+    description="Write the transforms, shape keys and tags of the agents for every frame to the simulation cache",
+    default=False,
+)
+bpy.types.Scene.cm_sim_cache_path = StringProperty(
+    name="Cache File",
+    description="The file the simulation cache is written to",
+    default="//crowdmaster.cmcache",
+    subtype="FILE_PATH",
+)
+bpy.types.Scene.cm_brain_cache = BoolProperty(
+    name="Cache Brains",
+    description="Save the compiled brains so that simulations with brains that haven't changed start faster. Only used once the .blend file has been saved",
+    default=False,
+)
+bpy.types.Scene.cm_brain_cache_directory = StringProperty(
+    name="Brain Cache Directory",
+    description="The directory the compiled brains are saved in",
+    default="//cm_brain_cache/",
+    subtype="DIR_PATH",
+)
+bpy.types.Scene.cm_snapshot_interval = IntProperty(
+    name="Snapshot Interval",
+    description="Save a snapshot of the simulation every this many frames so it can be resumed from (0 to disable)",
+    default=0,
+    min=0,
+)
+bpy.types.Scene.cm_snapshot_directory = StringProperty(
+    name="Snapshot Directory",
+    description="The directory the snapshots of the simulation are saved in",
+    default="//cm_snapshots/",
+    subtype="DIR_PATH",
+)
 
 
 class modifyBoneProperty(PropertyGroup):
@@ -91,6 +159,25 @@ class group_entry(PropertyGroup):
     freezePlacement = BoolProperty(name="Freeze Placement", default=False)
     freezeAnimation = BoolProperty(name="Freeze Animation", default=False)
 
+    useLOD = BoolProperty(name="Level of Detail",
+                          description="Evaluate the brains of agents that are far from the camera or can't change state less often",
+                          default=False)
+    lodMidDistance = FloatProperty(name="Mid Distance",
+                                   description="Distance from the camera after which the mid rate is used",
+                                   default=30.0, min=0.0)
+    lodMidRate = IntProperty(name="Mid Rate",
+                             description="Evaluate the brains of agents beyond the mid distance every this many frames",
+                             default=4, min=1)
+    lodFarDistance = FloatProperty(name="Far Distance",
+                                   description="Distance from the camera after which the far rate is used",
+                                   default=80.0, min=0.0)
+    lodFarRate = IntProperty(name="Far Rate",
+                             description="Evaluate the brains of agents beyond the far distance every this many frames",
+                             default=8, min=1)
+    lodActionRate = IntProperty(name="Action Rate",
+                                description="Evaluate the brains of agents in a state that can't be interrupted every this many frames",
+                                default=8, min=1)
+
 
 class manual_props(PropertyGroup):
     """All settings for manually adding agents."""
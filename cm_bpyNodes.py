@@ -17,7 +17,6 @@
 # along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
 # ##### END GPL LICENSE BLOCK #####
 
-import random
 import textwrap
 
 import bpy
@@ -766,8 +765,6 @@ class StartState(StateNode):
     def getSettings(self, item):
         item.settings["minRandWait"] = self.minRandWait
         item.settings["maxRandWait"] = self.maxRandWait
-        item.length = random.randint(self.minRandWait,
-                                     self.maxRandWait)
 
     def draw_buttons(self, context, layout):
         row = layout.row()
@@ -18,135 +18,159 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import logging
-import random
 import time
+from collections import deque
 
 import bpy
 import mathutils
-from bpy.props import BoolProperty
 
 from . import cm_timings
+from .cm_impulse import normaliseOutput
+from .cm_random import RandomStream
 
 logger = logging.getLogger("CrowdMaster")
 
 
+"""The kinds of entry in an evaluation plan (see BrainTemplate.plan)"""
+GATED = 0  # A neuron that is dependant on a state that isn't current
+LOGIC = 1
+STATE = 2
+SHARED = 3  # A neuron with the same output for every agent (see below)
+
+"""How much the output of a neuron can vary (see Neuron.invariance). Used by
+BrainTemplate.share to only evaluate the neurons that are the same for every
+agent once per frame or once per simulation."""
+PER_AGENT = 0
+PER_FRAME = 1
+STATIC = 2
+
+
+def resultColour(output):
+    """The colour a neuron with this output is shown in if the agent is
+    selected
+
+    :rtype: (float, float, float) - HSV"""
+    if output:
+        val = 1
+        av = sum(output.values()) / len(output)
+        if av > 0:
+            startHue = 0.333
+        else:
+            startHue = 0.5
+
+        if av > 1:
+            hueChange = -(-(abs(av) + 1) / abs(av) + 2) * (1 / 3)
+            hue = 0.333 + hueChange
+            sat = 1
+        elif av < -1:
+            hueChange = (-(abs(av) + 1) / abs(av) + 2) * (1 / 3)
+            hue = 0.5 + hueChange
+            sat = 1
+        else:
+            hue = startHue
+
+        if abs(av) < 1:
+            sat = abs(av)**(1 / 2)
+        else:
+            sat = 1
+    else:
+        hue = 0
+        sat = 0
+        val = 0.5
+    return hue, sat, val
+
+
 class Neuron():
-    """The representation of the nodes. Not to be used on own"""
+    """The representation of the nodes. Not to be used on own.
+
+    There is one of these for every node of every agent so they have no
+    __dict__. Subclasses must also define __slots__. The settings, inputs
+    and dependantOn are shared with the BrainTemplate."""
+
+    __slots__ = ("brain", "inputs", "slot", "bpyNode", "settings",
+                 "dependantOn")
+
+    # If more than one input has the same key, core keeps the first value
+    # rather than the last (see cm_batchBrain.BatchImpulse.merge)
+    keepsFirstKey = False
+    # core reads the channels so they must be set to this agent first
+    # (see cm_batchBrain.BatchPlan)
+    usesChannels = False
+    # core changes the tags or outputs of the brain or prints, so it has to
+    # be evaluated even when its output isn't used (see
+    # Brain.findLockedOutputs)
+    hasSideEffects = False
 
     def __init__(self, brain, bpyNode):
         self.brain = brain  # type: Brain
-        self.neurons = self.brain.neurons  # type: List[Neuron]
         self.inputs = []  # type: List[str] - strings are names of neurons
-        self.result = None  # type: None | ImpulseContainer - Cache for current
-        self.resultLog = [(0, 0, 0), (0, 0, 0)]  # type: List[(int, int, int)]
-        self.fillOutput = BoolProperty(default=True)
+        self.slot = None  # type: int - index in Brain.results
         self.bpyNode = bpyNode  # type: cm_bpyNodes.LogicNode
         self.settings = {}  # type: Dict[str, bpy.props.*]
         self.dependantOn = []  # type: List[str] - strings are names of neurons
 
-    def evaluate(self):
-        """Called by any neurons that take this neuron as an input"""
-        preferences = bpy.context.user_preferences.addons[__package__].preferences
-        if preferences.show_debug_options:
-            t = time.time()
-        if self.result:
-            # Return a cached version of the answer if possible
-            return self.result
-        noDeps = len(self.dependantOn) == 0
-        dep = False
-        for x in self.dependantOn:
-            if self.neurons[x].isCurrent:
-                dep = True
-                break
-        # Only output something if the node isn't dependant on a state
-        #  or if one of it's dependancies is the current state
-        if preferences.show_debug_options and preferences.show_debug_timings:
-            cm_timings.neuron["deps"] += time.time() - t
-
-        if noDeps or dep:
-            inps = []
-            for i in self.inputs:
-                got = self.neurons[i].evaluate()
-                """For each of the inputs the result is collected. If the
-                input in not a dictionary then it is made into one"""
-                if got is not None:
-                    inps.append(got)
-            if preferences.show_debug_options and preferences.show_debug_timings:
-                coreT = time.time()
-            output = self.core(inps, self.settings)
-            if preferences.show_debug_options and preferences.show_debug_timings:
-                cm_timings.coreTimes[self.__class__.__name__] += time.time() - \
-                    coreT
-                cm_timings.coreNumber[self.__class__.__name__] += 1
-            if output is None:
-                output = {}
-            elif not (isinstance(output, dict) or output is None):
-                output = {"None": output}
-        else:
-            output = None
-        self.result = output
-
-        if preferences.show_debug_options:
-            t = time.time()
-        # Calculate the colour that would be displayed in the agent is selected
-        total = 0
-        if output:
-            val = 1
-            av = sum(output.values()) / len(output)
-            if av > 0:
-                startHue = 0.333
-            else:
-                startHue = 0.5
-
-            if av > 1:
-                hueChange = -(-(abs(av) + 1) / abs(av) + 2) * (1 / 3)
-                hue = 0.333 + hueChange
-                sat = 1
-            elif av < -1:
-                hueChange = (-(abs(av) + 1) / abs(av) + 2) * (1 / 3)
-                hue = 0.5 + hueChange
-                sat = 1
-            else:
-                hue = startHue
-
-            if abs(av) < 1:
-                sat = abs(av)**(1 / 2)
-            else:
-                sat = 1
-        else:
-            hue = 0
-            sat = 0
-            val = 0.5
-        if preferences.show_debug_options and preferences.show_debug_timings:
-            cm_timings.neuron["sumColour"] += time.time() - t
-        self.resultLog[-1] = (hue, sat, val)
-
-        return output
-
-    def newFrame(self):
-        self.result = None
-        self.resultLog.append((0, 0, 0.5))
-
-    def highLight(self, frame):
-        """Colour the nodes in the interface to reflect the output"""
+    @staticmethod
+    def source(template, const):
+        """Python source that does the same as self.core for the settings of
+        template (a cm_compileBrain.NeuronTemplate) with the branches on the
+        settings resolved. Used by BrainTemplate.function.
+
+        The lines read the inputs from inps and assign the output, which
+        must be a dict, to out. They can also use brain, lvars, math, logger
+        and norm (see normaliseOutput). const(value) gives the source for a
+        value from the settings.
+
+        :returns: The lines or None to call self.core instead
+        :rtype: List[str] | None"""
+        return None
+
+    @staticmethod
+    def invariance(template):
+        """How much the output of self.core can vary for the settings of
+        template if its inputs are the same for every agent.
+
+        :returns: PER_AGENT, PER_FRAME or STATIC"""
+        return PER_AGENT
+
+    @staticmethod
+    def batch(template):
+        """A vectorised form of self.core for the settings of template, used
+        to evaluate the neuron for many agents at once (see cm_batchBrain).
+        Only possible for neurons whose output has an entry for each key of
+        their inputs that depends only on that value.
+
+        :returns: A function from a numpy array of the input values to the
+            output values or None if this neuron can't be vectorised"""
+        return None
+
+    def highLight(self, frame, colour):
+        """Colour the nodes in the interface to reflect the output (see
+        Brain.hightLight)"""
         preferences = bpy.context.user_preferences.addons[__package__].preferences
         if preferences.use_node_color:
-            hue, sat, val = self.resultLog[frame]
+            hue, sat, val = colour
             self.bpyNode.use_custom_color = True
             c = mathutils.Color()
             c.hsv = hue, sat, val
             self.bpyNode.color = c
-            self.bpyNode.keyframe_insert("color")
+            self.bpyNode.keyframe_insert("color", frame=frame)
 
 
 class State:
-    """The basic element of the state machine. Abstract class"""
+    """The basic element of the state machine. Abstract class. Like Neuron
+    subclasses must also define __slots__."""
+
+    __slots__ = ("name", "brain", "neurons", "inputs", "outputs",
+                 "valueInputs", "finalValue", "finalValueCalcd", "settings",
+                 "isCurrent", "length", "cycleState", "currentFrame",
+                 "bpyNode", "slot", "valueInputSlots", "complete")
 
     def __init__(self, brain, bpyNode, name):
         """A lot of the fields are modified by the compileBrain function"""
         self.name = name
         self.brain = brain
         self.neurons = self.brain.neurons
+        self.inputs = []
         self.outputs = []
         self.valueInputs = []  # Left empty by start state
         self.finalValue = 1.0
@@ -159,7 +183,10 @@ class State:
         self.currentFrame = 0
 
         self.bpyNode = bpyNode
-        self.resultLog = {0: (0, 0, 0), 1: (0, 0, 0)}
+        self.slot = None  # type: int - index in Brain.results
+        self.valueInputSlots = []  # type: List[int] - valueInputs as slots
+        # How far through the state the agent was when it was last current
+        self.complete = 0
 
     def query(self):
         """If this state is a valid next move return float > 0"""
@@ -167,11 +194,27 @@ class State:
             self.evaluate()
         return self.finalValue
 
+    def setup(self):
+        """Called once the brain this state is part of has been created"""
+        pass
+
     def moveTo(self):
         """Called when the current state moves to this node"""
         self.currentFrame = 0
         self.isCurrent = True
 
+    def snapshot(self):
+        """The values that change as the simulation runs"""
+        return {"isCurrent": self.isCurrent,
+                "length": self.length,
+                "currentFrame": self.currentFrame}
+
+    def restore(self, data):
+        """Load the values returned by self.snapshot"""
+        self.isCurrent = data["isCurrent"]
+        self.length = data["length"]
+        self.currentFrame = data["currentFrame"]
+
     def evaluate(self):
         """Called while all the neurons are being evaluated"""
         if self.finalValueCalcd:
@@ -180,11 +223,13 @@ class State:
         if len(self.valueInputs) == 0:
             self.finalValue = self.settings["ValueDefault"]
             if self.settings["RandomInput"]:
-                self.finalValue += random.random()
+                self.finalValue += self.brain.rng.random(
+                    self.brain.sim.framelast, self.name)
             return
+        results = self.brain.results
         values = []
-        for inp in self.valueInputs:
-            values.append(self.neurons[inp].evaluate())
+        for slot in self.valueInputSlots:
+            values.append(results[slot])
 
         total = 0
         num = 0
@@ -209,7 +254,8 @@ class State:
             result = min(vals)
         self.finalValue = result
         if self.settings["RandomInput"]:
-            self.finalValue += random.random()
+            self.finalValue += self.brain.rng.random(
+                self.brain.sim.framelast, self.name)
 
     def evaluateState(self):
         """Return the state to move to (allowed to return itself)
@@ -225,8 +271,7 @@ class State:
         else:
             complete = self.currentFrame / self.length
             complete = 0.5 + complete / 2
-        sceneFrame = bpy.context.scene.frame_current
-        self.resultLog[sceneFrame] = ((0.15, 0.4, complete))
+        self.complete = complete
 
         if self.currentFrame < self.length - 1:
             return False, self.name
@@ -257,25 +302,26 @@ class State:
     def newFrame(self):
         self.finalValueCalcd = False
 
-    def highLight(self, frame):
+    def highLight(self, frame, colour):
         preferences = bpy.context.user_preferences.addons[__package__].preferences
         if preferences.use_node_color:
-            if frame in self.resultLog:
-                hue, sat, val = self.resultLog[frame]
-            else:
-                hue = 0.0
-                sat = 0.0
-                val = 1.0
+            hue, sat, val = colour
             self.bpyNode.use_custom_color = True
             c = mathutils.Color()
             c.hsv = hue, sat, val
             self.bpyNode.color = c
-            self.bpyNode.keyframe_insert("color")
+            self.bpyNode.keyframe_insert("color", frame=frame)
 
 
 class Brain():
     """An executable brain object. One created per agent"""
 
+    __slots__ = ("userid", "sim", "lvars", "outvars", "tags",
+                 "isActiveSelection", "freeze", "rng", "currentState",
+                 "startState", "template", "outputs", "neurons", "slots",
+                 "results", "states", "lockedOutputs", "recording",
+                 "history")
+
     def __init__(self, sim, userid, freezeAnimation):
         self.userid = userid
         self.sim = sim
@@ -283,35 +329,142 @@ class Brain():
         self.outvars = {}
         self.tags = {}
         self.isActiveSelection = False
+        # True if this frame is being added to self.history
+        self.recording = False
+        # The last few frames evaluated while the agent was selected
+        self.history = None  # type: deque[(int, tuple, tuple, str, float)]
         self.freeze = freezeAnimation
+        self.rng = RandomStream(userid)
 
         self.currentState = None
         self.startState = None
 
         # set in compileBrian
+        self.template = None  # type: cm_compileBrain.BrainTemplate
         self.outputs = []
         self.neurons = {}
-        self.states = []
+        self.slots = []  # type: List[Neuron | State] - neurons by slot
+        self.results = []  # type: List[dict | None] - results by slot
+        self.states = []  # type: List[State]
+        # {state name: [neuron name]} - see self.findLockedOutputs
+        self.lockedOutputs = {}
 
     def setStartState(self, stateNode):
         """Used by compileBrian"""
         self.currentState = stateNode
         self.startState = stateNode
 
+    def findLockedOutputs(self):
+        """Called by compileBrain once all the neurons have been added.
+
+        While the current state can't be interrupted and isn't at its end it
+        doesn't query any other states (see State.evaluateState) so the
+        values of the states don't need calculating. For each state that has
+        no interrupt states leaving it store the logic outputs that still
+        need evaluating, leaving out the ones that are dependant on other
+        states. The neurons with side effects that feed the values of the
+        states are kept as well, as they would have been evaluated along
+        with the value of the state."""
+        self.lockedOutputs = {}
+        for name, neuron in self.neurons.items():
+            if not isinstance(neuron, State):
+                continue
+            interruptible = False
+            for out in neuron.outputs:
+                if getattr(self.neurons[out], "interuptState", False):
+                    interruptible = True
+                    break
+            if interruptible:
+                continue
+
+            def allowed(n):
+                deps = self.neurons[n].dependantOn
+                return len(deps) == 0 or name in deps
+
+            locked = []
+            for out in self.outputs:
+                outNeuron = self.neurons[out]
+                if not isinstance(outNeuron, State):
+                    if allowed(out):
+                        locked.append(out)
+                    continue
+                # Neurons that are dependant on another state output None
+                # without evaluating their inputs so aren't followed
+                visited = set()
+                stack = list(reversed(outNeuron.valueInputs))
+                while stack:
+                    n = stack.pop()
+                    if n in visited or not allowed(n):
+                        continue
+                    visited.add(n)
+                    if self.neurons[n].hasSideEffects and n not in locked:
+                        locked.append(n)
+                    stack += reversed(self.neurons[n].inputs)
+            self.lockedOutputs[name] = locked
+
     def reset(self):
         self.outvars = {"rx": 0, "ry": 0, "rz": 0,
                         "px": 0, "py": 0, "pz": 0, "sk": {}}
-        self.tags = self.sim.agents[self.userid].access["tags"]
+        # Copied so that other agents read the tags from the last frame no
+        # matter which order the agents are evaluated in
+        self.tags = dict(self.sim.agents[self.userid].access["tags"])
 
-    def execute(self):
-        """Called for each time the agents needs to evaluate"""
-        preferences = bpy.context.user_preferences.addons[__package__].preferences
+    def prepare(self):
+        """Start evaluating a new frame. Doesn't set the channels to this
+        agent.
 
-        actv = bpy.context.active_object
+        :returns: The (gate, locked) arguments of BrainTemplate.plan for the
+            neurons that need evaluating on this frame"""
+        actv = getattr(bpy.context, "active_object", None)
         self.isActiveSelection = actv is not None and actv.name == self.userid
+        self.recording = self.isActiveSelection or \
+            self.userid in self.sim.debugAgents
         self.reset()
-        randstate = hash(self.userid) + self.sim.framelast
-        random.seed(randstate)
+
+        for state in self.states:
+            state.newFrame()
+
+        current = self.currentState
+        gate = None
+        if current and self.neurons[current].isCurrent:
+            gate = current
+        locked = None
+        if self.canCoast() and current in self.lockedOutputs:
+            locked = current
+        return gate, locked
+
+    def transition(self):
+        """Move to the next state once the neurons have been evaluated
+
+        :returns: The state that was current while they were evaluated"""
+        current = self.currentState
+        if self.currentState:
+            new, nextState = self.neurons[self.currentState].evaluateState()
+            self.neurons[self.currentState].isCurrent = False
+            if nextState is None:
+                nextState = self.startState
+            self.currentState = nextState
+            self.neurons[self.currentState].isCurrent = True
+            if new:
+                self.neurons[nextState].moveTo()
+        return current
+
+    def record(self, gate, locked, state):
+        """Add the outputs of the neurons on this frame to self.history so
+        that the nodes can be coloured by them later (see self.hightLight)
+
+        :param state: The state returned by self.transition"""
+        if self.history is None:
+            preferences = bpy.context.user_preferences.addons[__package__].preferences
+            self.history = deque(maxlen=preferences.node_color_history)
+        complete = None if state is None else self.neurons[state].complete
+        self.history.append((self.sim.framelast,
+                             self.template.plan(gate, locked),
+                             tuple(self.results), state, complete))
+
+    def execute(self):
+        """Called for each time the agents needs to evaluate"""
+        preferences = bpy.context.user_preferences.addons[__package__].preferences
 
         if preferences.show_debug_options:
             t = time.time()
@@ -323,34 +476,113 @@ class Brain():
             cm_timings.brain["setUser"] += time.time() - t
             t = time.time()
 
-        for neur in self.neurons.values():
-            neur.newFrame()
+        gate, locked = self.prepare()
 
         if preferences.show_debug_options and preferences.show_debug_timings:
             cm_timings.brain["newFrame"] += time.time() - t
             t = time.time()
 
-        for out in self.outputs:
-            self.neurons[out].evaluate()
+        if preferences.show_debug_options and preferences.show_debug_timings:
+            # The generated functions can't time the individual neurons
+            self.run(self.template.plan(gate, locked), True)
+        else:
+            run = self.template.function(gate, locked)
+            run(self, self.results, self.slots, self.sim.framelast)
 
         if preferences.show_debug_options and preferences.show_debug_timings:
             cm_timings.brain["evaluate"] += time.time() - t
             t = time.time()
 
-        if self.currentState:
-            new, nextState = self.neurons[self.currentState].evaluateState()
-            self.neurons[self.currentState].isCurrent = False
-            if nextState is None:
-                nextState = self.startState
-            self.currentState = nextState
-            self.neurons[self.currentState].isCurrent = True
-            if new:
-                self.neurons[nextState].moveTo()
+        state = self.transition()
+        if self.recording:
+            self.record(gate, locked, state)
 
         if preferences.show_debug_options and preferences.show_debug_timings:
             cm_timings.brain["evalState"] += time.time() - t
 
+    def run(self, plan, timings=False):
+        """Evaluate the neurons in the order given by the plan. Each logic
+        neuron is given the results of its inputs that aren't None.
+        BrainTemplate.function generates the same thing as Python source."""
+        results = self.results
+        slots = self.slots
+        for slot, kind, inputSlots in plan:
+            if kind == LOGIC:
+                neuron = slots[slot]
+                inps = []
+                for i in inputSlots:
+                    got = results[i]
+                    if got is not None:
+                        inps.append(got)
+                if timings:
+                    coreT = time.time()
+                output = neuron.core(inps, neuron.settings)
+                if timings:
+                    name = neuron.__class__.__name__
+                    cm_timings.coreTimes[name] += time.time() - coreT
+                    cm_timings.coreNumber[name] += 1
+                results[slot] = normaliseOutput(output)
+            elif kind == STATE:
+                slots[slot].evaluate()
+            elif kind == SHARED:
+                results[slot] = self.template.shared[slot]
+            else:
+                results[slot] = None
+
+    def canCoast(self):
+        """True if the current state won't look for a state to move to on
+        the next frame unless it is interrupted"""
+        if not self.currentState:
+            return False
+        state = self.neurons[self.currentState]
+        return state.currentFrame + 2 < state.length
+
+    def isInterruptible(self):
+        """True if the current state has any interrupt states to move to"""
+        return self.currentState not in self.lockedOutputs
+
+    def coast(self):
+        """Advance the current state by a frame without evaluating any of the
+        neurons. Used in place of self.execute when the level of detail
+        scheduler skips this agent. If the state has reached its end the
+        agent stays in it until it is next evaluated."""
+        if self.currentState:
+            self.neurons[self.currentState].currentFrame += 1
+
+    def snapshot(self):
+        """The position in the state machine (see Simulation.saveSnapshot)"""
+        return {"currentState": self.currentState,
+                "states": {name: n.snapshot() for name, n in self.neurons.items()
+                           if isinstance(n, State)}}
+
+    def restore(self, data):
+        """Load the values returned by self.snapshot"""
+        self.currentState = data["currentState"]
+        for name, stateData in data["states"].items():
+            if name in self.neurons:
+                self.neurons[name].restore(stateData)
+
     def hightLight(self, frame):
-        """This will be called for the agent that is the active selection"""
-        for n in self.neurons.values():
-            n.highLight(frame)
+        """This will be called for the agent that is the active selection.
+        The colours are worked out from self.history so are only shown for
+        frames that were recorded. The other nodes are shown grey."""
+        entry = None
+        if self.history is not None:
+            for item in self.history:
+                if item[0] == frame:
+                    entry = item
+        shown = {}
+        state = None
+        if entry is not None:
+            frame, plan, results, state, complete = entry
+            for slot, kind, inputSlots in plan:
+                if kind == LOGIC or kind == SHARED:
+                    shown[slot] = resultColour(results[slot])
+        for slot, item in enumerate(self.slots):
+            if isinstance(item, State):
+                if item.name == state:
+                    item.highLight(frame, (0.15, 0.4, complete))
+                else:
+                    item.highLight(frame, (0.0, 0.0, 1.0))
+            else:
+                item.highLight(frame, shown.get(slot, (0, 0, 0.5)))
@@ -19,7 +19,6 @@
 
 import math
 
-import bpy
 import mathutils
 
 from .cm_masterChannels import MasterChannel as Mc
@@ -35,10 +34,11 @@ class AgentInfo(Mc):
     def getTag(self, inputs, tag):
         """For each agent in the input look up their tag"""
         result = {}
+        names = self.sim.state.names
         for into in inputs:
             for i in into:
-                if i in self.sim.agents:
-                    agentTags = self.sim.agents[i].access["tags"]
+                if isinstance(i, int):
+                    agentTags = self.sim.agents[names[i]].access["tags"]
                     if tag in agentTags:
                         result[i] = agentTags[tag]
         return result
@@ -48,27 +48,15 @@ class AgentInfo(Mc):
         """For each agent in the input look up the relative heading about the
         z axis"""
         result = {}
-        ag = bpy.context.scene.objects[self.userid]
+        location = self.sim.geometry.location(self.userid)
+        state = self.sim.state
+        rotation = state.localMatrix(self.sim.agents[self.userid].index)
         for into in inputs:
             for i in into:
-                emitterAgent = self.sim.agents[i]
-                # eVel = emitterAgent.globalVelocity
+                emitHead = Vector(state.forward[i])
 
-                z = mathutils.Matrix.Rotation(-emitterAgent.arz, 4, 'Z')
-                y = mathutils.Matrix.Rotation(-emitterAgent.ary, 4, 'Y')
-                x = mathutils.Matrix.Rotation(-emitterAgent.arx, 4, 'X')
-
-                rotation = x * y * z
-                emitHead = Vector((0, 1, 0)) * rotation
-
-                target = emitHead - ag.location
-
-                z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-                rotation = x * y * z
-                relative = target * rotation
+                target = emitHead - location
+                relative = rotation * target
 
                 changez = math.atan2(relative[0], relative[1]) / math.pi
                 changex = math.atan2(relative[2], relative[1]) / math.pi
@@ -81,27 +69,15 @@ class AgentInfo(Mc):
         """For each agent in the input look up the relative heading about the
         x axis"""
         result = {}
-        ag = bpy.context.scene.objects[self.userid]
+        location = self.sim.geometry.location(self.userid)
+        state = self.sim.state
+        rotation = state.localMatrix(self.sim.agents[self.userid].index)
         for into in inputs:
             for i in into:
-                emitterAgent = self.sim.agents[i]
-                # eVel = emitterAgent.globalVelocity
-
-                z = mathutils.Matrix.Rotation(-emitterAgent.arz, 4, 'Z')
-                y = mathutils.Matrix.Rotation(-emitterAgent.ary, 4, 'Y')
-                x = mathutils.Matrix.Rotation(-emitterAgent.arx, 4, 'X')
-
-                rotation = x * y * z
-                emitHead = Vector((0, 1, 0)) * rotation
-
-                target = emitHead - ag.location
-
-                z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
+                emitHead = Vector(state.forward[i])
 
-                rotation = x * y * z
-                relative = target * rotation
+                target = emitHead - location
+                relative = rotation * target
 
                 changez = math.atan2(relative[0], relative[1]) / math.pi
                 changex = math.atan2(relative[2], relative[1]) / math.pi
@@ -19,8 +19,6 @@
 
 import math
 
-import bpy
-import mathutils
 from mathutils import Vector
 
 from .cm_masterChannels import MasterChannel as Mc
@@ -56,34 +54,31 @@ class Flock(Mc):
         sepVec = Vector([0, 0, 0])
         if len(localArea) == 0:
             return sepVec
-        agents = self.sim.agents
+        position = self.sim.state.position
+        row = self.sim.agents[self.userid].index
         for neighbour in localArea:
-            sepVec.x += agents[self.userid].apx - agents[neighbour].apx
-            sepVec.y += agents[self.userid].apy - agents[neighbour].apy
-            sepVec.z += agents[self.userid].apz - agents[neighbour].apz
+            sepVec.x += position[row, 0] - position[neighbour, 0]
+            sepVec.y += position[row, 1] - position[neighbour, 1]
+            sepVec.z += position[row, 2] - position[neighbour, 2]
 
-        z = mathutils.Matrix.Rotation(agents[self.userid].arz, 4, 'Z')
-        y = mathutils.Matrix.Rotation(agents[self.userid].ary, 4, 'Y')
-        x = mathutils.Matrix.Rotation(agents[self.userid].arx, 4, 'X')
-
-        rotation = x * y * z
-        relative = sepVec * rotation
-        return relative
+        rotation = self.sim.state.localMatrix(row)
+        return rotation * sepVec
 
     def calcAlign(self, localArea):
         alnVec = Vector([0, 0, 0])
         if len(localArea) == 0:
             return alnVec
-        agents = self.sim.agents
+        rotation = self.sim.state.rotation
+        row = self.sim.agents[self.userid].index
         for neighbour in localArea:
-            alnVec.x += agents[neighbour].arx
-            alnVec.y += agents[neighbour].ary
-            alnVec.z += agents[neighbour].arz
+            alnVec.x += rotation[neighbour, 0]
+            alnVec.y += rotation[neighbour, 1]
+            alnVec.z += rotation[neighbour, 2]
         alnVec /= len(localArea)
 
-        alnVec.x -= agents[self.userid].arx
-        alnVec.y -= agents[self.userid].ary
-        alnVec.z -= agents[self.userid].arz
+        alnVec.x -= rotation[row, 0]
+        alnVec.y -= rotation[row, 1]
+        alnVec.z -= rotation[row, 2]
 
         alnVec.x %= 2 * math.pi
         alnVec.y %= 2 * math.pi
@@ -107,23 +102,19 @@ class Flock(Mc):
         cohVec = Vector([0, 0, 0])
         if len(localArea) == 0:
             return cohVec
-        agents = self.sim.agents
+        position = self.sim.state.position
+        row = self.sim.agents[self.userid].index
         for neighbour in localArea:
-            cohVec.x += agents[neighbour].apx
-            cohVec.y += agents[neighbour].apy
-            cohVec.z += agents[neighbour].apz
+            cohVec.x += position[neighbour, 0]
+            cohVec.y += position[neighbour, 1]
+            cohVec.z += position[neighbour, 2]
         cohVec /= len(localArea)
-        cohVec.x -= agents[self.userid].apx
-        cohVec.y -= agents[self.userid].apy
-        cohVec.z -= agents[self.userid].apz
-
-        z = mathutils.Matrix.Rotation(agents[self.userid].arz, 4, 'Z')
-        y = mathutils.Matrix.Rotation(agents[self.userid].ary, 4, 'Y')
-        x = mathutils.Matrix.Rotation(agents[self.userid].arx, 4, 'X')
+        cohVec.x -= position[row, 0]
+        cohVec.y -= position[row, 1]
+        cohVec.z -= position[row, 2]
 
-        rotation = x * y * z
-        relative = cohVec * rotation
-        return relative
+        rotation = self.sim.state.localMatrix(row)
+        return rotation * cohVec
 
     @timeChannel()
     def separateTx(self, inputs):
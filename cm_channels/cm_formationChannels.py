@@ -57,6 +57,16 @@ class Formation(Mc):
                 self.formations[formID] = ch
             self.formations[formID].register(agent.id, val)
 
+    def snapshot(self):
+        """The priorities of each formation (see Simulation.saveSnapshot)"""
+        return {formID: ch.snapshot() for formID, ch in self.formations.items()}
+
+    def restore(self, data):
+        """Load the values returned by self.snapshot"""
+        for formID, chData in data.items():
+            if formID in bpy.data.groups:
+                self.retrieve(formID).restore(chData)
+
     def retrieve(self, formID):
         """Dynamic properties"""
         if formID not in self.formations:
@@ -105,17 +115,42 @@ class Channel:
         self.priority = new
         self.inpBuffer = []
 
+        self.updateTargets()
+
+    def updateTargets(self):
+        """Get the positions of the vertices of the target objects"""
         self.targets = []
         for ob in self.targetObjects:
             wrld = ob.matrix_world
             self.targets += [wrld * v.co for v in ob.data.vertices]
 
+    def snapshot(self):
+        """The values that are carried between frames"""
+        lastCalcd = None
+        if self.lastCalcd:
+            agents, targets, calcd = self.lastCalcd
+            lastCalcd = (agents, targets,
+                         {k: tuple(v) for k, v in calcd.items()})
+        return {"priority": self.priority,
+                "inpBuffer": self.inpBuffer,
+                "lastCalcd": lastCalcd}
+
+    def restore(self, data):
+        """Load the values returned by self.snapshot"""
+        self.priority = data["priority"]
+        self.inpBuffer = data["inpBuffer"]
+        self.lastCalcd = None
+        if data["lastCalcd"]:
+            agents, targets, calcd = data["lastCalcd"]
+            self.lastCalcd = (agents, targets,
+                              {k: mathutils.Vector(v) for k, v in calcd.items()})
+        self.updateTargets()
+
     def calculate(self):
         """Collect data and use clusterMatch to work out pairings"""
-        objs = bpy.data.objects
+        geometry = self.sim.geometry
 
-        def agAccess(x): return (objs[x].location.x, objs[x].location.y,
-                                 objs[x].location.z)
+        def agAccess(x): return tuple(geometry.location(x))
 
         def tgAccess(x): return (x.x, x.y, x.z)
         setOfTargets = set([tgAccess(x) for x in self.targets])
@@ -161,11 +196,9 @@ class Channel:
         :type fixedPoint: int
         :param fixedPoint: overrides the cluster matching behaviour so that an
                             agent can always target the same point"""
-        objs = bpy.data.objects
-
         if fixedPoint < len(self.targets):
             to = self.targets[fixedPoint]
-            loc = objs[self.userid].location
+            loc = self.sim.geometry.location(self.userid)
             return math.sqrt((loc[0] - to[0])**2 + (loc[1] - to[1])**2 + (loc[2] - to[2])**2)
         else:
             return None
@@ -174,11 +207,10 @@ class Channel:
     @timeChannel("Formation")
     def dist(self):
         """Distance from this agent to the position in formation"""
-        objs = bpy.data.objects
         to = self.checkCalcd()
 
         if to:
-            loc = objs[self.userid].location
+            loc = self.sim.geometry.location(self.userid)
             return math.sqrt((loc[0] - to[0])**2 + (loc[1] - to[1])**2 + (loc[2] - to[2])**2)
         else:
             return None
@@ -189,21 +221,14 @@ class Channel:
         :type fixedPoint: int
         :param fixedPoint: overrides the cluster matching behaviour so that an
                             agent can always target the same point"""
-        objs = bpy.data.objects
-
         if fixedPoint < len(self.targets):
             to = self.targets[fixedPoint]
 
-            ag = objs[self.userid]
-
-            target = to - ag.location
+            target = to - self.sim.geometry.location(self.userid)
 
-            z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-            y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-            x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-            rotation = x * y * z
-            relative = target * rotation
+            rotation = self.sim.state.localMatrix(
+                self.sim.agents[self.userid].index)
+            relative = rotation * target
 
             return math.atan2(relative[0], relative[1]) / math.pi
 
@@ -211,20 +236,14 @@ class Channel:
     @timeChannel("Formation")
     def rz(self):
         """Horizontal rotation to be pointing at position in formation"""
-        objs = bpy.data.objects
         to = self.checkCalcd()
 
         if to:
-            ag = objs[self.userid]
-
-            target = to - ag.location
+            target = to - self.sim.geometry.location(self.userid)
 
-            z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-            y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-            x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-            rotation = x * y * z
-            relative = target * rotation
+            rotation = self.sim.state.localMatrix(
+                self.sim.agents[self.userid].index)
+            relative = rotation * target
 
             return math.atan2(relative[0], relative[1]) / math.pi
         else:
@@ -236,21 +255,14 @@ class Channel:
         :type fixedPoint: int
         :param fixedPoint: overrides the cluster matching behaviour so that an
                             agent can always target the same point"""
-        objs = bpy.data.objects
-
         if fixedPoint < len(self.targets):
             to = self.targets[fixedPoint]
 
-            ag = objs[self.userid]
+            target = to - self.sim.geometry.location(self.userid)
 
-            target = to - ag.location
-
-            z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-            y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-            x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-            rotation = x * y * z
-            relative = target * rotation
+            rotation = self.sim.state.localMatrix(
+                self.sim.agents[self.userid].index)
+            relative = rotation * target
 
             return math.atan2(relative[2], relative[1]) / math.pi
 
@@ -258,20 +270,14 @@ class Channel:
     @timeChannel("Formation")
     def rx(self):
         """Vertical rotation to be pointing at position in formation"""
-        objs = bpy.data.objects
         to = self.checkCalcd()
 
         if to:
-            ag = objs[self.userid]
-
-            target = to - ag.location
-
-            z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-            y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-            x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
+            target = to - self.sim.geometry.location(self.userid)
 
-            rotation = x * y * z
-            relative = target * rotation
+            rotation = self.sim.state.localMatrix(
+                self.sim.agents[self.userid].index)
+            relative = rotation * target
 
             return math.atan2(relative[2], relative[1]) / math.pi
         else:
@@ -79,13 +79,13 @@ class Channel:
     def calcground(self):
         """Called the first time each agent uses the Ground channel"""
         results = []
-        s = bpy.context.scene.objects[self.userid]
+        location = self.Ground.sim.geometry.location(self.userid)
         for gnd in self.groupObjects:
             if gnd.name not in self.groundTrees:
                 sce = bpy.context.scene
                 self.groundTrees[gnd.name] = BVHTree.FromObject(gnd, sce)
             inverseTransform = gnd.matrix_world.inverted()
-            point = (inverseTransform * s.location.to_4d()).to_3d()
+            point = (inverseTransform * location.to_4d()).to_3d()
             direc = Vector((0, 0, 1))
             direc.rotate(inverseTransform.to_euler())
             calcd = self.groundTrees[gnd.name].ray_cast(point,
@@ -94,7 +94,7 @@ class Channel:
                 loc, norm, ind, dist = calcd
                 loc = gnd.matrix_world * loc
                 norm = gnd.matrix_world * norm
-                dist = (s.location - loc).length
+                dist = (location - loc).length
                 results.append((loc, norm, ind, dist))
             calcd = self.groundTrees[gnd.name].ray_cast(
                 point, tuple(x for x in direc))
@@ -102,7 +102,7 @@ class Channel:
                 loc, norm, ind, dist = calcd
                 loc = gnd.matrix_world * loc
                 norm = gnd.matrix_world * norm
-                dist = (s.location - loc).length
+                dist = (location - loc).length
                 results.append((loc, norm, ind, -dist))
 
         if len(results) > 0:
@@ -122,7 +122,7 @@ class Channel:
         return self.store["distance"]
 
     def calcAhead(self, offset):
-        s = bpy.context.scene.objects[self.userid]
+        matrixWorld = self.Ground.sim.geometry.matrixWorld(self.userid)
         result = None
         best = None
         for gnd in self.groupObjects:
@@ -130,7 +130,7 @@ class Channel:
                 sce = bpy.context.scene
                 self.groundTrees[gnd.name] = BVHTree.FromObject(gnd, sce)
             offsetVec = Vector((offset[0], offset[1], offset[2]))
-            lookAheadPoint = s.matrix_world * offsetVec
+            lookAheadPoint = matrixWorld * offsetVec
             r = self.groundTrees[gnd.name].find_nearest(lookAheadPoint)
             if result is None or r[3] < best:
                 result = r[0]
@@ -138,10 +138,10 @@ class Channel:
                 # TODO calc distance from look ahead point to nearest point?
 
         if result is None:
-            self.aheadStore[multiply] = {"rz": None,
-                                         "rx": None}
+            self.aheadStore[offset] = {"rz": None,
+                                       "rx": None}
             return
-        relative = s.matrix_world.inverted() * result
+        relative = matrixWorld.inverted() * result
         changez = math.atan2(relative[0], relative[1]) / math.pi
         changex = math.atan2(relative[2], relative[1]) / math.pi
         offsetRz = math.atan2(offset[0], offset[1]) / math.pi
@@ -17,13 +17,13 @@
 # along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
 # ##### END GPL LICENSE BLOCK #####
 
-import random
 import math
 
 import bpy
 
 from .cm_masterChannels import MasterChannel as Mc
 from .cm_masterChannels import timeChannel
+from ..cm_random import CONSTANT
 
 
 class Noise(Mc):
@@ -33,27 +33,24 @@ class Noise(Mc):
         Mc.__init__(self, sim)
 
     @timeChannel("Noise")
-    def random(self):
-        """Returns a random number in range 0-1"""
-        return random.random()
+    def random(self, key=0):
+        """Returns a random number in range 0-1. Different nodes of the
+        same agent should use different keys"""
+        rng = self.sim.agents[self.userid].brain.rng
+        return rng.random(self.sim.framelast, key)
 
     @timeChannel("Noise")
-    def agentRandom(self, offset=0):
+    def agentRandom(self, key=0):
         """Return a random number that is consistent between frames but can
-        be offset by an integer"""
-        state = random.getstate()
-        random.seed(hash(self.userid) - 1 + offset)
-        # -1 so that this number is different to the first random number
-        # generated on frame 0 (if used) of the simulation
-        result = random.random()
-        random.setstate(state)
-        return result
+        be varied by the key"""
+        rng = self.sim.agents[self.userid].brain.rng
+        return rng.random(CONSTANT, key)
 
     @timeChannel("Noise")
     def wave(self, offset, wavelength):
         """Returns a sine wave based on the current frame
         https://www.desmos.com/calculator/gwpmwylgg0"""
         scene = bpy.context.scene
-        t = scene.frame_current - scene.cm_sim_start_frame
+        t = self.sim.framelast - scene.cm_sim_start_frame
         x = (t + offset * wavelength)
         return math.sin((2 * math.pi * x) / wavelength)
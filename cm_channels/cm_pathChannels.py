@@ -46,16 +46,16 @@ class Path(Mc):
 
         self.pathObjectCache = {}
         self.resultsCache = {}
-        self.laneCache = {}  # {pathName: {vertexID: [(objectID, pathPos)]}}
+        # {pathObject: {agent row: (edgeIndex, pathPos)}} shared by all agents
+        self.projectionCache = {}
 
     def newframe(self):
         self.pathObjectCache = {}
-        self.laneCache = {}
+        self.projectionCache = {}
 
     def setuser(self, userid):
         Mc.setuser(self, userid)
         self.resultsCache = {}
-        self.laneCache = {}
 
     def calcPathData(self, pathObject, revDirec):
         if pathObject in self.pathObjectCache:
@@ -314,8 +314,6 @@ class Path(Mc):
         return globalPos, pointTowards, nextIndex
 
     def calcRelativeTarget(self, pathEntry, lookahead):
-        context = bpy.context
-
         pathObject = pathEntry.objectName
         radius = pathEntry.radius
         laneSep = pathEntry.laneSeparation
@@ -325,21 +323,20 @@ class Path(Mc):
         kd, bm, pathMatrixInverse, rotation = self.calcPathData(pathObject,
                                                                 revDirec)
 
-        vel = self.sim.agents[self.userid].globalVelocity * lookahead
+        agent = self.sim.agents[self.userid]
+        vel = agent.globalVelocity * lookahead
         if vel.x == 0 and vel.y == 0 and vel.z == 0:
-            vel = Vector((0, lookahead, 0))
-            vel.rotate(bpy.context.scene.objects[self.userid].rotation_euler)
+            vel = Vector(self.sim.state.forward[agent.index]) * lookahead
         vel = vel * rotation
-        co_find = pathMatrixInverse * \
-            context.scene.objects[self.userid].location
+        geometry = self.sim.geometry
+        co_find = pathMatrixInverse * geometry.location(self.userid)
         co, index, dist = kd.find(co_find)
         offset = self.followPath(bm, co, index, vel, co_find, radius, laneSep,
                                  isDirectional, pathEntry)
 
         offset = offset * pathMatrixInverse
 
-        eul = Euler(
-            [-x for x in context.scene.objects[self.userid].rotation_euler], 'ZYX')
+        eul = Euler([-x for x in geometry.rotation(self.userid)], 'ZYX')
         offset.rotate(eul)
 
         return offset
@@ -415,8 +412,6 @@ class Path(Mc):
 
     @timeChannel("Path")
     def inlane(self, pathName, length, agents):
-        context = bpy.context
-
         pathEntry = bpy.context.scene.cm_paths.coll.get(pathName)
         pathObject = pathEntry.objectName
         radius = pathEntry.radius
@@ -427,15 +422,24 @@ class Path(Mc):
         kd, bm, pathMatrixInverse, rotation = self.calcPathData(pathObject,
                                                                 revDirec)
 
-        co_find = pathMatrixInverse * \
-            context.scene.objects[self.userid].location
-        myEdgeIndex, myStart = self.startEdgeAndPoint(bm, kd, co_find)
+        projected = self.projectionCache.setdefault(pathObject, {})
+
+        names = self.sim.state.names
+
+        def project(agent):
+            """The edge of the path the agent (a row) is on and where on it"""
+            if agent not in projected:
+                location = self.sim.geometry.location(names[agent])
+                loc = pathMatrixInverse * location
+                projected[agent] = self.startEdgeAndPoint(bm, kd, loc)
+            return projected[agent]
+
+        myEdgeIndex, myStart = project(self.sim.agents[self.userid].index)
 
         edgeAgentCache = {}
 
         for agent in agents:
-            loc = pathMatrixInverse * context.scene.objects[agent].location
-            edgeIndex, start = self.startEdgeAndPoint(bm, kd, loc)
+            edgeIndex, start = project(agent)
             if edgeIndex not in edgeAgentCache:
                 edgeAgentCache[edgeIndex] = []
             edgeAgentCache[edgeIndex].append((agent, start))
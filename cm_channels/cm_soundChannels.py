@@ -18,10 +18,14 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import math
+import unittest
+from types import SimpleNamespace
 
-import bpy
 import mathutils
+import numpy
 
+from ..cm_agentState import AgentState, Geometry, stateProperty
+from ..cm_impulse import Impulse
 from ..libs import ins_octree as ot
 from .cm_masterChannels import MasterChannel as Mc
 from .cm_masterChannels import timeChannel
@@ -83,12 +87,16 @@ class Channel:
         self.predictNext = False
         self.steeringNext = False
 
-        self.kdtree = None
+        self.values = {}  # {emitter id: val}
         self.maxVal = 0
+        self.rows = None  # see self.emitterRows
+        self.emitterArrays = None  # see self.motionArrays
 
     def register(self, objectid, val):
         """Add an object that emits sound"""
         self.emitters.append((objectid, val))
+        self.values[objectid] = val
+        self.maxVal = max(self.maxVal, val)
 
     def newuser(self, userid):
         self.userid = userid
@@ -101,36 +109,29 @@ class Channel:
 
     def calculate(self, minusRadius):
         """Called the first time an agent uses this frequency"""
-        O = bpy.context.scene.objects
+        geometry = self.sim.geometry
+        names = self.sim.state.names
 
-        if self.kdtree is None:
-            self.kdtree = mathutils.kdtree.KDTree(len(self.emitters))
-            for i, item in enumerate(self.emitters):
-                emitterid, val = item
-                self.maxVal = max(self.maxVal, val)
-                self.kdtree.insert(O[emitterid].location, i)
-
-            self.kdtree.balance()
-
-        ag = O[self.userid]
+        location = geometry.location(self.userid)
+        agent = self.sim.agents[self.userid]
 
-        collisions = self.kdtree.find_range(ag.location, self.maxVal)
+        # Only the emitters on this frequency are searched. Each agent
+        # searches when it first listens, so agents that don't listen on a
+        # frame (or aren't evaluated on it) cost nothing.
+        collisions = self.sim.neighbours.radius(("Sound", self.frequency),
+                                                self.emitterRows(), location,
+                                                self.maxVal)
 
-        agent = self.sim.agents[self.userid]
+        rotation = self.sim.state.localMatrix(agent.index)
 
-        for (co, index, dist) in collisions:
-            emitterid, val = self.emitters[index]
-            if emitterid == self.userid:
+        for row, dist in collisions:
+            if row == agent.index:
                 continue
+            emitterid = names[row]
+            val = self.values[emitterid]
             if dist <= val:
-                to = O[emitterid]
-
-                target = to.location - ag.location
-                z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-                rotation = x * y * z
-                relative = target * rotation
+                target = geometry.location(emitterid) - location
+                relative = rotation * target
                 changez = math.atan2(relative[0], relative[1]) / math.pi
                 changex = math.atan2(relative[2], relative[1]) / math.pi
 
@@ -139,17 +140,47 @@ class Channel:
                     dist -= agent.radius
                     if dist < 0:
                         dist = 0
-                self.store[emitterid] = {"rz": changez,
-                                         "rx": changex,
-                                         "distProp": dist / val}
+                self.store[row] = {"rz": changez,
+                                   "rx": changex,
+                                   "distProp": dist / val}
         self.storeCalced = True
 
+    def emitterRows(self):
+        """The rows of the emitters in the same order as self.emitters"""
+        if self.rows is None:
+            self.rows = [self.sim.agents[emitterid].index
+                         for emitterid, val in self.emitters]
+        return self.rows
+
+    def motionArrays(self):
+        """The positions, locations (see Geometry.location), velocities,
+        radii and values of all the emitters as arrays in the same order as
+        self.emitters"""
+        if self.emitterArrays is None:
+            state = self.sim.state
+            rows = self.emitterRows()
+            positions = state.position[rows]
+            locations = positions.copy()
+            for i, (emitterid, val) in enumerate(self.emitters):
+                if self.sim.agents[emitterid].freezeAnimation:
+                    locations[i] = self.sim.geometry.location(emitterid)
+            self.emitterArrays = (positions, locations,
+                                  state.velocity[rows],
+                                  state.radius[rows],
+                                  numpy.array([val for emitterid, val
+                                               in self.emitters]))
+        return self.emitterArrays
+
     def calculatePrediction(self):
         """Called the first time an agent uses this frequency"""
-        O = bpy.context.scene.objects
-        ag = O[self.userid]
         agSim = self.sim.agents[self.userid]
-        for emitterid, val in self.emitters:
+        rotation = self.sim.state.localMatrix(agSim.index)
+        positions, locations, velocities, radii, values = self.motionArrays()
+        candidates = predictionCandidates(self.sim.state.position[agSim.index],
+                                          self.sim.state.velocity[agSim.index],
+                                          positions, velocities, values)
+        for index in candidates.tolist():
+            emitterid, val = self.emitters[index]
             if emitterid != self.userid:
                 toSim = self.sim.agents[emitterid]
 
@@ -184,13 +215,7 @@ class Channel:
                 #  make their closest approach
                 if dist <= val:
                     target = pd2 - pd1
-
-                    z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                    y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                    x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-                    rotation = x * y * z
-                    relative = target * rotation
+                    relative = rotation * target
 
                     changez = math.atan2(relative[0], relative[1]) / math.pi
                     changex = math.atan2(relative[2], relative[1]) / math.pi
@@ -203,36 +228,40 @@ class Channel:
                             c = s / 32
                         cert = (1 - ((-(c**3) / 3 + (c**2) / 2) * 6))**2
                         # https://www.desmos.com/calculator/godi4zejgd
-                    self.storePrediction[emitterid] = {"rz": changez,
-                                                       "rx": changex,
-                                                       "distProp": dist / val,
-                                                       "cert": cert}
+                    self.storePrediction[toSim.index] = {"rz": changez,
+                                                         "rx": changex,
+                                                         "distProp": dist / val,
+                                                         "cert": cert}
                     # (z rot, x rot, dist proportion, time until prediction)
-        self.storePredictionCalced = False
+        self.storePredictionCalced = True
 
     def calculateSteering(self):
         """Called the first time an agent uses this frequency"""
         MAXLOOKAHEAD = 64
-        O = bpy.data.objects
+        geometry = self.sim.geometry
 
-        ag = O[self.userid]
         agSim = self.sim.agents[self.userid]
+        rotation = self.sim.state.localMatrix(agSim.index)
+        px = geometry.location(self.userid)
+
+        positions, locations, velocities, radii, values = self.motionArrays()
+        candidates = steeringCandidates(numpy.array(px),
+                                        self.sim.state.velocity[agSim.index],
+                                        agSim.radius, locations, velocities,
+                                        radii, values)
 
-        for emitterid, val in self.emitters:
+        for index in candidates.tolist():
+            emitterid, val = self.emitters[index]
             if emitterid == self.userid:
                 continue
-            to = O[emitterid]
             toSim = self.sim.agents[emitterid]
 
-            x = ag
             rx = agSim.radius
             vx = mathutils.Vector(agSim.globalVelocity)
-            px = x.location
 
-            y = to
             ry = toSim.radius
             vy = mathutils.Vector(toSim.globalVelocity)
-            py = y.location
+            py = geometry.location(emitterid)
 
             a = (vx - vy).length**2
 
@@ -271,13 +300,7 @@ class Channel:
                     target = y0 - x0 + y1 - x1
                     target.normalize()
                     target *= (rx + ry)
-
-                    z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                    y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                    x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-                    rotation = x * y * z
-                    relative = target * rotation
+                    relative = rotation * target
 
                     changez = relative[0] / (abs(relative[0]) + 1)
                     changex = relative[2] / (abs(relative[2]) + 1)
@@ -301,25 +324,19 @@ class Channel:
                         cert = (1 - ((-(c**3) / 3 + (c**2) / 2) * 6))**2
                         # https://www.desmos.com/calculator/godi4zejgd
 
-                    self.storeSteering[emitterid] = {"rz": changez,
-                                                     "rx": changex,
-                                                     "distProp": 0,
-                                                     "acc": acc,
-                                                     "overlap": overlap,
-                                                     "cert": cert}
+                    self.storeSteering[toSim.index] = {"rz": changez,
+                                                       "rx": changex,
+                                                       "distProp": 0,
+                                                       "acc": acc,
+                                                       "overlap": overlap,
+                                                       "cert": cert}
 
                     # (z rot, x rot, dist proportion, recommended acceleration)
             elif dist < val and tc >= 0:
                 target = yc - xc
                 target.normalize()
                 target *= (rx + ry)
-
-                z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-                rotation = x * y * z
-                relative = target * rotation
+                relative = rotation * target
 
                 changez = relative[0] / (abs(relative[0]) + 1)
                 changex = relative[2] / (abs(relative[2]) + 1)
@@ -339,14 +356,14 @@ class Channel:
                     cert = (1 - ((-(c**3) / 3 + (c**2) / 2) * 6))**2
                     # https://www.desmos.com/calculator/godi4zejgd
 
-                self.storeSteering[emitterid] = {"rz": changez,
-                                                 "rx": changex,
-                                                 "distProp": dstp,
-                                                 "acc": 0,
-                                                 "overlap": 0,
-                                                 "cert": 0}
+                self.storeSteering[toSim.index] = {"rz": changez,
+                                                   "rx": changex,
+                                                   "distProp": dstp,
+                                                   "acc": 0,
+                                                   "overlap": 0,
+                                                   "cert": 0}
                 # (z rot, x rot, dist proportion, recommended acceleration)
-        self.storeSteeringCalced = False
+        self.storeSteeringCalced = True
 
     def calcAndGetItems(self, minusRadius):
         # TODO this gets called for both the sender and the receiver but I
@@ -370,63 +387,313 @@ class Channel:
         return items
 
     @staticmethod
-    def _buildDictFromProperty(dictionary, prop):
-        return {k: v[prop] for k, v in dictionary}
+    def _buildImpulseFromProperty(items, prop):
+        """The value of prop for each emitter keyed by the row of the
+        emitter"""
+        return Impulse([k for k, v in items], [v[prop] for k, v in items])
 
     @timeChannel("Sound")
     def rz(self, minusRadius):
         """Return the horizontal angle of sound emitting agents"""
         items = self.calcAndGetItems(minusRadius)
         if items:
-            return self._buildDictFromProperty(items, "rz")
+            return self._buildImpulseFromProperty(items, "rz")
 
     @timeChannel("Sound")
     def rx(self, minusRadius):
         """Return the vertical angle of sound emitting agents"""
         items = self.calcAndGetItems(minusRadius)
         if items:
-            return self._buildDictFromProperty(items, "rx")
+            return self._buildImpulseFromProperty(items, "rx")
 
     @timeChannel("Sound")
     def dist(self, minusRadius):
         """Return the distance to the sound emitting agents 0-1"""
         items = self.calcAndGetItems(minusRadius)
         if items:
-            return self._buildDictFromProperty(items, "distProp")
+            return self._buildImpulseFromProperty(items, "distProp")
 
     @timeChannel("Sound")
     def close(self, minusRadius):
         """Return how close the sound emitting is 0-1"""
         items = self.calcAndGetItems(minusRadius)
         if items:
-            result = self._buildDictFromProperty(items, "distProp")
-            return {k: 1 - v for k, v in result.items()}
+            result = self._buildImpulseFromProperty(items, "distProp")
+            return Impulse(result.keys(), [1 - v for v in result.values()])
 
     @timeChannel("Sound")
     def db(self, minusRadius):
         """Return the volume (dist^2) of sound emitting agents"""
         items = self.calcAndGetItems(minusRadius)
         if items:
-            tmp = self._buildDictFromProperty(items, "distProp")
-            return {k: (1 - v)**2 for k, v in tmp.items()}
+            tmp = self._buildImpulseFromProperty(items, "distProp")
+            return Impulse(tmp.keys(), [(1 - v)**2 for v in tmp.values()])
 
     @timeChannel("Sound")
     def cert(self, minusRadius):
         """Return the certainty of a prediction 0-1"""
         items = self.calcAndGetItems(minusRadius)
         if items:
-            return self._buildDictFromProperty(items, "cert")
+            return self._buildImpulseFromProperty(items, "cert")
 
     @timeChannel("Sound")
     def acc(self, minusRadius):
         """Return the recommended acceleration to avoid a collision"""
         items = self.calcAndGetItems(minusRadius)
         if items:
-            return self._buildDictFromProperty(items, "acc")
+            return self._buildImpulseFromProperty(items, "acc")
 
     @timeChannel("Sound")
     def over(self, minusRadius):
         """Return the predicted worst case overlap"""
         items = self.calcAndGetItems(minusRadius)
         if items:
-            return self._buildDictFromProperty(items, "overlap")
+            return self._buildImpulseFromProperty(items, "overlap")
+
+
+def predictionCandidates(position, velocity, positions, velocities, values):
+    """The indices of the emitters that Channel.calculatePrediction could
+    find within their value of an agent, in order. Calculating the
+    prediction for only these gives exactly the same result as for all of
+    the emitters.
+
+    calculatePrediction measures the distance between the agent and the
+    emitter once both have moved by their velocities for the same time s.
+    That is never less than the closest the line
+    offset + t * (velocity - emitter velocity) comes to the origin. Pairs
+    with velocities that are (nearly) parallel are always kept, as s is
+    then very sensitive to rounding. mathutils works in single precision
+    so a margin is added to the distance that is allowed.
+
+    This is not a spatial bound. Every emitter on the frequency is still
+    looked at for every listener, so the work is still O(listeners x
+    emitters). It is only a constant-factor speedup: the pass over the
+    pairs runs in numpy instead of creating mathutils.Vectors in Python."""
+    offset = position - positions
+    relative = velocity - velocities
+    relSpeed = (relative ** 2).sum(axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        t = numpy.where(relSpeed > 0,
+                        -(offset * relative).sum(axis=1) / relSpeed, 0)
+        closest = numpy.sqrt(((offset + t[:, None] * relative) ** 2)
+                             .sum(axis=1))
+
+        # s as calculatePrediction works it out, but in double precision
+        a = velocity.dot(velocity)
+        b = velocities.dot(velocity)
+        e = (velocities ** 2).sum(axis=1)
+        d = a * e - b * b
+        c = offset.dot(velocity)
+        f = (offset * velocities).sum(axis=1)
+        stable = d > 1e-4 * a * e
+        s = numpy.where(stable, (b * f - c * e) / d, 0)
+
+    margin = (1e-3 * (1 + values +
+                      numpy.sqrt(position.dot(position)) +
+                      numpy.sqrt((positions ** 2).sum(axis=1))) +
+              1e-2 * numpy.abs(s) * (numpy.sqrt(a) + numpy.sqrt(e)))
+    keep = numpy.logical_or(~stable, closest <= values + margin)
+    # Velocities that are zero or identical as mathutils.Vectors always make
+    # calculatePrediction treat the pair as parallel and skip it
+    single = velocity.astype(numpy.float32)
+    singles = velocities.astype(numpy.float32)
+    if not single.any():
+        keep[:] = False
+    keep &= singles.any(axis=1)
+    keep &= (singles != single).any(axis=1)
+    return numpy.nonzero(keep)[0]
+
+
+def steeringCandidates(location, velocity, radius, locations, velocities,
+                       radii, values):
+    """The indices of the emitters that Channel.calculateSteering could
+    store a result for, in order. Calculating the steering for only these
+    gives exactly the same result as for all of the emitters.
+
+    calculateSteering keeps an emitter if the agents will overlap at some
+    time from now on, or if they get within the value of the emitter (less
+    both radii) at their closest approach and that is in the future. The
+    certainty only uses MAXLOOKAHEAD to fade out collisions that are far
+    in the future and they are still returned, so the motion of the
+    agents can't be cut off at the lookahead. Both cases need the closest
+    point of offset + t * (velocity - emitter velocity) for t >= 0 to be
+    within both radii plus the value. A margin covers the single precision
+    of mathutils.
+
+    The values are rounded to single precision first, like they are when
+    calculateSteering makes them into mathutils.Vectors. The difference
+    between two nearly equal velocities is then the same as it sees, so the
+    time of closest approach is too.
+
+    Like predictionCandidates this is a constant-factor speedup, not a
+    spatial bound. Collisions beyond MAXLOOKAHEAD are still returned, so
+    the search can't stop at a distance, and every emitter is still looked
+    at for every listener."""
+    location, locations, velocity, velocities = (
+        numpy.asarray(a, dtype=numpy.float32).astype(float)
+        for a in (location, locations, velocity, velocities))
+    offset = location - locations
+    relative = velocity - velocities
+    relSpeed = (relative ** 2).sum(axis=1)
+    along = (offset * relative).sum(axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        t = numpy.where(relSpeed > 0, -along / relSpeed, 0)
+    t = numpy.maximum(t, 0)
+    closest = numpy.sqrt(((offset + t[:, None] * relative) ** 2)
+                         .sum(axis=1))
+
+    speed = numpy.sqrt(velocity.dot(velocity))
+    speeds = numpy.sqrt((velocities ** 2).sum(axis=1))
+    reach = radius + radii + numpy.maximum(values, 0)
+    margin = (1e-3 * (1 + reach + numpy.abs(values) +
+                      numpy.sqrt(location.dot(location)) +
+                      numpy.sqrt((locations ** 2).sum(axis=1)) +
+                      2 * t * (speed + speeds)) +
+              1e-2 * numpy.sqrt((offset ** 2).sum(axis=1)))
+    return numpy.nonzero(closest <= reach + margin)[0]
+
+
+class CandidateTestAgent:
+    """The parts of cm_agent.Agent that Channel reads"""
+
+    apx = stateProperty("position", 0)
+    apy = stateProperty("position", 1)
+    apz = stateProperty("position", 2)
+    radius = stateProperty("radius")
+
+    def __init__(self, sim, index):
+        self.sim = sim
+        self.index = index
+        self.freezeAnimation = False
+
+    @property
+    def globalVelocity(self):
+        return mathutils.Vector(self.sim.state.velocity[self.index])
+
+
+class SoundCandidatesTestCase(unittest.TestCase):
+    def channel(self, seed):
+        """A Channel with every agent emitting on it. A third of the agents
+        have velocities that are nearly parallel and a third have
+        velocities that are only different before they are rounded to
+        single precision. These are the two cases the margins and the
+        rounding of the candidate functions are for."""
+        rng = numpy.random.RandomState(seed)
+        state = AgentState()
+        sim = SimpleNamespace(state=state, agents={})
+        sim.geometry = Geometry(sim)
+        base = rng.normal(0, 0.3, 3)
+        for row in range(60):
+            name = "Agent.{:03d}".format(row)
+            size = rng.uniform(0.6, 2)
+            state.add(name, rng.uniform(-20, 20, 3),
+                      (0, 0, rng.uniform(-math.pi, math.pi)), (1, 1, 1),
+                      (size, size, size))
+            if row % 3 == 0:
+                state.velocity[row] = base * (1 + rng.uniform(-1e-7, 1e-7))
+            elif row % 3 == 1:
+                state.velocity[row] = base + rng.normal(0, 1e-9, 3)
+            else:
+                state.velocity[row] = rng.normal(0, 0.3, 3)
+            sim.agents[name] = CandidateTestAgent(sim, row)
+        state.updateTransforms()
+        channel = Channel("Test", sim)
+        for name in sim.agents:
+            channel.register(name, rng.uniform(1, 15))
+        return channel
+
+    def checkCulling(self, candidates, calculate, store):
+        """The results of calculate must be the same when every emitter is
+        looked at as when only the candidates are"""
+        real = globals()[candidates]
+        found = 0
+        for seed in range(5):
+            channel = self.channel(seed)
+            for name in list(channel.sim.agents)[::3]:
+                channel.newuser(name)
+                getattr(channel, calculate)()
+                culled = getattr(channel, store)
+                channel.newuser(name)
+                try:
+                    globals()[candidates] = \
+                        lambda *args: numpy.arange(len(args[-1]))
+                    getattr(channel, calculate)()
+                finally:
+                    globals()[candidates] = real
+                self.assertEqual(culled, getattr(channel, store))
+                found += len(culled)
+        self.assertGreater(found, 0)
+
+    def testPredictionCulling(self):
+        self.checkCulling("predictionCandidates", "calculatePrediction",
+                          "storePrediction")
+
+    def testSteeringCulling(self):
+        self.checkCulling("steeringCandidates", "calculateSteering",
+                          "storeSteering")
+
+    def testPrediction(self):
+        rng = numpy.random.RandomState(2)
+        for trial in range(20):
+            positions = rng.uniform(-50, 50, (100, 3))
+            velocities = rng.normal(0, 0.3, (100, 3))
+            if trial % 2 == 0:
+                # A crowd walking the same way
+                velocities[::2] = (0.1, 0.05, 0)
+            values = rng.uniform(1, 10, 100)
+            for agent in range(0, 100, 10):
+                p1 = mathutils.Vector(positions[agent])
+                d1 = mathutils.Vector(velocities[agent])
+                expected = []
+                for index in range(100):
+                    p2 = mathutils.Vector(positions[index])
+                    d2 = mathutils.Vector(velocities[index])
+                    a = d1.dot(d1)
+                    b = d1.dot(d2)
+                    e = d2.dot(d2)
+                    d = a * e - b * b
+                    if d != 0:
+                        r = p1 - p2
+                        s = (b * d2.dot(r) - d1.dot(r) * e) / d
+                        if ((p1 + s * d1) - (p2 + s * d2)).length <= values[index]:
+                            expected.append(index)
+                candidates = predictionCandidates(positions[agent],
+                                                  velocities[agent],
+                                                  positions, velocities,
+                                                  values)
+                self.assertLessEqual(set(expected), set(candidates.tolist()))
+
+    def testSteering(self):
+        rng = numpy.random.RandomState(3)
+        for trial in range(20):
+            locations = rng.uniform(-50, 50, (100, 3))
+            velocities = rng.normal(0, 0.3, (100, 3))
+            if trial % 2 == 0:
+                velocities[::2] = (0.1, 0.05, 0)
+            radii = rng.uniform(0.3, 1, 100)
+            values = rng.uniform(0.5, 5, 100)
+            for agent in range(0, 100, 10):
+                px = mathutils.Vector(locations[agent])
+                vx = mathutils.Vector(velocities[agent])
+                rx = radii[agent]
+                expected = []
+                for index in range(100):
+                    py = mathutils.Vector(locations[index])
+                    vy = mathutils.Vector(velocities[index])
+                    ry = radii[index]
+                    a = (vx - vy).length**2
+                    b = 2 * (px - py).dot(vx - vy)
+                    c = (px - py).length**2 - (rx + ry)**2
+                    tc = 0 if a == 0 else -b / (2 * a)
+                    dist = ((px + tc * vx) - (py + tc * vy)).length
+                    det = b**2 - 4 * a * c
+                    if det > 0:
+                        if (-b + det**0.5) / (2 * a) >= 0:
+                            expected.append(index)
+                    elif dist - (rx + ry) < values[index] and tc >= 0:
+                        expected.append(index)
+                candidates = steeringCandidates(locations[agent],
+                                                velocities[agent], rx,
+                                                locations, velocities, radii,
+                                                values)
+                self.assertLessEqual(set(expected), set(candidates.tolist()))
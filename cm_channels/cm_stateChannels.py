@@ -19,6 +19,7 @@
 
 import bpy
 
+from ..cm_impulse import scalar
 from .cm_masterChannels import MasterChannel as Mc
 from .cm_masterChannels import timeChannel
 
@@ -32,7 +33,7 @@ class State(Mc):
     @property
     @timeChannel("State")
     def radius(self):
-        return bpy.context.scene.objects[self.userid].dimensions.length / 2
+        return self.sim.geometry.dimensions(self.userid).length / 2
 
     @property
     @timeChannel("State")
@@ -64,5 +65,5 @@ class State(Mc):
         name = self.userid
         if name in self.sim.agents:
             if tag in self.sim.agents[name].access["tags"]:
-                return {"None": self.sim.agents[name].access["tags"][tag]}
+                return scalar(self.sim.agents[name].access["tags"][tag])
         return {}
@@ -22,6 +22,7 @@ import math
 import bpy
 import mathutils
 
+from ..cm_impulse import scalar
 from .cm_masterChannels import MasterChannel as Mc
 from .cm_masterChannels import timeChannel
 
@@ -48,7 +49,7 @@ class World(Mc):
 
     @property
     def time(self):
-        return bpy.context.scene.frame_current
+        return self.sim.framelast
 
     @timeChannel("World")
     def event(self, eventName, eventType):
@@ -58,12 +59,12 @@ class World(Mc):
             if e.eventname == en:
                 result = True
                 if e.category == "Time" or e.category == "Time+Volume":
-                    if not e.timeMin <= bpy.context.scene.frame_current < e.timeMax:
+                    if not e.timeMin <= self.sim.framelast < e.timeMax:
                         result = False
                 if e.category == "Volume" or e.category == "Time+Volume":
                     if result:
                         volObj = bpy.data.objects[e.volume]
-                        pt = bpy.data.objects[self.userid].location
+                        pt = self.sim.geometry.location(self.userid)
                         localPt = volObj.matrix_world.inverted() * pt
                         d = mathutils.Vector()
                         d.x = volObj.dimensions.x / volObj.scale.x
@@ -76,15 +77,15 @@ class World(Mc):
                             result = False
                 if result:
                     if eventType == "control":
-                        return {"None": 1}
+                        return scalar(1)
                     elif eventType == "duration":
                         duration = e.timeMax - e.timeMin
-                        return {"None": duration}
+                        return scalar(duration)
                     elif eventType == "elapsed":
-                        elapsed = bpy.context.scene.frame_current - e.timeMin
-                        return {"None": elapsed}
+                        elapsed = self.sim.framelast - e.timeMin
+                        return scalar(elapsed)
 
-        return {"None": 0}
+        return scalar(0)
 
 
 class Channel:
@@ -98,28 +99,17 @@ class Channel:
         self.calcd = False
 
     def calculate(self):
-        O = bpy.context.scene.objects
+        geometry = self.sim.geometry
 
-        to = O[self.target]
-        ag = O[self.userid]
-        userDim = bpy.context.scene.objects[self.userid].dimensions
+        tDim = max(geometry.dimensions(self.target))
+        uDim = max(geometry.dimensions(self.userid))
 
-        tDim = max(bpy.context.scene.objects[self.target].dimensions)
-        uDim = max(userDim)
+        target = geometry.location(self.target) - \
+            geometry.location(self.userid)
+        dist = target.length
 
-        difx = to.location.x - ag.location.x
-        dify = to.location.y - ag.location.y
-        difz = to.location.z - ag.location.z
-        dist = math.sqrt(difx**2 + dify**2 + difz**2)
-
-        target = to.location - ag.location
-
-        z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-        y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-        x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-        rotation = x * y * z
-        relative = target * rotation
+        agent = self.sim.agents[self.userid]
+        relative = self.sim.state.localMatrix(agent.index) * target
 
         changez = math.atan2(relative[0], relative[1]) / math.pi
         changex = math.atan2(relative[2], relative[1]) / math.pi
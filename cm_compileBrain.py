@@ -17,13 +17,55 @@
 # along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
 # ##### END GPL LICENSE BLOCK #####
 
+import hashlib
+import logging
+import marshal
+import math
+import os
+import pickle
+import sys
+import unittest
+from types import SimpleNamespace
+
 import bpy
 
-from .cm_brainClasses import Brain
-from .cm_nodeFunctions import logictypes, statetypes
+from .cm_batchBrain import BatchPlan
+from .cm_brainClasses import (GATED, LOGIC, PER_AGENT, PER_FRAME, SHARED,
+                               STATE, STATIC, Brain)
+from .cm_impulse import SCALAR, normaliseOutput, scalar
+from .cm_nodeFunctions import (LogicAND, LogicGRAPH, LogicMAP, LogicMATH,
+                               LogicNEWINPUT, LogicOR, LogicOUTPUT,
+                               LogicPRINT, LogicSETTAG, logictypes,
+                               statetypes)
 
 preferences = bpy.context.user_preferences.addons[__package__].preferences
 
+logger = logging.getLogger("CrowdMaster")
+
+"""Neurons that change the outputs or tags of the brain (see
+BrainTemplate.optimise)"""
+SINKS = (LogicOUTPUT, LogicSETTAG)
+"""Neurons that only do maths on their inputs so can be evaluated when the
+brain is compiled if all of their inputs are constant"""
+FOLDABLE = (LogicMATH, LogicMAP, LogicGRAPH)
+
+"""The code objects of the functions generated by BrainTemplate.function
+keyed by their source. Kept between simulations so that running the same
+brains again doesn't need to compile them again."""
+_codeCache = {}
+
+BRAIN_CACHE_VERSION = 2
+
+"""The modules whose code decides what a node tree compiles to. A hash of
+their source is part of treeHash so that brains cached by other versions
+of the add-on aren't loaded."""
+COMPILER_MODULES = ("cm_batchBrain", "cm_bpyNodes", "cm_brainClasses",
+                    "cm_compileBrain", "cm_impulse", "cm_nodeFunctions")
+_compilerHash = None
+
+"""The types of property that are included in treeHash"""
+HASHED_PROPERTY_TYPES = {"BOOLEAN", "INT", "FLOAT", "STRING", "ENUM"}
+
 
 def getInputs(inp):
     result = []
@@ -59,35 +101,819 @@ def getOutputs(out):
     return result
 
 
-def compileBrain(nodeGroup, sim, userid, freezeAnimation):
-    """Compile the brain that defines how and agent moves and is animated"""
-    result = Brain(sim, userid, freezeAnimation)
-    preferences = bpy.context.user_preferences.addons[__package__].preferences
-    """create the connections from the node"""
+def propertyValues(item, ignore):
+    """The values of the properties of a node or socket other than the
+    ones in ignore"""
+    values = []
+    for prop in item.bl_rna.properties:
+        if prop.identifier in ignore or prop.type not in HASHED_PROPERTY_TYPES:
+            continue
+        value = getattr(item, prop.identifier)
+        if prop.type != "STRING" and prop.type != "ENUM" and \
+                prop.array_length > 0:
+            value = tuple(value)
+        elif isinstance(value, set):
+            value = tuple(sorted(value))
+        values.append((prop.identifier, value))
+    return values
+
+
+def compilerHash():
+    """A hash of the source of the COMPILER_MODULES. Only worked out once."""
+    global _compilerHash
+    if _compilerHash is None:
+        sha = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in COMPILER_MODULES:
+            with open(os.path.join(directory, name + ".py"), "rb") as f:
+                sha.update(f.read())
+        _compilerHash = sha.hexdigest()
+    return _compilerHash
+
+
+def treeHash(nodeGroup):
+    """A hash of everything in a brain node tree that compiling it depends
+    on, and of the code that compiles it. Used as the name of the file it
+    is cached in (see loadBrain)."""
+    sha = hashlib.sha1()
+    sha.update(repr((BRAIN_CACHE_VERSION, compilerHash(), sys.version,
+                     nodeGroup.name, preferences.show_debug_options)).encode())
+    nodeProperties = set(bpy.types.Node.bl_rna.properties.keys())
+    socketProperties = set(bpy.types.NodeSocket.bl_rna.properties.keys())
     for node in nodeGroup.nodes:
-        if node.bl_idname in logictypes:
-            # node.name  -  The identifier
-            # node.bl_idname  -  The type
-            item = logictypes[node.bl_idname](result, node)
-            node.getSettings(item)
-            if node.bl_idname == "PriorityNode":
-                item.inputs = getMultiInputs(node.inputs)
+        sha.update(repr((node.name, node.bl_idname,
+                         propertyValues(node, nodeProperties))).encode())
+        for socket in node.inputs:
+            sha.update(repr((socket.identifier, propertyValues(
+                socket, socketProperties))).encode())
+    # The order of the links is the order of the inputs of the neurons
+    for link in nodeGroup.links:
+        sha.update(repr((link.from_node.name, link.from_socket.identifier,
+                         link.to_node.name, link.to_socket.identifier)
+                        ).encode())
+    return sha.hexdigest()
+
+
+def brainCachePath(scene, key):
+    """The file that the compiled brain with this treeHash is cached in"""
+    directory = bpy.path.abspath(scene.cm_brain_cache_directory)
+    return os.path.join(directory, "{}.cmbrain".format(key))
+
+
+class SettingsRecorder:
+    """Passed to node.getSettings in place of a neuron to collect the
+    settings so they can be given to the neurons of every agent"""
+
+    def __init__(self):
+        self.settings = {}
+
+    def attributes(self):
+        """Everything other than self.settings that getSettings set"""
+        return {k: v for k, v in vars(self).items() if k != "settings"}
+
+
+class NeuronTemplate:
+    """Everything needed to create one of the neurons of a brain"""
+
+    def __init__(self, node, neuronType, isState, settings=None,
+                 attributes=None):
+        """
+        :param settings: The settings from node.getSettings if they are
+            already known (see BrainTemplate.cacheData)
+        """
+        self.name = node.name
+        self.bpyNode = node
+        self.neuronType = neuronType
+        self.isState = isState
+
+        if settings is None:
+            recorder = SettingsRecorder()
+            node.getSettings(recorder)
+            self.settings = recorder.settings
+            self.attributes = recorder.attributes()
+        else:
+            self.settings = settings
+            self.attributes = attributes
+
+        self.inputs = []
+        self.dependantOn = []
+        self.outputs = []
+        self.valueInputs = []
+
+        # Set by BrainTemplate once all the neurons have been found
+        self.slot = None
+        self.inputSlots = ()
+        self.valueInputSlots = []
+
+
+class SourceWriter:
+    """Builds the source of a function generated by BrainTemplate.function"""
+
+    def __init__(self):
+        self.lines = []
+        self.constants = []
+
+    def const(self, value):
+        """Source for a value from the settings of a neuron. Values that
+        don't have a literal form are passed to the function in K"""
+        if isinstance(value, (bool, int, str)) or \
+                (isinstance(value, float) and math.isfinite(value)):
+            literal = repr(value)
+            if literal.startswith("-"):
+                literal = "(" + literal + ")"
+            return literal
+        self.constants.append(value)
+        return "K[{}]".format(len(self.constants) - 1)
+
+    def add(self, lines, indent=1):
+        self.lines += ["    " * indent + line for line in lines]
+
+    def source(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class BrainTemplate:
+    """The compiled form of a brain node tree. Made once per node group and
+    then instantiated for each agent that uses it. The settings, inputs and
+    outputs are shared between all the instances so must not be modified."""
+
+    def __init__(self, nodeGroup, cached=None):
+        """
+        :param cached: The data from self.cacheData for this node tree. The
+            settings and connections of the nodes are taken from it rather
+            than from the nodes.
+        """
+        self.name = nodeGroup.name
+        self.neurons = []  # type: List[NeuronTemplate]
+        self.outputs = []  # type: List[str]
+        self.startState = None  # type: str | None
+        self.lockedOutputs = None  # Found by the first instance
+        self.slots = {}  # type: Dict[str, int]
+        self.plans = {}  # See self.plan
+        self.functions = {}  # See self.function
+        self.batchPlans = {}  # See self.batchPlan
+        self.representative = None  # The first instance, see self.share
+        self.cachePath = None  # See loadBrain
+        self.cachedSources = set()  # Sources of the code in the cache file
+        self.generatedSources = set()  # Sources of the code from self.generate
+
+        if cached is not None:
+            self.restore(nodeGroup, cached)
+        else:
+            self.collect(nodeGroup)
+            self.removed = []  # type: List[str] - see self.optimise
+            self.folded = []  # type: List[str] - see self.optimise
+            self.optimise()
+
+        for slot, nt in enumerate(self.neurons):
+            nt.slot = slot
+            self.slots[nt.name] = slot
+        for nt in self.neurons:
+            nt.inputSlots = tuple(self.slots[i] for i in nt.inputs)
+            nt.valueInputSlots = [self.slots[i] for i in nt.valueInputs]
+
+        self.invariance = self.classify()  # type: List[int] - by slot
+        # The outputs of the neurons that are the same for every agent
+        self.shared = [None] * len(self.neurons)
+        self.frameShare = None  # See self.share
+
+    def collect(self, nodeGroup):
+        """create the connections from the node"""
+        for node in nodeGroup.nodes:
+            if node.bl_idname in logictypes:
+                # node.name  -  The identifier
+                # node.bl_idname  -  The type
+                item = NeuronTemplate(node, logictypes[node.bl_idname], False)
+                if node.bl_idname == "PriorityNode":
+                    item.inputs = getMultiInputs(node.inputs)
+                else:
+                    item.inputs = getInputs(node.inputs["Input"])
+                item.dependantOn = getOutputs(node.outputs["Dependant"])
+                if not node.outputs["Output"].is_linked:
+                    self.outputs.append(node.name)
+                self.neurons.append(item)
+            elif node.bl_idname in statetypes:
+                item = NeuronTemplate(node, statetypes[node.bl_idname], True)
+                item.outputs = getOutputs(node.outputs["To"])
+                if node.bl_idname == "StartState":
+                    self.startState = node.name
+                else:
+                    item.valueInputs = getInputs(node.inputs["Value"])
+                    item.inputs = getInputs(node.inputs["From"])
+                    if len(item.valueInputs) != 0:
+                        self.outputs.append(node.name)
+                self.neurons.append(item)
+
+    def cacheData(self):
+        """Everything needed to make this template again without reading
+        the settings of the nodes or compiling the generated functions"""
+        return {
+            "version": BRAIN_CACHE_VERSION,
+            "neurons": [{"name": nt.name,
+                         "type": nt.neuronType.__name__,
+                         "isState": nt.isState,
+                         "settings": nt.settings,
+                         "attributes": nt.attributes,
+                         "inputs": nt.inputs,
+                         "dependantOn": nt.dependantOn,
+                         "outputs": nt.outputs,
+                         "valueInputs": nt.valueInputs}
+                        for nt in self.neurons],
+            "outputs": self.outputs,
+            "startState": self.startState,
+            "removed": self.removed,
+            "folded": self.folded,
+            "lockedOutputs": self.lockedOutputs,
+            "code": {source: marshal.dumps(_codeCache[source])
+                     for source in self.generatedSources}
+        }
+
+    def restore(self, nodeGroup, data):
+        """Load the values returned by self.cacheData"""
+        neuronTypes = {cls.__name__: cls for cls in
+                       list(logictypes.values()) + list(statetypes.values())}
+        for item in data["neurons"]:
+            nt = NeuronTemplate(nodeGroup.nodes[item["name"]],
+                                neuronTypes[item["type"]], item["isState"],
+                                item["settings"], item["attributes"])
+            nt.inputs = item["inputs"]
+            nt.dependantOn = item["dependantOn"]
+            nt.outputs = item["outputs"]
+            nt.valueInputs = item["valueInputs"]
+            self.neurons.append(nt)
+        self.outputs = data["outputs"]
+        self.startState = data["startState"]
+        self.removed = data["removed"]
+        self.folded = data["folded"]
+        self.lockedOutputs = data["lockedOutputs"]
+        for source, code in data["code"].items():
+            if source not in _codeCache:
+                _codeCache[source] = marshal.loads(code)
+        self.cachedSources = set(data["code"])
+        self.generatedSources = set(data["code"])
+
+    def saveCache(self):
+        """Write self.cacheData to self.cachePath if anything has been
+        compiled since it was last written"""
+        if self.cachePath is None:
+            return
+        if self.cachedSources == self.generatedSources and \
+                os.path.isfile(self.cachePath):
+            return
+        directory = os.path.dirname(self.cachePath)
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.cachePath, "wb") as f:
+            pickle.dump(self.cacheData(), f, pickle.HIGHEST_PROTOCOL)
+        self.cachedSources = set(self.generatedSources)
+        logger.info("Saved compiled brain {} to {}".format(self.name,
+                                                            self.cachePath))
+
+    def optimise(self):
+        """Replace the maths neurons whose inputs are all constant by
+        constants then remove the neurons that can't change the outputs or
+        tags of the brain or the value of a state. Print neurons are kept
+        while the debug options are shown."""
+        byName = {nt.name: nt for nt in self.neurons}
+
+        def isConstant(name):
+            nt = byName[name]
+            return (nt.neuronType is LogicNEWINPUT and
+                    nt.settings["InputSource"] == "CONSTANT" and
+                    len(nt.dependantOn) == 0)
+
+        changed = True
+        while changed:
+            changed = False
+            for nt in self.neurons:
+                if nt.neuronType not in FOLDABLE or len(nt.inputs) == 0:
+                    continue
+                if not all(isConstant(i) for i in nt.inputs):
+                    continue
+                inps = [scalar(byName[i].settings["Constant"])
+                        for i in nt.inputs]
+                try:
+                    output = normaliseOutput(
+                        nt.neuronType.core(None, inps, nt.settings))
+                except (ArithmeticError, KeyError, TypeError, ValueError):
+                    continue
+                if list(output) != [SCALAR]:
+                    continue
+                nt.neuronType = LogicNEWINPUT
+                nt.settings = {"InputSource": "CONSTANT",
+                               "Constant": output[SCALAR]}
+                nt.inputs = []
+                self.folded.append(nt.name)
+                changed = True
+
+        sinks = SINKS
+        if preferences.show_debug_options:
+            sinks += (LogicPRINT,)
+        live = set()
+        stack = []
+        for nt in self.neurons:
+            if nt.isState:
+                stack += nt.valueInputs
+            elif nt.neuronType in sinks:
+                stack.append(nt.name)
+        while stack:
+            name = stack.pop()
+            if name not in live:
+                live.add(name)
+                stack += byName[name].inputs
+
+        self.removed = [nt.name for nt in self.neurons
+                        if not nt.isState and nt.name not in live]
+        self.neurons = [nt for nt in self.neurons
+                        if nt.isState or nt.name in live]
+
+        # Keep the order of the outputs that are still needed. Sinks whose
+        # output only went to removed neurons become outputs themselves.
+        outputs = [o for o in self.outputs
+                   if byName[o].isState or o in live]
+        reached = set()
+        stack = list(outputs)
+        while stack:
+            name = stack.pop()
+            if name not in reached:
+                reached.add(name)
+                nt = byName[name]
+                stack += nt.valueInputs if nt.isState else nt.inputs
+        for nt in self.neurons:
+            if nt.name not in reached and not nt.isState and \
+                    nt.neuronType in sinks:
+                outputs.append(nt.name)
+                stack = [nt.name]
+                while stack:
+                    name = stack.pop()
+                    if name not in reached:
+                        reached.add(name)
+                        stack += byName[name].inputs
+        self.outputs = outputs
+
+        if self.removed or self.folded:
+            logger.info("Brain {}: removed {} unused neurons {}, folded {} "
+                        "constant neurons {}".format(
+                            self.name, len(self.removed), self.removed,
+                            len(self.folded), self.folded))
+
+    def classify(self):
+        """How much the output of each neuron can vary (see
+        Neuron.invariance) taking its inputs into account. A neuron is only
+        as invariant as the least invariant of its inputs. The output of a
+        neuron that is dependant on a state depends on the state of the
+        agent so the neurons that use it are per agent.
+
+        :rtype: List[int] - by slot"""
+        result = [None] * len(self.neurons)
+
+        def visit(slot):
+            if result[slot] is None:
+                result[slot] = PER_AGENT  # In case of a loop
+                nt = self.neurons[slot]
+                if not nt.isState:
+                    try:
+                        invariance = nt.neuronType.invariance(nt)
+                    except KeyError:
+                        invariance = PER_AGENT
+                    for i in nt.inputSlots:
+                        if invariance == PER_AGENT:
+                            break
+                        if len(self.neurons[i].dependantOn) > 0:
+                            invariance = PER_AGENT
+                        else:
+                            invariance = min(invariance, visit(i))
+                    result[slot] = invariance
+            return result[slot]
+
+        for slot in range(len(self.neurons)):
+            visit(slot)
+        return result
+
+    def plan(self, gate, locked):
+        """The order to evaluate the neurons in (see Brain.run).
+
+        :param gate: The name of the current state if it is set as current.
+            Neurons that are dependant on other states output None without
+            their inputs being evaluated.
+        :param locked: The name of the current state if the agent is locked
+            in it (see Brain.findLockedOutputs) otherwise None.
+        :returns: (slot, GATED | LOGIC | STATE | SHARED, input slots) for
+            each neuron that needs evaluating. Inputs always come before the
+            neurons that use them. The inputs of SHARED neurons are left out
+            as their output is copied from self.shared.
+        :rtype: Tuple[(int, int, Tuple[int])]"""
+        key = (gate, locked)
+        if key not in self.plans:
+            if locked is None:
+                outputs = self.outputs
             else:
-                item.inputs = getInputs(node.inputs["Input"])
-            item.dependantOn = getOutputs(node.outputs["Dependant"])
-            if not node.outputs["Output"].is_linked:
-                result.outputs.append(node.name)
-            result.neurons[node.name] = item
-        elif node.bl_idname in statetypes:
-            item = statetypes[node.bl_idname](result, node, node.name)
-            node.getSettings(item)
-            item.outputs = getOutputs(node.outputs["To"])
-            if node.bl_idname == "StartState":
-                result.setStartState(node.name)
+                outputs = self.lockedOutputs[locked]
+            plan = []
+            visited = set()
+
+            def visit(slot):
+                if slot in visited:
+                    return
+                visited.add(slot)
+                nt = self.neurons[slot]
+                if nt.isState:
+                    for i in nt.valueInputSlots:
+                        visit(i)
+                    plan.append((slot, STATE, ()))
+                elif len(nt.dependantOn) > 0 and gate not in nt.dependantOn:
+                    plan.append((slot, GATED, ()))
+                elif self.invariance[slot] != PER_AGENT:
+                    plan.append((slot, SHARED, ()))
+                else:
+                    for i in nt.inputSlots:
+                        visit(i)
+                    plan.append((slot, LOGIC, nt.inputSlots))
+
+            for out in outputs:
+                visit(self.slots[out])
+            self.plans[key] = tuple(plan)
+        return self.plans[key]
+
+    def function(self, gate, locked):
+        """The plan for (gate, locked) as a Python function with the settings
+        of the neurons inlined (see Neuron.source). Calling it as
+        run(brain, brain.results, brain.slots, frame) does the same as
+        brain.run(self.plan(gate, locked))."""
+        key = (gate, locked)
+        if key not in self.functions:
+            self.functions[key] = self.generate(self.plan(gate, locked))
+        return self.functions[key]
+
+    def batchPlan(self, gate, locked):
+        """The plan for (gate, locked) split up to be evaluated for many
+        agents at once (see cm_batchBrain)"""
+        key = (gate, locked)
+        if key not in self.batchPlans:
+            self.batchPlans[key] = BatchPlan(self, self.plan(gate, locked))
+        return self.batchPlans[key]
+
+    def share(self, frame):
+        """Evaluate the neurons that have the same output for every agent
+        (see self.classify) into self.shared. Static neurons are only
+        evaluated the first time. Called once per frame before any of the
+        brains are evaluated."""
+        brain = self.representative
+        if brain is None:
+            return
+        if self.frameShare is None:
+            static = self.sharePlan(STATIC)
+            if static:
+                self.generate(static)(brain, self.shared, brain.slots, frame)
+            self.frameShare = self.generate(self.sharePlan(PER_FRAME))
+        self.frameShare(brain, self.shared, brain.slots, frame)
+
+    def sharePlan(self, invariance):
+        """A plan (see self.plan) for all of the neurons with this
+        invariance. Their inputs are either in the plan or more invariant."""
+        plan = []
+        visited = set()
+
+        def visit(slot):
+            if slot in visited or self.invariance[slot] != invariance:
+                return
+            visited.add(slot)
+            for i in self.neurons[slot].inputSlots:
+                visit(i)
+            plan.append((slot, LOGIC, self.neurons[slot].inputSlots))
+
+        for slot in range(len(self.neurons)):
+            if not self.neurons[slot].isState:
+                visit(slot)
+        return plan
+
+    def generate(self, plan):
+        """Compile a plan into a Python function (see self.function)"""
+        writer = SourceWriter()
+        kinds = {slot: kind for slot, kind, inputSlots in plan}
+        writer.add(["def run(brain, results, slots, frame):"], 0)
+        writer.add(["lvars = brain.lvars"])
+        for slot, kind, inputSlots in plan:
+            nt = self.neurons[slot]
+            if kind == GATED:
+                writer.add(["results[{}] = None".format(slot)])
+            elif kind == STATE:
+                writer.add(["slots[{}].evaluate()".format(slot)])
+            elif kind == SHARED:
+                writer.add(["r{0} = results[{0}] = shared[{0}]".format(slot)])
             else:
-                item.valueInputs = getInputs(node.inputs["Value"])
-                item.inputs = getInputs(node.inputs["From"])
-                if len(item.valueInputs) != 0:
-                    result.outputs.append(node.name)
-            result.neurons[node.name] = item
-    return result
+                writer.add(["# {!r} ({})".format(nt.name,
+                                                  nt.neuronType.__name__)])
+                # The outputs of logic neurons are never None and are kept in
+                # locals, gated neurons always are None
+                inps = []
+                optional = False
+                for i in inputSlots:
+                    if kinds.get(i) in (LOGIC, SHARED):
+                        inps.append("r{}".format(i))
+                    elif kinds.get(i) == STATE:
+                        inps.append("results[{}]".format(i))
+                        optional = True
+                    elif i not in kinds:
+                        # Only in the plans of self.share, for inputs that
+                        # are more invariant so have already been evaluated
+                        inps.append("results[{}]".format(i))
+                if optional:
+                    writer.add(["inps = [r for r in ({},) if r is not None]"
+                                .format(", ".join(inps))])
+                else:
+                    writer.add(["inps = [{}]".format(", ".join(inps))])
+                try:
+                    lines = nt.neuronType.source(nt, writer.const)
+                except KeyError:
+                    # Missing settings are left to raise from core
+                    lines = None
+                if lines is None:
+                    lines = ["out = norm(slots[{0}].core(inps, slots[{0}].settings))"
+                             .format(slot)]
+                writer.add(lines)
+                writer.add(["r{0} = results[{0}] = out".format(slot)])
+
+        source = writer.source()
+        self.generatedSources.add(source)
+        if source not in _codeCache:
+            _codeCache[source] = compile(
+                source, "<CrowdMaster brain {}>".format(self.name), "exec")
+        namespace = {"math": math, "logger": logger, "norm": normaliseOutput,
+                     "scalar": scalar, "SCALAR": SCALAR,
+                     "K": writer.constants, "shared": self.shared}
+        exec(_codeCache[source], namespace)
+        return namespace["run"]
+
+    def instantiate(self, sim, userid, freezeAnimation):
+        """Create the brain for an agent"""
+        result = Brain(sim, userid, freezeAnimation)
+        result.template = self
+        for nt in self.neurons:
+            if nt.isState:
+                item = nt.neuronType(result, nt.bpyNode, nt.name)
+                item.outputs = nt.outputs
+                item.valueInputs = nt.valueInputs
+                item.valueInputSlots = nt.valueInputSlots
+                result.states.append(item)
+            else:
+                item = nt.neuronType(result, nt.bpyNode)
+                item.dependantOn = nt.dependantOn
+            item.settings = nt.settings
+            for attr, value in nt.attributes.items():
+                setattr(item, attr, value)
+            item.inputs = nt.inputs
+            item.slot = nt.slot
+            result.neurons[nt.name] = item
+            result.slots.append(item)
+        result.results = [None] * len(self.neurons)
+        result.outputs = self.outputs
+        if self.startState is not None:
+            result.setStartState(self.startState)
+
+        if self.representative is None:
+            self.representative = result
+        if self.lockedOutputs is None:
+            result.findLockedOutputs()
+            self.lockedOutputs = result.lockedOutputs
+        else:
+            result.lockedOutputs = self.lockedOutputs
+
+        for nt in self.neurons:
+            if nt.isState:
+                result.neurons[nt.name].setup()
+        return result
+
+
+def loadBrain(nodeGroup):
+    """Make the template for a node tree. If the compiled brain cache is
+    enabled and the node tree hasn't changed since it was last cached the
+    template is loaded from the cache rather than compiled."""
+    scene = bpy.context.scene
+    if not scene.cm_brain_cache or bpy.data.filepath == "":
+        return BrainTemplate(nodeGroup)
+    path = brainCachePath(scene, treeHash(nodeGroup))
+    template = None
+    if os.path.isfile(path):
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            if data["version"] == BRAIN_CACHE_VERSION:
+                template = BrainTemplate(nodeGroup, data)
+                logger.info("Loaded compiled brain {} from {}".format(
+                    nodeGroup.name, path))
+        except (OSError, EOFError, ValueError, KeyError, TypeError,
+                pickle.UnpicklingError) as e:
+            logger.warning("Couldn't load compiled brain {} from {}: {}"
+                           .format(nodeGroup.name, path, e))
+    if template is None:
+        template = BrainTemplate(nodeGroup)
+    template.cachePath = path
+    return template
+
+
+def compileBrain(nodeGroup, sim, userid, freezeAnimation):
+    """Compile the brain that defines how and agent moves and is animated.
+    The node tree is only compiled once per simulation (see
+    Simulation.compbrains)"""
+    if nodeGroup.name not in sim.compbrains:
+        sim.compbrains[nodeGroup.name] = loadBrain(nodeGroup)
+    return sim.compbrains[nodeGroup.name].instantiate(sim, userid,
+                                                      freezeAnimation)
+
+
+class GeneratedSourceTestCase(unittest.TestCase):
+    """The source from Neuron.source must give the same results as core"""
+
+    def check(self, neuronType, settings, inps):
+        writer = SourceWriter()
+        template = SimpleNamespace(settings=settings, name="Node",
+                                   bpyNode=SimpleNamespace(name="Node"))
+        lines = neuronType.source(template, writer.const)
+        writer.add(["def run(brain, inps):"], 0)
+        writer.add(lines + ["return out"])
+        namespace = {"math": math, "logger": logger, "norm": normaliseOutput,
+                     "scalar": scalar, "SCALAR": SCALAR,
+                     "K": writer.constants}
+        exec(compile(writer.source(), "<test>", "exec"), namespace)
+        expected = normaliseOutput(neuronType.core(None, inps, settings))
+        self.assertEqual(namespace["run"](None, inps), expected)
+
+    def testMath(self):
+        inps = [{"a": 0.5, "b": -2}, {"b": 3}]
+        for operation in ("add", "sub", "mul", "div", "set"):
+            self.check(LogicMATH, {"operation": operation, "num1": -1.5}, inps)
+        self.check(LogicMATH, {"operation": "add", "num1": float("inf")}, inps)
+
+    def testMap(self):
+        inps = [{"a": 0.5, "b": -2}]
+        self.check(LogicMAP, {"LowerInput": 0.0, "UpperInput": 2.0,
+                              "LowerOutput": -1.0, "UpperOutput": 1.0}, inps)
+        self.check(LogicMAP, {"LowerInput": 1.0, "UpperInput": 1.0,
+                              "LowerOutput": -1.0, "UpperOutput": 1.0}, inps)
+
+    def testAndOr(self):
+        inps = [{"a": 0.5, "b": 0.2}, {"b": 0.9, "c": 0.4}, {}]
+        for method in ("MUL", "MIN"):
+            for includeAll in (True, False):
+                for singleOutput in (True, False):
+                    self.check(LogicAND, {"Method": method,
+                                          "IncludeAll": includeAll,
+                                          "SingleOutput": singleOutput}, inps)
+        for method in ("MUL", "MAX"):
+            for singleOutput in (True, False):
+                self.check(LogicOR, {"Method": method,
+                                     "SingleOutput": singleOutput}, inps)
+
+    def testScalar(self):
+        self.assertTrue(normaliseOutput(0.5).isScalar())
+        writer = SourceWriter()
+        template = SimpleNamespace(settings={"Method": "MUL",
+                                             "IncludeAll": False,
+                                             "SingleOutput": True})
+        lines = LogicAND.source(template, writer.const)
+        writer.add(["def run(brain, inps):"], 0)
+        writer.add(lines + ["return out"])
+        namespace = {"math": math, "logger": logger, "norm": normaliseOutput,
+                     "scalar": scalar, "SCALAR": SCALAR,
+                     "K": writer.constants}
+        exec(compile(writer.source(), "<test>", "exec"), namespace)
+        out = namespace["run"](None, [{0: 0.5, 1: 0.2}, scalar(2.0)])
+        self.assertTrue(out.isScalar())
+        self.assertEqual(out, {SCALAR: 0.2})
+
+
+class BrainOptimiseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tree = bpy.data.node_groups.new("cm_test_optimise",
+                                             "CrowdMasterTreeType")
+
+    def tearDown(self):
+        bpy.data.node_groups.remove(self.tree)
+
+    def testFoldAndRemove(self):
+        nodes = self.tree.nodes
+        links = self.tree.links
+        const = nodes.new("NewInputNode")
+        const.InputSource = "CONSTANT"
+        const.Constant = 2.0
+        mul = nodes.new("MathNode")
+        mul.operation = "mul"
+        mul.num1 = 3.0
+        out = nodes.new("OutputNode")
+        unused = nodes.new("MathNode")
+        links.new(const.outputs["Output"], mul.inputs["Input"])
+        links.new(mul.outputs["Output"], out.inputs["Input"])
+        links.new(const.outputs["Output"], unused.inputs["Input"])
+
+        template = BrainTemplate(self.tree)
+        self.assertEqual(template.folded, [mul.name])
+        self.assertEqual(template.removed, [const.name, unused.name])
+        self.assertEqual(template.outputs, [out.name])
+        self.assertEqual([nt.name for nt in template.neurons],
+                         [mul.name, out.name])
+        self.assertEqual(template.neurons[0].settings["Constant"], 6.0)
+
+    def testClassify(self):
+        nodes = self.tree.nodes
+        links = self.tree.links
+        time = nodes.new("NewInputNode")
+        time.InputSource = "WORLD"
+        time.WorldOptions = "TIME"
+        wave = nodes.new("MathNode")
+        speed = nodes.new("NewInputNode")
+        speed.InputSource = "STATE"
+        speed.StateOptions = "SPEED"
+        both = nodes.new("AndNode")
+        out = nodes.new("OutputNode")
+        links.new(time.outputs["Output"], wave.inputs["Input"])
+        links.new(wave.outputs["Output"], both.inputs["Input"])
+        links.new(speed.outputs["Output"], both.inputs["Input"])
+        links.new(both.outputs["Output"], out.inputs["Input"])
+
+        template = BrainTemplate(self.tree)
+        invariance = {nt.name: template.invariance[nt.slot]
+                      for nt in template.neurons}
+        self.assertEqual(invariance, {time.name: PER_FRAME,
+                                      wave.name: PER_FRAME,
+                                      speed.name: PER_AGENT,
+                                      both.name: PER_AGENT,
+                                      out.name: PER_AGENT})
+        kinds = {template.neurons[slot].name: kind
+                 for slot, kind, inputSlots in template.plan(None, None)}
+        self.assertEqual(kinds, {wave.name: SHARED, speed.name: LOGIC,
+                                 both.name: LOGIC, out.name: LOGIC})
+
+    def testLockedSideEffects(self):
+        nodes = self.tree.nodes
+        links = self.tree.links
+        start = nodes.new("StartState")
+        action = nodes.new("ActionState")
+        speed = nodes.new("NewInputNode")
+        speed.InputSource = "STATE"
+        speed.StateOptions = "SPEED"
+        tag = nodes.new("SetTagNode")
+        links.new(start.outputs["To"], action.inputs["From"])
+        links.new(speed.outputs["Output"], tag.inputs["Input"])
+        links.new(tag.outputs["Output"], action.inputs["Value"])
+
+        template = BrainTemplate(self.tree)
+        sim = SimpleNamespace(lvars={}, framelast=1)
+        brain = template.instantiate(sim, "Agent", False)
+        # The tag is still set while the agent is locked in the action
+        self.assertEqual(brain.lockedOutputs[action.name], [tag.name])
+        kinds = {template.neurons[slot].name: kind
+                 for slot, kind, inputSlots
+                 in template.plan(action.name, action.name)}
+        self.assertEqual(kinds, {speed.name: LOGIC, tag.name: LOGIC})
+
+
+class BrainCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tree = bpy.data.node_groups.new("cm_test_cache",
+                                             "CrowdMasterTreeType")
+        nodes = self.tree.nodes
+        links = self.tree.links
+        self.speed = nodes.new("NewInputNode")
+        self.speed.InputSource = "STATE"
+        self.speed.StateOptions = "SPEED"
+        self.mul = nodes.new("MathNode")
+        self.mul.operation = "mul"
+        self.mul.num1 = 3.0
+        self.out = nodes.new("OutputNode")
+        links.new(self.speed.outputs["Output"], self.mul.inputs["Input"])
+        links.new(self.mul.outputs["Output"], self.out.inputs["Input"])
+
+    def tearDown(self):
+        bpy.data.node_groups.remove(self.tree)
+
+    def testHash(self):
+        before = treeHash(self.tree)
+        self.assertEqual(treeHash(self.tree), before)
+        self.mul.num1 = 4.0
+        self.assertNotEqual(treeHash(self.tree), before)
+
+    def testCompilerHash(self):
+        global _compilerHash
+        before = treeHash(self.tree)
+        real = compilerHash()
+        try:
+            _compilerHash = "changed"
+            self.assertNotEqual(treeHash(self.tree), before)
+        finally:
+            _compilerHash = real
+        self.assertEqual(treeHash(self.tree), before)
+
+    def testRoundTrip(self):
+        template = BrainTemplate(self.tree)
+        template.function(None, None)
+        data = pickle.loads(pickle.dumps(template.cacheData()))
+        loaded = BrainTemplate(self.tree, data)
+        self.assertEqual([(nt.name, nt.neuronType, nt.settings, nt.inputs)
+                          for nt in loaded.neurons],
+                         [(nt.name, nt.neuronType, nt.settings, nt.inputs)
+                          for nt in template.neurons])
+        self.assertEqual(loaded.outputs, template.outputs)
+        self.assertEqual(loaded.plan(None, None), template.plan(None, None))
+        self.assertEqual(loaded.generatedSources, template.generatedSources)
+        self.assertEqual(loaded.neurons[0].bpyNode, self.speed)
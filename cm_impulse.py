@@ -0,0 +1,104 @@
+# Copyright 2017 CrowdMaster Developer Team
+#
+# ##### BEGIN GPL LICENSE BLOCK ######
+# This file is part of CrowdMaster.
+#
+# CrowdMaster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CrowdMaster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
+# ##### END GPL LICENSE BLOCK #####
+
+"""The containers the outputs of neurons are passed between neurons in. Kept
+apart from cm_brainClasses so that the channels can make them too."""
+
+"""The key of a value in an impulse that isn't about another agent. Values
+about other agents are keyed by the row of the agent in AgentState (see
+AgentState.keyName)."""
+SCALAR = "None"
+
+
+class Impulse:
+    """A read only {key: value} mapping kept as a list of keys and a list of
+    values. Cheaper to make than a dict when the keys and values are
+    already in lists (see cm_batchBrain.BatchImpulse.toImpulses). Has the
+    parts of the dict interface that neurons and channels use so it can be
+    used anywhere the output of a neuron can."""
+
+    __slots__ = ("_keys", "_values", "_index")
+
+    def __init__(self, keys, values, index=None):
+        self._keys = keys
+        self._values = values
+        self._index = index  # {key: position} made the first time it's needed
+
+    def _lookup(self):
+        if self._index is None:
+            self._index = {k: i for i, k in enumerate(self._keys)}
+        return self._index
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return key in self._lookup()
+
+    def __getitem__(self, key):
+        return self._values[self._lookup()[key]]
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, Impulse)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return "Impulse({})".format(dict(self.items()))
+
+    def get(self, key, default=None):
+        index = self._lookup()
+        if key in index:
+            return self._values[index[key]]
+        return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def isScalar(self):
+        """True if this only holds one value under the SCALAR key"""
+        return self._keys is _SCALAR_KEYS
+
+
+_SCALAR_KEYS = (SCALAR,)
+_SCALAR_INDEX = {SCALAR: 0}
+
+
+def scalar(value):
+    """An Impulse holding value under the SCALAR key. All of them share the
+    same keys and lookup so only the value is stored for each one."""
+    return Impulse(_SCALAR_KEYS, (value,), _SCALAR_INDEX)
+
+
+def normaliseOutput(output):
+    """The form of the output of Neuron.core that is stored in Brain.results"""
+    if output is None:
+        return {}
+    elif not isinstance(output, (dict, Impulse)):
+        return scalar(output)
+    return output
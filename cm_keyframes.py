@@ -0,0 +1,89 @@
+# Copyright 2017 CrowdMaster Developer Team
+#
+# ##### BEGIN GPL LICENSE BLOCK ######
+# This file is part of CrowdMaster.
+#
+# CrowdMaster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CrowdMaster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
+# ##### END GPL LICENSE BLOCK #####
+
+import logging
+
+import bpy
+
+logger = logging.getLogger("CrowdMaster")
+
+
+class KeyframeBuffer:
+    """Collects keyframes in memory during the simulation and writes them to
+    the fcurves in bulk. Inserting a keyframe through the RNA layer is slow
+    so doing it for every channel of every agent every frame dominates the
+    time spent applying the output of the agents."""
+
+    def __init__(self):
+        # {(ID, data_path, index): (action group, {frame: value})}
+        self.curves = {}
+        self.count = 0
+
+    def insert(self, idData, dataPath, index, frame, value, group=""):
+        """Equivalent to idData.keyframe_insert(dataPath, index, frame) when
+        the property has the given value. A later insert on the same frame
+        replaces the earlier one."""
+        key = (idData, dataPath, index)
+        if key not in self.curves:
+            self.curves[key] = (group, {})
+        self.curves[key][1][frame] = value
+        self.count += 1
+
+    def flush(self):
+        """Write all the buffered keyframes to their fcurves"""
+        if self.count == 0:
+            return
+        logger.debug("Writing {} buffered keyframes".format(self.count))
+        for (idData, dataPath, index), (group, keys) in self.curves.items():
+            if idData.animation_data is None:
+                idData.animation_data_create()
+            animData = idData.animation_data
+            if animData.action is None:
+                animData.action = bpy.data.actions.new(idData.name + "Action")
+            fcurves = animData.action.fcurves
+
+            fc = fcurves.find(dataPath, index)
+            if fc is None:
+                fc = fcurves.new(dataPath, index, group)
+            points = fc.keyframe_points
+            last = points[-1].co[0] if len(points) > 0 else None
+
+            # Keys after the end of the curve are appended to it in one go.
+            # Earlier keys (only when frames are simulated again) are
+            # inserted among the existing ones, replacing any key already on
+            # that frame, so the rest of the curve is left as it is.
+            frames = sorted(keys)
+            appended = [f for f in frames if last is None or f > last]
+            for f in frames[:len(frames) - len(appended)]:
+                points.insert(f, keys[f], {'FAST'})
+            # Setting the points one at a time through the RNA layer is as
+            # slow as inserting them so the existing ones are read back and
+            # the whole curve is written in a single call.
+            start = len(points)
+            co = [0.0] * (2 * start)
+            if start > 0:
+                points.foreach_get("co", co)
+            for f in appended:
+                co.append(f)
+                co.append(keys[f])
+            points.add(len(appended))
+            points.foreach_set("co", co)
+            fc.update()
+        self.curves = {}
+        self.count = 0
@@ -0,0 +1,119 @@
+# Copyright 2017 CrowdMaster Developer Team
+#
+# ##### BEGIN GPL LICENSE BLOCK ######
+# This file is part of CrowdMaster.
+#
+# CrowdMaster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CrowdMaster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
+# ##### END GPL LICENSE BLOCK #####
+
+"""A spatial index of where the agents are on the current frame, shared by
+all the channels that look for agents that are close to each other."""
+
+import unittest
+from types import SimpleNamespace
+
+import mathutils
+import numpy
+
+from .cm_agentState import AgentState, Geometry
+
+
+class NeighbourIndex:
+    """The positions of all the agents on this frame, and balanced kd-trees
+    of the groups of agents that the channels search (eg. the emitters on a
+    Sound frequency). The positions are worked out from the simulation
+    state the first time they are needed on each frame. Each tree is built
+    the first time it is asked for on a frame and then shared by every
+    agent that searches it. Agents are identified by their row in the
+    AgentState table."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.positions = None  # type: numpy.ndarray - (N, 3)
+        self.trees = {}  # type: Dict[Hashable, mathutils.kdtree.KDTree]
+
+    def newFrame(self):
+        """Called at the start of each frame once the agents have moved"""
+        self.positions = None
+        self.trees = {}
+
+    def agentPositions(self):
+        """Where every agent is, by row"""
+        if self.positions is None:
+            positions = self.sim.state.view("position").copy()
+            for agent in self.sim.agents.values():
+                # Moved by their own animation (see Geometry)
+                if agent.freezeAnimation:
+                    positions[agent.index] = self.sim.geometry.location(
+                        agent.id)
+            self.positions = positions
+        return self.positions
+
+    def tree(self, key, rows):
+        """The kd-tree of the agents in rows. rows is only read the first
+        time key is used on a frame."""
+        tree = self.trees.get(key)
+        if tree is None:
+            positions = self.agentPositions()
+            tree = mathutils.kdtree.KDTree(len(rows))
+            for row, co in zip(rows, positions[rows].tolist()):
+                tree.insert(co, row)
+            tree.balance()
+            self.trees[key] = tree
+        return tree
+
+    def radius(self, key, rows, co, distance):
+        """The agents in the group key (made of rows) within distance of co.
+        Agents that aren't in the group are never looked at.
+
+        :returns: [(row, distance to co)]"""
+        return [(row, dist) for _, row, dist
+                in self.tree(key, rows).find_range(co, distance)]
+
+
+class NeighbourIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(4)
+        state = AgentState()
+        agents = {}
+        for row in range(200):
+            name = "Agent.{:03d}".format(row)
+            state.add(name, rng.uniform(-20, 20, 3), (0, 0, 0), (1, 1, 1),
+                      (1, 1, 1))
+            agents[name] = SimpleNamespace(id=name, index=row,
+                                           freezeAnimation=False)
+        self.sim = SimpleNamespace(state=state, agents=agents)
+        self.sim.geometry = Geometry(self.sim)
+        self.index = NeighbourIndex(self.sim)
+
+    def testRadius(self):
+        positions = self.sim.state.view("position")
+        rows = list(range(0, 200, 3))
+        co = positions[7]
+        dists = numpy.sqrt(((positions - co) ** 2).sum(axis=1))
+        expected = {row for row in numpy.nonzero(dists <= 6)[0].tolist()
+                    if row % 3 == 0}
+        found = self.index.radius("Test", rows, co, 6)
+        self.assertEqual({row for row, dist in found}, expected)
+        for row, dist in found:
+            self.assertAlmostEqual(dist, dists[row], places=4)
+
+    def testNewFrame(self):
+        positions = self.sim.state.view("position")
+        tree = self.index.tree("Test", [1, 2])
+        self.assertIs(self.index.tree("Test", [1, 2]), tree)
+        positions[1] = (100, 100, 100)
+        self.index.newFrame()
+        found = self.index.radius("Test", [1, 2], (100, 100, 100), 0.5)
+        self.assertEqual([row for row, dist in found], [1])
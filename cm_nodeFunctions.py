@@ -21,32 +21,56 @@ import copy
 import logging
 import math
 import os
-import random
 from collections import OrderedDict
 
 import bpy
+import numpy
 
-from .cm_brainClasses import Neuron, State
+from .cm_brainClasses import PER_AGENT, PER_FRAME, STATIC, Neuron, State
+from .cm_impulse import SCALAR, scalar
+from .cm_random import CONSTANT
 
 """
 class Logic{NAME}(Neuron):
     def core(self, inps, settings):
-        :param inps: list of form [ImpulseContainer |
-                                   dict of form {str: float | int}, ]
+        :param inps: list of form [Impulse |
+                                   dict of form {int | str: float | int}, ]
+            keyed by the rows of agents or by SCALAR
         :param settings: dict of form {str: str | int | float, }
-        :rtype: int | dict of form {str: float | int}
+        :rtype: int | Impulse | dict of form {int | str: float | int}
 """
 
 logger = logging.getLogger("CrowdMaster")
 
 
+def valueSource(expression):
+    """Neuron.source for a core that returns the value of expression"""
+    return ["out = scalar(" + expression + ")"]
+
+
+def optionalSource(expression):
+    """Neuron.source for a core that returns the value of expression or an
+    empty dict if it is None"""
+    return ["v = " + expression,
+            "out = {} if v is None else scalar(v)"]
+
+
+def returnedSource(expression):
+    """Neuron.source for a core that returns whatever expression does"""
+    return ["out = norm(" + expression + ")"]
+
+
 class LogicNEWINPUT(Neuron):
     """Retrieve information from the scene or about the agent"""
 
+    __slots__ = ()
+
+    usesChannels = True
+
     def core(self, inps, settings):
         channels = self.brain.sim.lvars
         if settings["InputSource"] == "CONSTANT":
-            return {"None": settings["Constant"]}
+            return scalar(settings["Constant"])
 
         elif settings["InputSource"] == "FLOCK":
             if settings["Flocking"] == "SEPARATE":
@@ -54,44 +78,44 @@ class LogicNEWINPUT(Neuron):
                     separateTx = channels["Flock"].separateTx(inps)
                     if separateTx is None:
                         return {}
-                    return {"None": separateTx}
+                    return scalar(separateTx)
                 elif settings["TranslationAxis"] == "TY":
                     separateTy = channels["Flock"].separateTy(inps)
                     if separateTy is None:
                         return {}
-                    return {"None": separateTy}
+                    return scalar(separateTy)
                 elif settings["TranslationAxis"] == "TZ":
                     separateTz = channels["Flock"].separateTz(inps)
                     if separateTz is None:
                         return {}
-                    return {"None": separateTz}
+                    return scalar(separateTz)
             elif settings["Flocking"] == "COHERE":
                 if settings["TranslationAxis"] == "TX":
                     cohereTx = channels["Flock"].cohereTx(inps)
                     if cohereTx is None:
                         return {}
-                    return {"None": cohereTx}
+                    return scalar(cohereTx)
                 elif settings["TranslationAxis"] == "TY":
                     cohereTy = channels["Flock"].cohereTy(inps)
                     if cohereTy is None:
                         return {}
-                    return {"None": cohereTy}
+                    return scalar(cohereTy)
                 elif settings["TranslationAxis"] == "TZ":
                     cohereTz = channels["Flock"].cohereTz(inps)
                     if cohereTz is None:
                         return {}
-                    return {"None": cohereTz}
+                    return scalar(cohereTz)
             else:  # ie. settings["Flocking"] == "ALIGN"
                 if settings["RotationAxis"] == "RZ":
                     alignRz = channels["Flock"].alignRz(inps)
                     if alignRz is None:
                         return {}
-                    return {"None": alignRz}
+                    return scalar(alignRz)
                 elif settings["RotationAxis"] == "RX":
                     alignRx = channels["Flock"].alignRx(inps)
                     if alignRx is None:
                         return {}
-                    return {"None": alignRx}
+                    return scalar(alignRx)
 
         elif settings["InputSource"] == "FORMATION":
             fChan = channels["Formation"].retrieve(settings["FormationGroup"])
@@ -102,45 +126,45 @@ class LogicNEWINPUT(Neuron):
                 rz = fChan.rz
                 if rz is None:
                     return {}
-                return {"None": rz}
+                return scalar(rz)
             elif settings["FormationOptions"] == "RX":
                 rx = fChan.rx
                 if rx is None:
                     return {}
-                return {"None": rx}
+                return scalar(rx)
             elif settings["FormationOptions"] == "DIST":
                 dist = fChan.dist
                 if dist is None:
                     return {}
-                return {"None": dist}
+                return scalar(dist)
 
         elif settings["InputSource"] == "GROUND":
             if settings["GroundOptions"] == "DH":
                 gChan = channels["Ground"].retrieve(settings["GroundGroup"])
                 dh = gChan.dh()
-                return {"None": dh} if dh is not None else {}
+                return scalar(dh) if dh is not None else {}
             elif settings["GroundOptions"] == "ARZ":
                 gChan = channels["Ground"].retrieve(settings["GroundGroup"])
-                return {"None": gChan.aheadRz(self.settings["GroundAheadOffset"])}
+                return scalar(gChan.aheadRz(self.settings["GroundAheadOffset"]))
             elif settings["GroundOptions"] == "ARX":
                 gChan = channels["Ground"].retrieve(settings["GroundGroup"])
-                return {"None": gChan.aheadRx(self.settings["GroundAheadOffset"])}
+                return scalar(gChan.aheadRx(self.settings["GroundAheadOffset"]))
 
         elif settings["InputSource"] == "NOISE":
             noise = channels["Noise"]
             if settings["NoiseOptions"] == "RANDOM":
-                return {"None": noise.random()}
+                return scalar(noise.random(self.bpyNode.name))
             elif settings["NoiseOptions"] == "AGENTRANDOM":
-                return {"None": noise.agentRandom(offset=hash(self))}
+                return scalar(noise.agentRandom(self.bpyNode.name))
             elif settings["NoiseOptions"] == "WAVE":
-                return {"None": noise.wave(self.settings["WaveOffset"],
-                                           self.settings["WaveLength"])}
+                return scalar(noise.wave(self.settings["WaveOffset"],
+                                         self.settings["WaveLength"]))
 
         elif settings["InputSource"] == "PATH":
             if settings["PathOptions"] == "RZ":
-                return {"None": channels["Path"].rz(settings["PathName"])}
+                return scalar(channels["Path"].rz(settings["PathName"]))
             elif settings["PathOptions"] == "RX":
-                return {"None": channels["Path"].rx(settings["PathName"])}
+                return scalar(channels["Path"].rx(settings["PathName"]))
             elif settings["PathOptions"] == "INLANE":
                 agents = set()
                 for into in inps:
@@ -188,15 +212,15 @@ class LogicNEWINPUT(Neuron):
         elif settings["InputSource"] == "STATE":
             state = channels["State"]
             if settings["StateOptions"] == "RADIUS":
-                return {"None": state.radius}
+                return scalar(state.radius)
             elif settings["StateOptions"] == "SPEED":
-                return {"None": state.speed}
+                return scalar(state.speed)
             elif settings["StateOptions"] == "GLOBALVELX":
-                return {"None": state.velocity.x}
+                return scalar(state.velocity.x)
             elif settings["StateOptions"] == "GLOBALVELY":
-                return {"None": state.velocity.y}
+                return scalar(state.velocity.y)
             elif settings["StateOptions"] == "GLOBALVELZ":
-                return {"None": state.velocity.z}
+                return scalar(state.velocity.z)
             elif settings["StateOptions"] == "QUERYTAG":
                 return state.getTag(settings["StateTagName"])
 
@@ -205,15 +229,15 @@ class LogicNEWINPUT(Neuron):
             if settings["WorldOptions"] == "TARGET":
                 if settings["TargetOptions"] == "RZ":
                     tgt = world.target(settings["TargetObject"])
-                    return {"None": tgt.rz}
+                    return scalar(tgt.rz)
                 elif settings["TargetOptions"] == "RX":
                     tgt = world.target(settings["TargetObject"])
-                    return {"None": tgt.rx}
+                    return scalar(tgt.rx)
                 elif settings["TargetOptions"] == "ARRIVED":
                     tgt = world.target(settings["TargetObject"])
-                    return {"None": tgt.arrived}
+                    return scalar(tgt.arrived)
             elif settings["WorldOptions"] == "TIME":
-                return {"None": channels["World"].time}
+                return scalar(channels["World"].time)
             elif settings["WorldOptions"] == "EVENT":
                 return world.event(settings["EventName"], settings["EventOptions"])
 
@@ -227,10 +251,155 @@ class LogicNEWINPUT(Neuron):
             elif settings["AgentInfoOptions"] == "HEADRX":
                 return agent.headingRx(inps)
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        inputSource = settings["InputSource"]
+        if inputSource == "CONSTANT":
+            return valueSource(const(settings["Constant"]))
+
+        elif inputSource == "FLOCK":
+            if settings["Flocking"] in ("SEPARATE", "COHERE"):
+                axis = settings["TranslationAxis"]
+                if axis in ("TX", "TY", "TZ"):
+                    method = settings["Flocking"].lower() + axis.title()
+                    return optionalSource('lvars["Flock"].{}(inps)'.format(method))
+            elif settings["RotationAxis"] in ("RZ", "RX"):
+                method = "align" + settings["RotationAxis"].title()
+                return optionalSource('lvars["Flock"].{}(inps)'.format(method))
+
+        elif inputSource == "FORMATION":
+            retrieve = 'fChan = lvars["Formation"].retrieve({})'.format(
+                const(settings["FormationGroup"]))
+            if settings.get("FormationOptions") in ("RZ", "RX", "DIST"):
+                attr = settings["FormationOptions"].lower()
+                return [retrieve,
+                        "v = None if fChan is None else fChan.{}".format(attr),
+                        "out = {} if v is None else scalar(v)"]
+            return [retrieve, "out = {}"]
+
+        elif inputSource == "GROUND":
+            gChan = 'lvars["Ground"].retrieve({})'.format(
+                const(settings["GroundGroup"]))
+            offset = const(settings["GroundAheadOffset"])
+            if settings["GroundOptions"] == "DH":
+                return optionalSource(gChan + ".dh()")
+            elif settings["GroundOptions"] == "ARZ":
+                return valueSource("{}.aheadRz({})".format(gChan, offset))
+            elif settings["GroundOptions"] == "ARX":
+                return valueSource("{}.aheadRx({})".format(gChan, offset))
+
+        elif inputSource == "NOISE":
+            if settings["NoiseOptions"] == "RANDOM":
+                return valueSource('lvars["Noise"].random({})'.format(
+                    const(template.bpyNode.name)))
+            elif settings["NoiseOptions"] == "AGENTRANDOM":
+                return valueSource('lvars["Noise"].agentRandom({})'.format(
+                    const(template.bpyNode.name)))
+            elif settings["NoiseOptions"] == "WAVE":
+                return valueSource('lvars["Noise"].wave({}, {})'.format(
+                    const(settings["WaveOffset"]),
+                    const(settings["WaveLength"])))
+
+        elif inputSource == "PATH":
+            pathName = const(settings["PathName"])
+            if settings["PathOptions"] == "RZ":
+                return valueSource('lvars["Path"].rz({})'.format(pathName))
+            elif settings["PathOptions"] == "RX":
+                return valueSource('lvars["Path"].rx({})'.format(pathName))
+            elif settings["PathOptions"] == "INLANE":
+                return returnedSource(
+                    'lvars["Path"].inlane({}, {}, {{i for into in inps for i in into}})'.format(
+                        pathName, const(settings["PathLaneSearchDistance"])))
+
+        elif inputSource == "SOUND":
+            lines = ['ch = lvars["Sound"].retrieve({})'.format(
+                const(settings["SoundFrequency"]))]
+            modes = {"BASIC": (False, False),
+                     "PREDICTION": (True, False),
+                     "STEERING": (False, True)}
+            if settings["SoundMode"] in modes:
+                predict, steering = modes[settings["SoundMode"]]
+                lines += ["if ch is not None:",
+                          "    ch.predictNext = {}".format(predict),
+                          "    ch.steeringNext = {}".format(steering)]
+            if settings["SoundOptions"] in ("RZ", "RX", "DIST", "CLOSE", "DB",
+                                            "CERT", "ACC", "OVER", "HEADRZ",
+                                            "HEADRX"):
+                lines.append("out = {{}} if ch is None else norm(ch.{}({}))".format(
+                    settings["SoundOptions"].lower(),
+                    const(settings["MinusRadius"])))
+            else:
+                lines.append("out = {}")
+            return lines
+
+        elif inputSource == "STATE":
+            attrs = {"RADIUS": "radius",
+                     "SPEED": "speed",
+                     "GLOBALVELX": "velocity.x",
+                     "GLOBALVELY": "velocity.y",
+                     "GLOBALVELZ": "velocity.z"}
+            if settings["StateOptions"] in attrs:
+                return valueSource('lvars["State"].{}'.format(
+                    attrs[settings["StateOptions"]]))
+            elif settings["StateOptions"] == "QUERYTAG":
+                return returnedSource('lvars["State"].getTag({})'.format(
+                    const(settings["StateTagName"])))
+
+        elif inputSource == "WORLD":
+            if settings["WorldOptions"] == "TARGET":
+                if settings["TargetOptions"] in ("RZ", "RX", "ARRIVED"):
+                    return valueSource('lvars["World"].target({}).{}'.format(
+                        const(settings["TargetObject"]),
+                        settings["TargetOptions"].lower()))
+            elif settings["WorldOptions"] == "TIME":
+                return valueSource('lvars["World"].time')
+            elif settings["WorldOptions"] == "EVENT":
+                return returnedSource('lvars["World"].event({}, {})'.format(
+                    const(settings["EventName"]),
+                    const(settings["EventOptions"])))
+
+        elif inputSource == "AGENTINFO":
+            if settings["AgentInfoOptions"] == "GETTAG":
+                if settings["GetTagName"].strip() != "":
+                    return returnedSource('lvars["AgentInfo"].getTag(inps, {})'.format(
+                        const(settings["GetTagName"].strip())))
+            elif settings["AgentInfoOptions"] == "HEADRZ":
+                return returnedSource('lvars["AgentInfo"].headingRz(inps)')
+            elif settings["AgentInfoOptions"] == "HEADRX":
+                return returnedSource('lvars["AgentInfo"].headingRx(inps)')
+
+        return ["out = {}"]
+
+    @staticmethod
+    def invariance(template):
+        settings = template.settings
+        inputSource = settings["InputSource"]
+        if inputSource == "CONSTANT":
+            return STATIC
+        elif inputSource == "NOISE":
+            if settings["NoiseOptions"] == "WAVE":
+                return PER_FRAME
+        elif inputSource == "WORLD":
+            if settings["WorldOptions"] == "TIME":
+                return PER_FRAME
+            elif settings["WorldOptions"] == "EVENT":
+                # Only events that don't have a volume are the same for
+                # every agent
+                events = bpy.context.scene.cm_events.coll
+                if all(e.category == "Time" for e in events
+                       if e.eventname == settings["EventName"]):
+                    return PER_FRAME
+        return PER_AGENT
+
 
 class LogicGRAPH(Neuron):
     """Return value 0 to 1 mapping from graph"""
 
+    __slots__ = ()
+
+    keepsFirstKey = True
+
     def core(self, inps, settings):
         preferences = bpy.context.user_preferences.addons[__package__].preferences
 
@@ -274,10 +443,77 @@ class LogicGRAPH(Neuron):
                         output[i] = -output[i] + 1
         return output
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        if settings["CurveType"] == "RBF":
+            if settings["RBFTenPP"] == 0:
+                return None
+            a = math.log(0.1) / (settings["RBFTenPP"]**2)
+            value = "math.e**({} * (v - {})**2) * {}".format(
+                const(a), const(settings["RBFMiddle"]),
+                const(settings["Multiply"]))
+        elif settings["CurveType"] == "RANGE":
+            lz = const(settings["LowerZero"])
+            lo = const(settings["LowerOne"])
+            uo = const(settings["UpperOne"])
+            uz = const(settings["UpperZero"])
+            value = ("(0 if v < {lz} else (v - {lz}) / ({lo} - {lz}) if v < {lo} "
+                     "else 1 if v <= {uo} else ({uz} - v) / ({uz} - {uo}) "
+                     "if v < {uz} else 0) * {m}").format(
+                lz=lz, lo=lo, uo=uo, uz=uz, m=const(settings["Multiply"]))
+        else:
+            return None
+        if settings["Invert"]:
+            value = "-({}) + 1".format(value)
+        return ["out = {}",
+                "for into in inps:",
+                "    for k, v in into.items():",
+                "        if k in out:",
+                "            logger.debug(",
+                '                "LogicGRAPH data lost due to multiple inputs with the same key")',
+                "        else:",
+                "            out[k] = " + value]
+
+    @staticmethod
+    def batch(template):
+        settings = template.settings
+        multiply = settings["Multiply"]
+        if settings["CurveType"] == "RBF":
+            u = settings["RBFMiddle"]
+            if settings["RBFTenPP"] == 0:
+                return None
+            a = math.log(0.1) / (settings["RBFTenPP"]**2)
+
+            def curve(values):
+                return numpy.power(math.e, a * (values - u)**2) * multiply
+        elif settings["CurveType"] == "RANGE":
+            lz = settings["LowerZero"]
+            lo = settings["LowerOne"]
+            uo = settings["UpperOne"]
+            uz = settings["UpperZero"]
+
+            def curve(values):
+                return numpy.select([values < lz, values < lo, values <= uo,
+                                     values < uz],
+                                    [0, (values - lz) / (lo - lz), 1,
+                                     (uz - values) / (uz - uo)], 0) * multiply
+        else:
+            return None
+        if settings["Invert"]:
+            return lambda values: -curve(values) + 1
+        return curve
+
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicMATH(Neuron):
     """returns the values added/subtracted/multiplied/divided together"""
 
+    __slots__ = ()
+
     def core(self, inps, settings):
         result = {}
         for into in inps:
@@ -294,10 +530,45 @@ class LogicMATH(Neuron):
                     result[i] = settings["num1"]
         return result
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        num1 = const(settings["num1"])
+        operators = {"add": "+", "sub": "-", "mul": "*", "div": "/"}
+        if settings["operation"] in operators:
+            value = "v {} {}".format(operators[settings["operation"]], num1)
+        elif settings["operation"] == "set":
+            value = num1
+        else:
+            return ["out = {}"]
+        return ["out = {k: " + value + " for into in inps for k, v in into.items()}"]
+
+    @staticmethod
+    def batch(template):
+        settings = template.settings
+        num1 = settings["num1"]
+        if settings["operation"] == "add":
+            return lambda values: values + num1
+        elif settings["operation"] == "sub":
+            return lambda values: values - num1
+        elif settings["operation"] == "mul":
+            return lambda values: values * num1
+        elif settings["operation"] == "div" and num1 != 0:
+            return lambda values: values / num1
+        elif settings["operation"] == "set":
+            return lambda values: numpy.full(len(values), num1, dtype=float)
+        return None
+
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicAND(Neuron):
     """returns the values multiplied together"""
 
+    __slots__ = ()
+
     def core(self, inps, settings):
         results = {}
         for into in inps:
@@ -323,17 +594,51 @@ class LogicAND(Neuron):
                         total *= v
                 else:  # Method == "MIN"
                     total = min(results.values()) if len(results) > 0 else 0
-                return {"None": total}
+                return scalar(total)
             else:
                 return results
         else:
             return {}
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        lines = ["out = {}",
+                 "for into in inps:",
+                 "    for k, v in into.items():",
+                 "        if k in out:"]
+        if settings["Method"] == "MUL":
+            lines.append("            out[k] *= v")
+        else:
+            lines.append("            out[k] = min(out[k], v)")
+        if settings["IncludeAll"]:
+            lines += ["        elif all(k in intoB for intoB in inps):",
+                      "            out[k] = v"]
+        else:
+            lines += ["        else:",
+                      "            out[k] = v"]
+        if settings["SingleOutput"]:
+            lines.append("if len(out) > 0:")
+            if settings["Method"] == "MUL":
+                lines += ["    total = 1",
+                          "    for v in out.values():",
+                          "        total *= v"]
+            else:
+                lines.append("    total = min(out.values())")
+            lines.append("    out = scalar(total)")
+        return lines
+
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicOR(Neuron):
     """If any of the values are high return a high value
     1 - ((1-a) * (1-b) * (1-c)...)"""
 
+    __slots__ = ()
+
     def core(self, inps, settings):
         if settings["SingleOutput"]:
             if settings["Method"] == "MUL":
@@ -363,10 +668,42 @@ class LogicOR(Neuron):
             results.update((k, 1 - v) for k, v in results.items())
             return results
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        if settings["SingleOutput"]:
+            if settings["Method"] == "MUL":
+                return ["total = 1",
+                        "for into in inps:",
+                        "    for v in into.values():",
+                        "        total *= (1 - v)",
+                        "out = scalar(1 - total)"]
+            return ["total = 0",
+                    "for into in inps:",
+                    "    total = max(list(into.values()) + [total])",
+                    "out = scalar(total)"]
+        lines = ["combined = {}",
+                 "for into in inps:",
+                 "    for k, v in into.items():",
+                 "        if k in combined:"]
+        if settings["Method"] == "MUL":
+            lines.append("            combined[k] *= (1 - v)")
+        else:
+            lines.append("            combined[k] = min(1 - combined[k], 1 - v)")
+        return lines + ["        else:",
+                        "            combined[k] = (1 - v)",
+                        "out = {k: 1 - v for k, v in combined.items()}"]
+
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicNOT(Neuron):
     """Flip the logic state"""
 
+    __slots__ = ()
+
     def core(self, inps, settings):
         result = {}
         for into in inps:
@@ -374,9 +711,23 @@ class LogicNOT(Neuron):
                 result[i] = -into[i] + 1
         return result
 
+    @staticmethod
+    def source(template, const):
+        return ["out = {k: -v + 1 for into in inps for k, v in into.items()}"]
+
+    @staticmethod
+    def batch(template):
+        return lambda values: -values + 1
+
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicSTRONG(Neuron):
     """Make 1's and 0's stronger"""
+
+    __slots__ = ()
     # https://www.desmos.com/calculator/izfhogpchr
 
     def core(self, inps, settings):
@@ -386,9 +737,23 @@ class LogicSTRONG(Neuron):
                 results[i] = into[i]**2 * (-2 * into[i] + 3)
         return results
 
+    @staticmethod
+    def source(template, const):
+        return ["out = {k: v**2 * (-2 * v + 3) for into in inps for k, v in into.items()}"]
+
+    @staticmethod
+    def batch(template):
+        return lambda values: values**2 * (-2 * values + 3)
+
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicWEAK(Neuron):
     """Make 1's and 0's stronger"""
+
+    __slots__ = ()
     # https://www.desmos.com/calculator/izfhogpchr
 
     def core(self, inps, settings):
@@ -398,11 +763,26 @@ class LogicWEAK(Neuron):
                 results[i] = 2 * into[i] - (into[i]**2 * (-2 * into[i] + 3))
         return results
 
+    @staticmethod
+    def source(template, const):
+        return ["out = {k: 2 * v - (v**2 * (-2 * v + 3)) for into in inps for k, v in into.items()}"]
+
+    @staticmethod
+    def batch(template):
+        return lambda values: 2 * values - (values**2 * (-2 * values + 3))
+
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicSETTAG(Neuron):
     """If any of the inputs are above the Threshold level add or remove the
     Tag from the agents tags"""
 
+    __slots__ = ()
+    hasSideEffects = True
+
     def core(self, inps, settings):
         condition = False
         total = 0
@@ -428,10 +808,31 @@ class LogicSETTAG(Neuron):
                     del self.brain.tags[settings["Tag"]]
         return settings["Threshold"]
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        threshold = const(settings["Threshold"])
+        tag = const(settings["Tag"])
+        if settings["Action"] == "ADD":
+            if settings["UseThreshold"]:
+                action = "brain.tags[{}] = 1".format(tag)
+            else:
+                action = "brain.tags[{}] = sum(v for into in inps for v in into.values())".format(tag)
+        else:
+            action = "brain.tags.pop({}, None)".format(tag)
+        if settings["UseThreshold"]:
+            lines = ["if any(v > {} for into in inps for v in into.values()):".format(threshold),
+                     "    " + action]
+        else:
+            lines = [action]
+        return lines + ["out = scalar(" + threshold + ")"]
+
 
 class LogicFILTER(Neuron):
     """Only allow some values through"""
 
+    __slots__ = ()
+
     def core(self, inps, settings):
         result = {}
 
@@ -489,7 +890,7 @@ class LogicFILTER(Neuron):
                             result[i] = into[i]
         elif self.settings["Operation"] == "LEAST":
             leastVal = float("inf")
-            leastName = "None"
+            leastName = SCALAR
             for into in inps:
                 for i in into:
                     if into[i] < leastVal:
@@ -498,7 +899,7 @@ class LogicFILTER(Neuron):
             result = {leastName: leastVal}
         elif self.settings["Operation"] == "MOST":
             mostVal = -float("inf")
-            mostName = "None"
+            mostName = SCALAR
             for into in inps:
                 for i in into:
                     if into[i] > mostVal:
@@ -513,14 +914,58 @@ class LogicFILTER(Neuron):
                     total += into[i]
                     count += 1
             if count != 0:
-                result = {"None": total / count}
+                result = scalar(total / count)
         return result
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        lines = ["out = {}",
+                 "if any(len(into) > 0 for into in inps):"]
+        if settings["Tag"]:
+            lines.append("    tagValue = brain.tags.get({})".format(
+                const(settings["TagName"])))
+            value = "tagValue"
+        else:
+            value = const(settings["Value"])
+        comparisons = {"EQUAL": "==", "NOT EQUAL": "!=",
+                       "LESS": "<=", "GREATER": ">"}
+        operation = settings["Operation"]
+        if operation in comparisons:
+            lines.append("    out = {{k: v for into in inps for k, v in into.items() if v {} {}}}".format(
+                comparisons[operation], value))
+        elif operation in ("LEAST", "MOST"):
+            compare = "<" if operation == "LEAST" else ">"
+            start = "float('inf')" if operation == "LEAST" else "-float('inf')"
+            lines += ["    best = " + start,
+                      "    bestName = SCALAR",
+                      "    for into in inps:",
+                      "        for k, v in into.items():",
+                      "            if v {} best:".format(compare),
+                      "                best = v",
+                      "                bestName = k",
+                      "    out = {bestName: best}"]
+        elif operation == "AVERAGE":
+            lines += ["    values = [v for into in inps for v in into.values()]",
+                      "    if len(values) != 0:",
+                      "        out = scalar(sum(values) / len(values))"]
+        else:
+            lines.append("    pass")
+        return lines
+
+    @staticmethod
+    def invariance(template):
+        if template.settings["Tag"]:
+            return PER_AGENT
+        return STATIC
+
 
 class LogicMAP(Neuron):
     """Map the input from the input range to the output range
     (extrapolates outside of input range)"""
 
+    __slots__ = ()
+
     def core(self, inps, settings):
         result = {}
         if settings["LowerInput"] != settings["UpperInput"]:
@@ -534,10 +979,41 @@ class LogicMAP(Neuron):
                     result[i] = ((uo - lo) / (ui - li)) * (num - li) + lo
         return result
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        li = settings["LowerInput"]
+        ui = settings["UpperInput"]
+        lo = settings["LowerOutput"]
+        uo = settings["UpperOutput"]
+        if li == ui:
+            return ["out = {}"]
+        return ["out = {{k: {} * (v - {}) + {} for into in inps for k, v in into.items()}}".format(
+            const((uo - lo) / (ui - li)), const(li), const(lo))]
+
+    @staticmethod
+    def batch(template):
+        settings = template.settings
+        li = settings["LowerInput"]
+        ui = settings["UpperInput"]
+        lo = settings["LowerOutput"]
+        uo = settings["UpperOutput"]
+        if li == ui:
+            return None
+        scale = (uo - lo) / (ui - li)
+        return lambda values: scale * (values - li) + lo
+
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicOUTPUT(Neuron):
     """Sets an agents output. (Has to be picked up in cm_agents.Agents)"""
 
+    __slots__ = ()
+    hasSideEffects = True
+
     def core(self, inps, settings):
         preferences = bpy.context.user_preferences.addons[__package__].preferences
         val = 0
@@ -580,10 +1056,45 @@ class LogicOUTPUT(Neuron):
             self.brain.outvars[settings["Output"]] = out
         return out
 
+    @staticmethod
+    def source(template, const):
+        settings = template.settings
+        multiInputType = settings["MultiInputType"]
+        if multiInputType == "AVERAGE":
+            lines = ["values = [v for into in inps for v in into.values()]",
+                     "o = sum(values) / max(1, len(values))"]
+        elif multiInputType == "MAX":
+            lines = ["o = 0",
+                     "for into in inps:",
+                     "    for v in into.values():",
+                     "        if abs(v) > abs(o):",
+                     "            o = v"]
+        elif multiInputType == "SIZEAVERAGE":
+            lines = ["Sm = 0",
+                     "SmSquared = 0",
+                     "for into in inps:",
+                     "    for v in into.values():",
+                     "        Sm += v",
+                     "        SmSquared += v * abs(v)",
+                     "o = 0 if Sm == 0 else SmSquared / Sm"]
+        elif multiInputType == "SUM":
+            lines = ["o = sum(v for into in inps for v in into.values())"]
+        else:
+            return None
+        if settings["Output"] == "sk":
+            lines.append('brain.outvars["sk"][{}] = o'.format(
+                const(settings["SKName"])))
+        else:
+            lines.append("brain.outvars[{}] = o".format(
+                const(settings["Output"])))
+        return lines + ["out = scalar(o)"]
+
 
 class LogicPRIORITY(Neuron):
     """Combine inputs by priority"""
 
+    __slots__ = ()
+
     def core(self, inps, settings):
         result = {}
         remaining = {}
@@ -618,28 +1129,36 @@ class LogicPRIORITY(Neuron):
                 result[key] += settings["defaultValue"] * rem
         return result
 
+    @staticmethod
+    def invariance(template):
+        return STATIC
+
 
 class LogicPRINT(Neuron):
     """print everything that is given to it"""
 
+    __slots__ = ()
+    hasSideEffects = True
+
     def core(self, inps, settings):
-        selected = [o.name for o in bpy.context.selected_objects]
+        selected = [o.name for o in getattr(bpy.context, "selected_objects", [])]
         if self.brain.userid in selected:
+            keyName = self.brain.sim.state.keyName
             for into in inps:
                 for i in into:
                     if settings["save_to_file"]:
                         with open(os.path.join(settings["output_filepath"], "CrowdMasterOutput.txt"), "a") as output:
                             message = settings["Label"] + " >> " + \
-                                str(i) + " " + str(into[i]) + "\n"
+                                str(keyName(i)) + " " + str(into[i]) + "\n"
                             output.write(message)
                     else:
                         logger.info("{} >> {} {}".format(
-                            settings["Label"], i, into[i]))
+                            settings["Label"], keyName(i), into[i]))
         return 0
 
 
 class LogicAction(Neuron):
-    pass
+    __slots__ = ()
 
 
 logictypes = OrderedDict([
@@ -663,17 +1182,33 @@ logictypes = OrderedDict([
 class StateSTART(State):
     """Points to the first state for the agent to be in"""
 
+    __slots__ = ()
+
+    def setup(self):
+        self.length = self.brain.rng.randint(self.brain.sim.framelast,
+                                             self.name,
+                                             self.settings["minRandWait"],
+                                             self.settings["maxRandWait"])
+
     def moveTo(self):
-        self.length = random.randint(self.settings["minRandWait"],
-                                     self.settings["maxRandWait"])
+        self.length = self.brain.rng.randint(self.brain.sim.framelast,
+                                             self.name,
+                                             self.settings["minRandWait"],
+                                             self.settings["maxRandWait"])
         State.moveTo(self)
 
 
 class StateAction(State):
     """The normal state in a state machine"""
 
+    # The attributes from ActionState.getSettings and the current action
+    __slots__ = ("actionName", "useValueOfSpeed", "interuptState",
+                 "syncState", "randomActionFromGroup", "action",
+                 "currentAction", "strip")
+
     def __init__(self, *args, **kwargs):
         self.action = None
+        self.currentAction = None
         self.strip = None
         State.__init__(self, *args, **kwargs)
 
@@ -693,7 +1228,7 @@ class StateAction(State):
             tr = obj.animation_data.nla_tracks.new()  # NLA track
             action = actionobj.action  # bpy action
             if action:
-                currentFrame = bpy.context.scene.frame_current
+                currentFrame = self.brain.sim.framelast
                 startTime = currentFrame - self.settings["Overlap"]
                 self.strip = tr.strips.new("", startTime, action)
                 self.strip.extrapolation = 'NOTHING'
@@ -703,6 +1238,32 @@ class StateAction(State):
 
         self.currentAction = self.action
 
+    def snapshot(self):
+        data = State.snapshot(self)
+        data["action"] = self.action
+        data["currentAction"] = self.currentAction
+        # The strip is stored as the names of the NLA track and strip
+        data["strip"] = None
+        if self.strip is not None:
+            obj = bpy.context.scene.objects[self.brain.userid]
+            for track in obj.animation_data.nla_tracks:
+                for strip in track.strips:
+                    if strip == self.strip:
+                        data["strip"] = (track.name, strip.name)
+        return data
+
+    def restore(self, data):
+        State.restore(self, data)
+        self.action = data["action"]
+        self.currentAction = data["currentAction"]
+        self.strip = None
+        if data["strip"] is not None:
+            trackName, stripName = data["strip"]
+            obj = bpy.context.scene.objects[self.brain.userid]
+            track = obj.animation_data.nla_tracks.get(trackName)
+            if track is not None:
+                self.strip = track.strips.get(stripName)
+
     def evaluate(self):
         act = self.actionName
         if self.syncState:
@@ -719,13 +1280,18 @@ class StateAction(State):
 
             sm = self.brain.sim.syncManager
             userid = self.brain.userid
-
-            for inp in self.valueInputs:
-                vals = self.neurons[inp].evaluate()
-                for key, v in vals.items():
+            rng = self.brain.rng
+            frame = self.brain.sim.framelast
+
+            results = self.brain.results
+            keyName = self.brain.sim.state.keyName
+            for inp, slot in zip(self.valueInputs, self.valueInputSlots):
+                vals = results[slot]
+                for row, v in vals.items():
+                    key = keyName(row)
                     if self.settings["RandomInput"]:
-                        val = v + (self.settings["ValueDefault"] *
-                                   v * random.random())
+                        rand = rng.random(frame, (self.name, inp, key))
+                        val = v + (self.settings["ValueDefault"] * v * rand)
                     else:
                         val = v + (v * self.settings["ValueDefault"])
                     if val > 0:
@@ -748,12 +1314,12 @@ class StateAction(State):
         elif self.isGroup():
             State.evaluate(self)
             acNm = self.actionName
-            state = random.getstate()
-            if not self.randomActionFromGroup:
-                random.seed(hash(self.brain.userid))
-            self.action = random.choice(
-                self.brain.sim.actionGroups[acNm[1:-1]])
-            random.setstate(state)
+            if self.randomActionFromGroup:
+                frame = self.brain.sim.framelast
+            else:
+                frame = CONSTANT
+            self.action = self.brain.rng.choice(
+                frame, self.name, self.brain.sim.actionGroups[acNm[1:-1]])
         else:
             State.evaluate(self)
             self.action = self.actionName
@@ -769,17 +1335,16 @@ class StateAction(State):
         else:
             complete = self.currentFrame / self.length
             complete = 0.5 + complete / 2
-        currentFrame = bpy.context.scene.frame_current
-        self.resultLog[currentFrame] = (0.15, 0.4, complete)
+        self.complete = complete
 
         if self.currentAction in self.brain.sim.actions:
             actionobj = self.brain.sim.actions[self.currentAction]
+            scale = self.brain.sim.geometry.scale(self.brain.userid)
 
             for data_path, data in actionobj.motiondata.items():
                 x = data[0][self.currentFrame] - data[0][self.currentFrame - 1]
                 y = data[1][self.currentFrame] - data[1][self.currentFrame - 1]
                 z = data[2][self.currentFrame] - data[2][self.currentFrame - 1]
-                scale = bpy.context.scene.objects[self.brain.userid].scale
                 if data_path == "location":
                     self.brain.outvars["px"] += x * scale.x
                     self.brain.outvars["py"] += y * scale.y
@@ -124,6 +124,13 @@ class CMPreferences(AddonPreferences):
         default=True,
     )
 
+    node_color_history = IntProperty(
+        name="Node Color History",
+        description="How many frames of node colors are kept for each selected agent",
+        default=250,
+        min=1,
+    )
+
     prefs_tab_items = [
         ("GEN", "General Settings", "General settings for the addon."),
         ("UPDATE", "Addon Update Settings", "Settings for the addon updater."),
@@ -151,6 +158,7 @@ class CMPreferences(AddonPreferences):
             row = layout.row()
             row.prop(preferences, 'ask_to_save', icon='SAVE_AS')
             row.prop(preferences, 'use_node_color', icon='COLOR')
+            row.prop(preferences, 'node_color_history')
 
             row = layout.row()
             if preferences.use_custom_icons:
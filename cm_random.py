@@ -0,0 +1,96 @@
+# Copyright 2017 CrowdMaster Developer Team
+#
+# ##### BEGIN GPL LICENSE BLOCK ######
+# This file is part of CrowdMaster.
+#
+# CrowdMaster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CrowdMaster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
+# ##### END GPL LICENSE BLOCK #####
+
+import unittest
+import zlib
+
+MASK = 0xFFFFFFFFFFFFFFFF
+GOLDEN = 0x9E3779B97F4A7C15
+
+# Frame used for numbers that stay the same for the whole simulation
+CONSTANT = -1
+
+_keys = {}
+
+
+def mix(x):
+    """The splitmix64 finaliser. Maps a 64 bit int to a well distributed
+    64 bit int."""
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & MASK
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EB & MASK
+    return x ^ (x >> 31)
+
+
+def key(value):
+    """A stable 32 bit key for a value (hash() of a str is different every
+    time Blender is started so can't be used)"""
+    if value not in _keys:
+        _keys[value] = zlib.crc32(str(value).encode("utf-8"))
+    return _keys[value]
+
+
+class RandomStream:
+    """Random numbers for a single agent.
+
+    There is no state to seed or advance, each number is a pure function of
+    (agent, frame, node) so the results don't depend on the order that the
+    agents or nodes are evaluated in."""
+
+    def __init__(self, userid):
+        self.seed = mix(key(userid))
+
+    def _bits(self, frame, node):
+        x = mix((self.seed + GOLDEN * (frame & MASK)) & MASK)
+        return mix(x ^ key(node))
+
+    def random(self, frame, node):
+        """Returns a number in the range 0-1 for this node on this frame"""
+        return (self._bits(frame, node) >> 11) * (1.0 / 9007199254740992)
+
+    def randint(self, frame, node, a, b):
+        """Returns an int in the range a-b (inclusive)"""
+        return a + int(self.random(frame, node) * (b - a + 1))
+
+    def choice(self, frame, node, seq):
+        """Returns an item from the non-empty sequence seq"""
+        return seq[int(self.random(frame, node) * len(seq))]
+
+
+class RandomStreamTestCase(unittest.TestCase):
+    def testReproducible(self):
+        a = RandomStream("Agent.001")
+        b = RandomStream("Agent.001")
+        first = [a.random(f, "Noise") for f in range(10)]
+        # Drawing in a different order gives the same numbers
+        second = [b.random(f, "Noise") for f in reversed(range(10))]
+        self.assertEqual(first, list(reversed(second)))
+
+    def testIndependent(self):
+        a = RandomStream("Agent.001")
+        b = RandomStream("Agent.002")
+        self.assertNotEqual(a.random(1, "Noise"), b.random(1, "Noise"))
+        self.assertNotEqual(a.random(1, "Noise"), a.random(2, "Noise"))
+        self.assertNotEqual(a.random(1, "Noise"), a.random(1, "State"))
+
+    def testRange(self):
+        a = RandomStream("Agent.001")
+        for f in range(1000):
+            self.assertTrue(0 <= a.random(f, "Noise") < 1)
+            self.assertTrue(3 <= a.randint(f, "Start", 3, 7) <= 7)
+            self.assertIn(a.choice(f, "Group", ["x", "y"]), ["x", "y"])
@@ -0,0 +1,401 @@
+# Copyright 2017 CrowdMaster Developer Team
+#
+# ##### BEGIN GPL LICENSE BLOCK ######
+# This file is part of CrowdMaster.
+#
+# CrowdMaster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CrowdMaster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
+# ##### END GPL LICENSE BLOCK #####
+
+"""An on disk cache of the output of the simulation.
+
+A cache is made of three files:
+    path           - The frames, appended in the order they are simulated.
+                     Each is the location and rotation of every agent as
+                     float32 followed by the shape keys and tags as JSON.
+    path.index     - A record of (frame, offset, transform bytes, JSON bytes)
+                     for each frame in the data file.
+    path.json      - The names of the agents (in the order of the rows of
+                     the transforms), the agents with frozen animation,
+                     the objects with shape keys and the bones rotated by
+                     the tags of each agent (see Agent.modifyBones).
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import bpy
+import numpy
+
+from .cm_agentState import AgentState
+
+logger = logging.getLogger("CrowdMaster")
+
+CACHE_VERSION = 2
+
+INDEX_RECORD = struct.Struct("<iQII")
+
+"""The index in rotation_euler of each attribute of Agent.modifyBones"""
+BONE_AXES = {"RX": 0, "RY": 1, "RZ": 2}
+
+
+class SimCacheWriter:
+    """Appends the frames of a running simulation to the cache"""
+
+    def __init__(self, path, sim, resumeFrame=None):
+        """
+        :param resumeFrame: Keep the frames up to and including this one
+            from an existing cache and append after them. If None the cache
+            is overwritten.
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.names = sim.state.names[:sim.state.count]
+        # Moved by their own animation so their rows aren't replayed
+        self.frozen = [name for name in self.names
+                       if sim.agents[name].freezeAnimation]
+        self.frames = set()
+
+        offset = 0
+        if resumeFrame is not None and os.path.exists(path + ".index"):
+            with open(path + ".index", "rb") as f:
+                index = f.read()
+            kept = []
+            for frame, off, nT, nE in INDEX_RECORD.iter_unpack(index):
+                if frame <= resumeFrame:
+                    kept.append((frame, off, nT, nE))
+                    offset = max(offset, off + nT + nE)
+                    self.frames.add(frame)
+            self.data = open(path, "r+b")
+            self.data.truncate(offset)
+            self.data.seek(offset)
+            self.index = open(path + ".index", "wb")
+            for record in kept:
+                self.index.write(INDEX_RECORD.pack(*record))
+        else:
+            self.data = open(path, "wb")
+            self.index = open(path + ".index", "wb")
+
+        shapeKeyObjects = {}
+        for name in self.names:
+            agent = sim.agents[name]
+            objs = []
+            if agent.geoGroup is None or agent.geoGroup == "":
+                grpObjs = [bpy.data.objects[name]]
+            else:
+                grpObjs = bpy.data.groups[agent.geoGroup].objects
+            for cobj in grpObjs:
+                if cobj.type == 'MESH' and cobj.data.shape_keys is not None:
+                    objs.append(cobj.name)
+            if objs:
+                shapeKeyObjects[name] = objs
+        bones = {}
+        for name in self.names:
+            agent = sim.agents[name]
+            if agent.freezeAnimation or not agent.modifyBones:
+                continue
+            modArm = agent.modifiedArmature()
+            if modArm is not None:
+                bones[name] = {"armature": modArm.name,
+                               "bones": agent.modifyBones}
+        with open(path + ".json", "w") as f:
+            json.dump({"version": CACHE_VERSION,
+                       "agents": self.names,
+                       "frozen": self.frozen,
+                       "shapeKeyObjects": shapeKeyObjects,
+                       "bones": bones}, f)
+        self.offset = offset
+
+    def write(self, frame, sim):
+        """Append the current state of the simulation as frame"""
+        state = sim.state
+        n = len(self.names)
+        transforms = numpy.empty((n, 6), dtype=numpy.float32)
+        transforms[:, :3] = state.position[:n]
+        transforms[:, 3:] = state.rotation[:n]
+        tBytes = transforms.tobytes()
+
+        extra = {}
+        for name in self.names:
+            agent = sim.agents[name]
+            if agent.shapeKeys or agent.access["tags"]:
+                extra[name] = {"sk": agent.shapeKeys,
+                               "tags": agent.access["tags"]}
+        eBytes = json.dumps(extra).encode("utf-8")
+
+        self.data.write(tBytes)
+        self.data.write(eBytes)
+        self.index.write(INDEX_RECORD.pack(frame, self.offset, len(tBytes),
+                                           len(eBytes)))
+        self.offset += len(tBytes) + len(eBytes)
+        self.frames.add(frame)
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class SimCacheReader:
+    """Random access to the frames of a cache through a memory map"""
+
+    def __init__(self, path):
+        with open(path + ".json") as f:
+            header = json.load(f)
+        if header["version"] != CACHE_VERSION:
+            raise ValueError("Simulation cache {} was written by an "
+                             "incompatible version of CrowdMaster".format(path))
+        self.names = header["agents"]
+        self.frozen = set(header["frozen"])
+        self.shapeKeyObjects = header["shapeKeyObjects"]
+        self.bones = header["bones"]
+
+        self.frames = {}  # {frame: (offset, transform bytes, JSON bytes)}
+        with open(path + ".index", "rb") as f:
+            for frame, off, nT, nE in INDEX_RECORD.iter_unpack(f.read()):
+                self.frames[frame] = (off, nT, nE)
+
+        self.file = open(path, "rb")
+        if os.path.getsize(path) > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = None
+
+    def transforms(self, frame):
+        """The location (columns 0-2) and rotation (3-5) of each agent
+
+        :rtype: numpy.ndarray | None"""
+        if frame not in self.frames or self.map is None:
+            return None
+        off, nT, nE = self.frames[frame]
+        return numpy.frombuffer(self.map, dtype=numpy.float32,
+                                count=nT // 4, offset=off).reshape(-1, 6)
+
+    def extra(self, frame):
+        """The shape keys and tags of the agents that have any
+
+        :rtype: {str: {"sk": {str: float}, "tags": {str: float}}}"""
+        if frame not in self.frames or self.map is None:
+            return {}
+        off, nT, nE = self.frames[frame]
+        return json.loads(self.map[off + nT:off + nT + nE].decode("utf-8"))
+
+    def apply(self, scene, frame):
+        """Set the agents in the scene to how they were on frame"""
+        transforms = self.transforms(frame)
+        if transforms is None:
+            return
+        objs = scene.objects
+        for row, name in enumerate(self.names):
+            if name in self.frozen:
+                continue
+            obj = objs.get(name)
+            if obj is not None:
+                obj.location = transforms[row, :3]
+                obj.rotation_euler = transforms[row, 3:]
+        for name, values in self.extra(frame).items():
+            if name in self.frozen:
+                continue
+            for objName in self.shapeKeyObjects.get(name, ()):
+                keyBlocks = bpy.data.objects[objName].data.shape_keys.key_blocks
+                for skNm, value in values["sk"].items():
+                    sk = keyBlocks.get(skNm)
+                    if sk is not None:
+                        sk.value = value
+            if name in self.bones:
+                self.applyBones(objs, self.bones[name], values["tags"])
+
+    def applyBones(self, objs, bones, tags):
+        """Rotate the bones of an agent by its tags the way Agent.apply does.
+        The bones aren't keyframed in the None keyframe mode so they are
+        only set by replay."""
+        modArm = objs.get(bones["armature"])
+        if modArm is None:
+            return
+        for bone, attributes in bones["bones"].items():
+            boneObj = modArm.pose.bones.get(bone)
+            if boneObj is None:
+                continue
+            for attribute, tag in attributes.items():
+                if tag in tags and attribute in BONE_AXES:
+                    boneObj.rotation_euler[BONE_AXES[attribute]] = tags[tag]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+_replay = None  # type: SimCacheReader | None
+
+
+@bpy.app.handlers.persistent
+def replayLoadHandler(dummy):
+    """Stop replaying before another file is loaded. Blender removes the
+    frame change handler but the cache would otherwise stay open."""
+    stopReplay()
+
+
+def replayFrameHandler(scene):
+    """Set the agents from the cache whenever the frame changes"""
+    if _replay is not None:
+        _replay.apply(scene, scene.frame_current)
+
+
+def startReplay(scene):
+    """Start setting the agents from the cache of scene"""
+    global _replay
+    stopReplay()
+    _replay = SimCacheReader(bpy.path.abspath(scene.cm_sim_cache_path))
+    if replayFrameHandler not in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.append(replayFrameHandler)
+    replayFrameHandler(scene)
+
+
+def stopReplay():
+    global _replay
+    if replayFrameHandler in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.remove(replayFrameHandler)
+    if _replay is not None:
+        _replay.close()
+        _replay = None
+
+
+class SimCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.cmcache")
+        self.objects = []
+        self.agents = {}
+        state = AgentState()
+        for row, frozen in enumerate((False, True)):
+            name = "CacheTestAgent.{:03d}".format(row)
+            obj = bpy.data.objects.new(name, None)
+            bpy.context.scene.objects.link(obj)
+            self.objects.append(obj)
+            state.add(obj.name, (row, 0, 0), (0, 0, 0), (1, 1, 1), (1, 1, 1))
+            self.agents[obj.name] = SimpleNamespace(
+                index=row, freezeAnimation=frozen, geoGroup="",
+                modifyBones={}, shapeKeys={}, access={"tags": {}})
+
+        # An agent with a bone rotated by its "Turn" tag
+        rig = bpy.data.objects.new("CacheTestRig",
+                                   bpy.data.armatures.new("CacheTestRig"))
+        bpy.context.scene.objects.link(rig)
+        bpy.context.scene.objects.active = rig
+        bpy.ops.object.mode_set(mode='EDIT')
+        bone = rig.data.edit_bones.new("Bone")
+        bone.tail = (0, 0, 1)
+        bpy.ops.object.mode_set(mode='OBJECT')
+        self.objects.append(rig)
+        state.add(rig.name, (2, 0, 0), (0, 0, 0), (1, 1, 1), (1, 1, 1))
+        self.agents[rig.name] = SimpleNamespace(
+            index=2, freezeAnimation=False, geoGroup="",
+            modifyBones={"Bone": {"RZ": "Turn"}},
+            modifiedArmature=lambda: rig,
+            shapeKeys={}, access={"tags": {"Turn": 0.0}})
+        self.sim = SimpleNamespace(state=state, agents=self.agents)
+
+    def tearDown(self):
+        for obj in self.objects:
+            bpy.context.scene.objects.unlink(obj)
+            bpy.data.objects.remove(obj)
+        self.directory.cleanup()
+
+    def writeFrames(self, frames, resumeFrame=None, offset=0.0):
+        """Write frames where agent row is at (frame + offset, row, 0) and
+        the rig has turned by frame / 10"""
+        writer = SimCacheWriter(self.path, self.sim, resumeFrame)
+        for frame in frames:
+            for row in range(3):
+                self.sim.state.position[row] = (frame + offset, row, 0)
+            self.agents[self.objects[2].name].access["tags"]["Turn"] = \
+                frame / 10
+            writer.write(frame, self.sim)
+        writer.close()
+
+    def testRoundTrip(self):
+        self.writeFrames(range(1, 6))
+        reader = SimCacheReader(self.path)
+        try:
+            # In any order
+            for frame in (4, 1, 5, 2, 3):
+                transforms = reader.transforms(frame)
+                self.assertEqual(transforms.shape, (3, 6))
+                for row in range(3):
+                    self.assertEqual(tuple(transforms[row, :3]),
+                                     (frame, row, 0))
+                self.assertEqual(reader.extra(frame),
+                                 {self.objects[2].name: {
+                                     "sk": {}, "tags": {"Turn": frame / 10}}})
+            self.assertIsNone(reader.transforms(6))
+            self.assertEqual(reader.extra(6), {})
+        finally:
+            reader.close()
+
+    def testResume(self):
+        self.writeFrames(range(1, 6))
+        # Frames 4 and 5 are simulated again differently
+        self.writeFrames(range(4, 6), resumeFrame=3, offset=100)
+        reader = SimCacheReader(self.path)
+        try:
+            self.assertEqual(set(reader.frames), {1, 2, 3, 4, 5})
+            self.assertEqual(tuple(reader.transforms(3)[0, :3]), (3, 0, 0))
+            self.assertEqual(tuple(reader.transforms(4)[0, :3]), (104, 0, 0))
+            self.assertEqual(tuple(reader.transforms(5)[0, :3]), (105, 0, 0))
+        finally:
+            reader.close()
+        self.assertEqual(os.path.getsize(self.path + ".index"),
+                         5 * INDEX_RECORD.size)
+
+    def testBones(self):
+        self.writeFrames(range(1, 4))
+        rig = self.objects[2]
+        reader = SimCacheReader(self.path)
+        try:
+            reader.apply(bpy.context.scene, 2)
+            self.assertAlmostEqual(rig.pose.bones["Bone"].rotation_euler[2],
+                                   0.2)
+            reader.apply(bpy.context.scene, 3)
+            self.assertAlmostEqual(rig.pose.bones["Bone"].rotation_euler[2],
+                                   0.3)
+        finally:
+            reader.close()
+
+    def testFrozenAgent(self):
+        writer = SimCacheWriter(self.path, self.sim)
+        self.sim.state.position[:2] = ((4, 5, 6), (7, 8, 9))
+        writer.write(1, self.sim)
+        writer.close()
+
+        moved, frozen = self.objects[:2]
+        frozen.location = (-1, -2, -3)
+        reader = SimCacheReader(self.path)
+        try:
+            reader.apply(bpy.context.scene, 1)
+        finally:
+            reader.close()
+        self.assertEqual(tuple(moved.location), (4, 5, 6))
+        self.assertEqual(tuple(frozen.location), (-1, -2, -3))
@@ -18,27 +18,98 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import logging
+import os
+import pickle
+import sys
 import time
+import unittest
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import bpy
+import numpy
 
 from . import cm_channels as chan
 from . import cm_timings
 from .cm_actions import getmotions
 from .cm_agent import Agent
+from .cm_agentState import AgentState, Geometry
+from .cm_batchBrain import evaluateBatched
+from .cm_keyframes import KeyframeBuffer
+from .cm_neighbours import NeighbourIndex
+from .cm_simCache import SimCacheWriter
 from .cm_syncManager import syncManager
 
 logger = logging.getLogger("CrowdMaster")
 
+SNAPSHOT_VERSION = 2
+
+"""How often the brains of the agents of a group are evaluated (see
+Simulation.scheduled)"""
+LevelOfDetail = namedtuple("LevelOfDetail", ["midDistance", "midRate",
+                                             "farDistance", "farRate",
+                                             "actionRate"])
+
+
+def snapshotPath(scene, frame):
+    """The file that the snapshot of frame is saved to"""
+    directory = bpy.path.abspath(scene.cm_snapshot_directory)
+    return os.path.join(directory, "snapshot_{:06d}.cmsnap".format(frame))
+
+
+def findSnapshot(scene, frame):
+    """Find the latest snapshot saved on or before frame
+
+    :returns: The frame of the snapshot and the path to it
+    :rtype: (int, str) | None"""
+    directory = bpy.path.abspath(scene.cm_snapshot_directory)
+    if not os.path.isdir(directory):
+        return None
+    best = None
+    for fileName in os.listdir(directory):
+        name, ext = os.path.splitext(fileName)
+        if ext != ".cmsnap" or not name.startswith("snapshot_"):
+            continue
+        try:
+            snapFrame = int(name[len("snapshot_"):])
+        except ValueError:
+            continue
+        if snapFrame <= frame and (best is None or snapFrame > best[0]):
+            best = (snapFrame, os.path.join(directory, fileName))
+    return best
+
 
 class Simulation:
     """The object that contains everything once the simulation starts"""
 
-    def __init__(self):
+    def __init__(self, resumeFrame=None):
+        """
+        :param resumeFrame: The frame of the snapshot that will be loaded
+            with self.loadSnapshot. When set the existing animation of the
+            agents isn't cleared when they are created.
+        """
         preferences = bpy.context.user_preferences.addons[__package__].preferences
         self.agents = {}
-        self.framelast = bpy.context.scene.cm_sim_start_frame
+        self.state = AgentState()
+        self.geometry = Geometry(self)
+        self.neighbours = NeighbourIndex(self)
+        self.resumeFrame = resumeFrame
+        if resumeFrame is None:
+            self.framelast = bpy.context.scene.cm_sim_start_frame
+        else:
+            self.framelast = resumeFrame
         self.compbrains = {}
+        # The agents whose brains record their outputs for the node colours
+        # (see Brain.record). Set to the selected objects on each frame.
+        self.debugAgents = set()
+        if bpy.context.scene.cm_keyframe_mode == "BULK":
+            self.keyframes = KeyframeBuffer()
+        else:
+            self.keyframes = None
+        self.writeKeyframes = bpy.context.scene.cm_keyframe_mode != "NONE"
+        self.cache = None  # Opened on the first frame. See self.writeCache
+        self.pool = None  # See self.workerPool
+        self.workerCount = 1
         Noise = chan.Noise(self)
         Sound = chan.Sound(self)
         State = chan.State(self)
@@ -87,32 +158,42 @@ class Simulation:
                     self.syncManager.actionPair(t, s)
 
     def newagent(self, name, brain, rigOverwrite, constrainBone, initialTags,
-                 modifyBones, freezeAnimation, geoGroup):
+                 modifyBones, freezeAnimation, geoGroup, lod=None):
         """Set up an agent"""
         nGps = bpy.data.node_groups
         preferences = bpy.context.user_preferences.addons[__package__].preferences
         if brain in nGps and nGps[brain].bl_idname == "CrowdMasterTreeType":
             ag = Agent(name, nGps[brain], self, rigOverwrite, constrainBone,
                        tags=initialTags, modifyBones=modifyBones,
-                       freezeAnimation=freezeAnimation, geoGroup=geoGroup)
+                       freezeAnimation=freezeAnimation, geoGroup=geoGroup,
+                       lod=lod)
             self.agents[name] = ag
         else:
             logger.debug("No such brain type: {}".format(brain))
 
     def createAgents(self, group):
         """Set up all the agents at the beginning of the simulation"""
+        lod = None
+        if group.useLOD:
+            lod = LevelOfDetail(group.lodMidDistance, group.lodMidRate,
+                                group.lodFarDistance, group.lodFarRate,
+                                group.lodActionRate)
         for ty in group.agentTypes:
             for ag in ty.agents:
-                self.newagent(ag.name, ty.name, ag.rigOverwrite,
+                # Every impulse keyed by this agent then uses the same string
+                # so looking it up compares by identity rather than contents.
+                # The dense integer id of the agent is its row in self.state.
+                self.newagent(sys.intern(ag.name), ty.name, ag.rigOverwrite,
                               ag.constrainBone, ag.initialTags,
-                              ag.modifyBones, group.freezeAnimation, ag.geoGroup)
+                              ag.modifyBones, group.freezeAnimation, ag.geoGroup,
+                              lod)
 
     def step(self, scene):
         """Called when the next frame is moved to"""
         preferences = bpy.context.user_preferences.addons[__package__].preferences
         if preferences.show_debug_options:
             t = time.time()
-            logger.debug("NEWFRAME {}".format(bpy.context.scene.frame_current))
+            logger.debug("NEWFRAME {}".format(self.framelast))
             if preferences.show_debug_timings:
                 if self.lastFrameTime is not None:
                     between = time.time() - self.lastFrameTime
@@ -128,14 +209,62 @@ class Simulation:
 
         self.syncManager.newFrame()
 
-        for a in self.agents.values():
-            a.step()
+        if scene.cm_sim_cache and self.cache is None:
+            # Also store the frame before the first simulated one
+            self.writeCache(self.framelast - 1)
+
+        selected = getattr(bpy.context, "selected_objects", None) or []
+        self.debugAgents = {obj.name for obj in selected}
+
+        self.geometry.newFrame()
+        self.state.updateTransforms(self.geometry)
+        self.neighbours.newFrame()
+
+        # The neurons with the same output for every agent of a brain
+        for template in self.compbrains.values():
+            template.share(self.framelast)
+
+        results = self.evaluate(self.scheduled())
+        for name, (outvars, tags) in results.items():
+            self.agents[name].store(outvars, tags)
+
+        skipped = None
+        if len(results) < len(self.agents):
+            skipped = numpy.ones(self.state.count, dtype=bool)
+            for name, agent in self.agents.items():
+                if name in results:
+                    skipped[agent.index] = False
+                else:
+                    agent.coast()
+
+        if preferences.show_debug_options and preferences.show_debug_timings:
+            integrateT = time.time()
+        self.state.integrate(skipped)
+        if preferences.show_debug_options and preferences.show_debug_timings:
+            cm_timings.simulation["integrate"] += time.time() - integrateT
+
         for a in self.agents.values():
             a.apply()
         for chan in self.lvars.values():
             chan.newframe()
+
+        if self.cache is not None:
+            self.writeCache(self.framelast)
+
+        if self.keyframes is not None:
+            interval = bpy.context.scene.cm_keyframe_flush_interval
+            if interval > 0:
+                start = bpy.context.scene.cm_sim_start_frame
+                if (self.framelast - start) % interval == 0:
+                    self.keyframes.flush()
+        interval = bpy.context.scene.cm_snapshot_interval
+        if interval > 0:
+            start = bpy.context.scene.cm_sim_start_frame
+            if (self.framelast - start) % interval == 0:
+                self.saveSnapshot()
         if preferences.show_debug_options and preferences.show_debug_timings:
             cm_timings.printTimings()
+            cm_timings.printMemory(self)
             newT = time.time()
             logger.debug("Frame time {}".format(newT - t))
             cm_timings.simulation["total"] += newT - t
@@ -147,6 +276,192 @@ class Simulation:
             logger.debug("spf {}".format(tt / tf))  # seconds per frame
             self.lastFrameTime = time.time()
 
+    def writeCache(self, frame):
+        """Append the current state of the agents to the simulation cache"""
+        if self.cache is None:
+            path = bpy.path.abspath(bpy.context.scene.cm_sim_cache_path)
+            self.cache = SimCacheWriter(path, self, self.resumeFrame)
+        if frame not in self.cache.frames:
+            self.cache.write(frame, self)
+
+    def flushOutput(self):
+        """Write the buffered keyframes, cached frames and compiled brains"""
+        if self.keyframes is not None:
+            self.keyframes.flush()
+        if self.cache is not None:
+            self.cache.flush()
+        for template in self.compbrains.values():
+            template.saveCache()
+
+    def workerPool(self):
+        """The pool of threads that the vectorised parts of the brains are
+        evaluated on in the parallel brain evaluation mode
+
+        :rtype: concurrent.futures.ThreadPoolExecutor | None"""
+        scene = bpy.context.scene
+        if scene.cm_brain_evaluation != "PARALLEL":
+            return None
+        if self.pool is None:
+            self.workerCount = scene.cm_brain_threads or os.cpu_count() or 1
+            self.pool = ThreadPoolExecutor(self.workerCount)
+        return self.pool
+
+    def closePool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def closeCache(self):
+        """Close the files of the simulation cache once the simulation has
+        finished writing to it"""
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def saveSnapshot(self, path=None):
+        """Save everything needed to continue the simulation from the end of
+        the current frame. The random numbers the brains use only depend on
+        the agent and frame so there is no generator state to save.
+
+        :param path: Defaults to snapshotPath for the current frame"""
+        if path is None:
+            path = snapshotPath(bpy.context.scene, self.framelast)
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory)
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "frame": self.framelast,
+            "state": self.state.snapshot(),
+            "agents": {name: ag.snapshot() for name, ag in self.agents.items()},
+            "syncManager": self.syncManager.snapshot(),
+            "formations": self.lvars["Formation"].snapshot()
+        }
+        with open(path, "wb") as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        logger.info("Saved snapshot of frame {} to {}".format(self.framelast,
+                                                              path))
+
+    def loadSnapshot(self, path):
+        """Continue the simulation from a snapshot saved by saveSnapshot.
+        The agents must already have been created. Any animation after the
+        frame of the snapshot is removed."""
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data["version"] != SNAPSHOT_VERSION:
+            raise ValueError("Snapshot {} was saved by an incompatible "
+                             "version of CrowdMaster".format(path))
+        self.framelast = data["frame"]
+        self.state.restore(data["state"])
+        for name, agentData in data["agents"].items():
+            if name in self.agents:
+                self.agents[name].restore(agentData)
+        for agent in self.agents.values():
+            if not agent.freezeAnimation:
+                agent.truncate(self.framelast)
+        self.syncManager.restore(data["syncManager"])
+        self.lvars["Formation"].restore(data["formations"])
+
+    def scheduled(self):
+        """The names of the agents whose brains should be evaluated this
+        frame. Agents in groups with level of detail enabled are evaluated
+        every midRate or farRate frames when they are further than
+        midDistance or farDistance from the scene camera, and every
+        actionRate frames while they are in the middle of a state that can't
+        be interrupted. The frames are staggered between agents. On the
+        frames an agent is skipped it keeps moving with its velocity from
+        the last frame (see Agent.coast), so an agent far from the camera
+        that is at the end of its state can move to the next state a few
+        frames late."""
+        if all(a.lod is None for a in self.agents.values()):
+            return list(self.agents.keys())
+
+        distances = None
+        camera = bpy.context.scene.camera
+        if camera is not None:
+            camLoc = numpy.array(camera.matrix_world.translation)
+            positions = self.state.view("position")
+            distances = numpy.sqrt(((positions - camLoc) ** 2).sum(axis=1))
+
+        due = []
+        for name, agent in self.agents.items():
+            lod = agent.lod
+            if lod is None:
+                due.append(name)
+                continue
+            rate = 1
+            if distances is not None:
+                dist = distances[agent.index]
+                if dist > lod.farDistance:
+                    rate = lod.farRate
+                elif dist > lod.midDistance:
+                    rate = lod.midRate
+            if agent.brain.canCoast() and not agent.brain.isInterruptible():
+                rate = max(rate, lod.actionRate)
+            if (self.framelast + agent.index) % rate == 0:
+                due.append(name)
+        return due
+
+    def evaluate(self, names):
+        """Evaluate the brains of the named agents. Brains only read the
+        state of the simulation from the end of the last frame so any subset
+        of the agents can be evaluated in any order and give the same result.
+
+        :returns: {agent name: (outvars, tags)} to be passed to Agent.store
+        :rtype: Dict[str, (dict, dict)]"""
+        preferences = bpy.context.user_preferences.addons[__package__].preferences
+        timings = preferences.show_debug_options and preferences.show_debug_timings
+        mode = bpy.context.scene.cm_brain_evaluation
+        if mode in ("BATCH", "PARALLEL") and not timings:
+            return evaluateBatched(self, names)
+        return {name: self.agents[name].evaluate() for name in names}
+
+    def run(self, start=None, end=None):
+        """Simulate every frame from start to end (defaults to the simulation
+        start and end frames of the scene). The scene is only moved through
+        the frames if something the agents read follows its own animation
+        (see self.followsAnimation) and is put back on the current frame
+        afterwards. This doesn't need a screen so it can also be used when
+        Blender is running in background mode."""
+        scene = bpy.context.scene
+        if start is None:
+            start = scene.cm_sim_start_frame
+        if end is None:
+            end = scene.cm_sim_end_frame
+        self.framelast = start
+        animated = self.followsAnimation(scene)
+        current = scene.frame_current
+        for frame in range(start + 1, end):
+            if animated:
+                # The frame change handler runs before Blender evaluates the
+                # animation of the new frame so it sees the previous one
+                scene.frame_set(frame - 1)
+            self.framelast = frame
+            self.step(scene)
+        if animated:
+            scene.frame_set(current)
+        self.flushOutput()
+        self.closeCache()
+        self.closePool()
+
+    def followsAnimation(self, scene):
+        """True if any object the channels can read is moved by its own
+        animation: agents with frozen animation and animated objects that
+        aren't agents (targets, event volumes, formation targets, the
+        camera and anything parented to them). Simulation.run then has to
+        move the scene through the frames to keep them up to date."""
+        if any(a.freezeAnimation for a in self.agents.values()):
+            return True
+        for obj in scene.objects:
+            if obj.name in self.agents:
+                continue
+            anim = obj.animation_data
+            if anim is not None and (anim.action is not None or
+                                     len(anim.nla_tracks) > 0 or
+                                     len(anim.drivers) > 0):
+                return True
+        return False
+
     def frameChangeHandler(self, scene):
         """Given to Blender to call whenever the scene moves to a new frame"""
         if bpy.context.scene.cm_sim_end_frame <= bpy.context.scene.frame_current:
@@ -183,3 +498,85 @@ class Simulation:
         if self.frameChangeHandler in bpy.app.handlers.frame_change_pre:
             logger.debug("Unregistering frame change handler")
             bpy.app.handlers.frame_change_pre.remove(self.frameChangeHandler)
+        self.flushOutput()
+        self.closeCache()
+        self.closePool()
+
+
+class BakeTestCase(unittest.TestCase):
+    """Simulation.run must give the same result as the frame change handler
+    when an agent follows the animation of a frozen agent"""
+
+    def setUp(self):
+        bpy.ops.wm.read_homefile()
+        scene = bpy.context.scene
+        scene.cm_sim_start_frame = 1
+        scene.cm_sim_end_frame = 12
+        scene.cm_keyframe_mode = "NONE"
+
+        self.frozen = bpy.data.objects.new("BakeFrozen", None)
+        scene.objects.link(self.frozen)
+        self.frozen.location = (-10, 10, 0)
+        self.frozen.keyframe_insert("location", frame=1)
+        self.frozen.location = (10, 10, 0)
+        self.frozen.keyframe_insert("location", frame=12)
+        self.walker = bpy.data.objects.new("BakeWalker", None)
+        scene.objects.link(self.walker)
+
+        tree = bpy.data.node_groups.new("BakeBrain", "CrowdMasterTreeType")
+        target = tree.nodes.new("NewInputNode")
+        target.InputSource = "WORLD"
+        target.WorldOptions = "TARGET"
+        target.TargetObject = self.frozen.name
+        target.TargetOptions = "RZ"
+        turn = tree.nodes.new("OutputNode")
+        turn.Output = "rz"
+        tree.links.new(target.outputs["Output"], turn.inputs["Input"])
+        speed = tree.nodes.new("NewInputNode")
+        speed.Constant = 0.5
+        move = tree.nodes.new("OutputNode")
+        move.Output = "py"
+        tree.links.new(speed.outputs["Output"], move.inputs["Input"])
+
+        for name, freeze in ((self.frozen.name, True),
+                             (self.walker.name, False)):
+            group = scene.cm_groups.add()
+            group.name = name
+            group.groupType = "manual"
+            group.freezeAnimation = freeze
+            agentType = group.agentTypes.add()
+            agentType.name = tree.name
+            agent = agentType.agents.add()
+            agent.name = name
+
+    def simulation(self):
+        self.walker.location = (0, 0, 0)
+        self.walker.rotation_euler = (0, 0, 0)
+        bpy.context.scene.frame_set(1)
+        sim = Simulation()
+        sim.setupActions()
+        for group in bpy.context.scene.cm_groups:
+            sim.createAgents(group)
+        return sim
+
+    def testFrozenAgent(self):
+        scene = bpy.context.scene
+        sim = self.simulation()
+        self.assertTrue(sim.followsAnimation(scene))
+        sim.run()
+        baked = (tuple(self.walker.location), tuple(self.walker.rotation_euler))
+        self.assertEqual(scene.frame_current, 1)
+
+        sim = self.simulation()
+        sim.startFrameHandler()
+        try:
+            for frame in range(2, scene.cm_sim_end_frame):
+                scene.frame_set(frame)
+        finally:
+            sim.stopFrameHandler()
+        handled = (tuple(self.walker.location),
+                   tuple(self.walker.rotation_euler))
+        for a, b in zip(baked[0] + baked[1], handled[0] + handled[1]):
+            self.assertAlmostEqual(a, b)
+        # The walker turned to follow the frozen agent
+        self.assertNotAlmostEqual(baked[1][2], 0)
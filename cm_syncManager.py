@@ -17,11 +17,13 @@
 # along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
 # ##### END GPL LICENSE BLOCK #####
 
+import pickle
 import unittest
 
 
 class syncManager:
     def __init__(self):
+        self.lastFrame = {}
         self.messages = {}
         # {"source": {"target": {"action": (state, value)}}}
         self.actionPairs = {}
@@ -31,6 +33,17 @@ class syncManager:
         self.lastFrame = self.resolveSync()
         self.messages = {}
 
+    def snapshot(self):
+        """The results of the last frame and the requests that have been
+        made on this frame (see Simulation.saveSnapshot)"""
+        return {"lastFrame": self.lastFrame,
+                "messages": self.messages}
+
+    def restore(self, data):
+        """Load the values returned by self.snapshot"""
+        self.lastFrame = data["lastFrame"]
+        self.messages = data["messages"]
+
     def actionPair(self, action0, action1):
         if action0 not in self.actionPairs:
             self.actionPairs[action0] = []
@@ -178,3 +191,29 @@ class SyncManagerTestCase(unittest.TestCase):
         result = sm.resolveSync()
         self.assertEqual(result, {'y': (('Action.001', 'attack'), 'x'),
                                   'x': (('Action.005', 'death1'), 'y')})
+
+    def testSnapshot(self):
+        def manager():
+            sm = syncManager()
+            sm.actionPair("attack", "defence")
+            sm.actionPair("defence", "attack")
+            return sm
+
+        def tellFrame(sm, frame):
+            sm.tell("x", "y", "attack", 0.5 + frame, "attackState")
+            sm.tell("y", "x", "defence", 0.9, "defenceState")
+
+        uninterrupted = manager()
+        tellFrame(uninterrupted, 0)
+        snapshot = pickle.dumps(uninterrupted.snapshot())
+        uninterrupted.newFrame()
+
+        resumed = manager()
+        resumed.restore(pickle.loads(snapshot))
+        resumed.newFrame()
+
+        for name in ("x", "y", "z"):
+            self.assertEqual(resumed.getResult(name),
+                             uninterrupted.getResult(name))
+        self.assertEqual(resumed.getResult("x"),
+                         (("attackState", "attack"), "y"))
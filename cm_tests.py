@@ -22,6 +22,15 @@ import unittest
 import bpy
 from bpy.types import Operator
 
+from .cm_agentState import AgentStateTestCase
+from .cm_batchBrain import BatchImpulseTestCase, ParallelBatchTestCase
+from .cm_channels.cm_soundChannels import SoundCandidatesTestCase
+from .cm_compileBrain import (BrainCacheTestCase, BrainOptimiseTestCase,
+                              GeneratedSourceTestCase)
+from .cm_neighbours import NeighbourIndexTestCase
+from .cm_random import RandomStreamTestCase
+from .cm_simCache import SimCacheTestCase
+from .cm_simulate import BakeTestCase
 from .cm_syncManager import SyncManagerTestCase
 
 
@@ -55,7 +64,9 @@ class AddonRegisterTestCase(unittest.TestCase):
                     "cm_paths_populate", "cm_paths_remove",
                     "cm_place_deferred_geo", "cm_run_long_tests",
                     "cm_run_short_tests", "cm_save_prefs",
-                    "cm_start", "cm_stop"]
+                    "cm_start", "cm_stop", "cm_bake",
+                    "cm_resume", "cm_snapshot_save",
+                    "cm_cache_replay", "cm_cache_replay_stop"]
         for op in opsProps:
             self.assertIn(op, dir(bpy.ops.scene))
 
@@ -65,12 +76,23 @@ def createShortTestSuite():
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(AddonRegisterTestCase))
     test_suite.addTest(unittest.makeSuite(SyncManagerTestCase))
+    test_suite.addTest(unittest.makeSuite(RandomStreamTestCase))
+    test_suite.addTest(unittest.makeSuite(GeneratedSourceTestCase))
+    test_suite.addTest(unittest.makeSuite(BrainOptimiseTestCase))
+    test_suite.addTest(unittest.makeSuite(BrainCacheTestCase))
+    test_suite.addTest(unittest.makeSuite(BatchImpulseTestCase))
+    test_suite.addTest(unittest.makeSuite(ParallelBatchTestCase))
+    test_suite.addTest(unittest.makeSuite(AgentStateTestCase))
+    test_suite.addTest(unittest.makeSuite(NeighbourIndexTestCase))
+    test_suite.addTest(unittest.makeSuite(SoundCandidatesTestCase))
+    test_suite.addTest(unittest.makeSuite(SimCacheTestCase))
     return test_suite
 
 
 def createLongTestSuite():
     """Gather all the long tests from this module in a test suite"""
     test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(BakeTestCase))
     return test_suite
 
 
@@ -18,6 +18,7 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import logging
+import sys
 from collections import OrderedDict
 
 from .cm_channels import channelTimes
@@ -106,14 +107,10 @@ brain = OrderedDict([
 simulation = OrderedDict([
     ("total", 0),
     ("betweenFrames", 0),
+    ("integrate", 0),
     ("totalFrames", 0)
 ])
 
-neuron = OrderedDict([
-    ("deps", 0),
-    ("sumColour", 0)
-])
-
 coreTimes = OrderedDict([
     ("LogicINPUT", 0),
     ("LogicNEWINPUT", 0),
@@ -167,9 +164,6 @@ def printTimings():
     logger.debug("Simulation")
     for k, v in simulation.items():
         logger.debug("     {} {}".format(k, v))
-    logger.debug("Neuron")
-    for k, v in neuron.items():
-        logger.debug("     {} {}".format(k, v))
     logger.debug("Cores")
     for k, v in coreTimes.items():
         n = coreNumber[k]
@@ -181,3 +175,46 @@ def printTimings():
         for k1 in sorted(v):
             v1 = v[k1]
             logger.debug("          {} {}".format(k1, v1))
+
+
+def objectSize(obj):
+    """The size of an object including its __dict__ if it has one but not
+    the values of its attributes"""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def memoryUsage(sim):
+    """The bytes used by the objects that there is one of per agent or per
+    neuron of each agent. Data shared with the brain templates isn't
+    included."""
+    usage = OrderedDict([
+        ("agents", 0),
+        ("brains", 0),
+        ("neurons", 0),
+        ("results", 0),
+        ("histories", 0)
+    ])
+    for agent in sim.agents.values():
+        usage["agents"] += objectSize(agent)
+        brain = agent.brain
+        usage["brains"] += objectSize(brain) + sys.getsizeof(brain.neurons) + \
+            sys.getsizeof(brain.slots)
+        usage["results"] += sys.getsizeof(brain.results)
+        for neuron in brain.slots:
+            usage["neurons"] += objectSize(neuron)
+        if brain.history is not None:
+            usage["histories"] += sys.getsizeof(brain.history) + \
+                sum(sys.getsizeof(entry) + sys.getsizeof(entry[2])
+                    for entry in brain.history)
+    return usage
+
+
+def printMemory(sim):
+    logger.debug("Memory (MB)")
+    usage = memoryUsage(sim)
+    for k, v in usage.items():
+        logger.debug("     {} {:.2f}".format(k, v / 2**20))
+    logger.debug("     total {:.2f}".format(sum(usage.values()) / 2**20))